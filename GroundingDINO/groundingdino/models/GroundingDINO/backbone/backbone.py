@@ -168,6 +168,8 @@ def build_backbone(args):
         - return_interm_indices: available: [0,1,2,3], [1,2,3], [3]
         - backbone_freeze_keywords:
         - use_checkpoint: for swin only for now
+        - swin_kwargs: optional overrides of the swin architecture (embed_dim, depths, ...),
+                       e.g. a small swin for cpu benchmarks
 
     """
     position_embedding = build_position_encoding(args)
@@ -202,6 +204,7 @@ def build_backbone(args):
             out_indices=tuple(return_interm_indices),
             dilation=False,
             use_checkpoint=use_checkpoint,
+            **(getattr(args, "swin_kwargs", None) or {}),
         )
 
         bb_num_channels = backbone.num_features[4 - len(return_interm_indices) :]
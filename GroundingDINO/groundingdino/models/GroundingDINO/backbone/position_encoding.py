@@ -24,6 +24,7 @@ import math
 import torch
 from torch import nn
 
+from groundingdino.util.geometry_cache import geometry_cache, padding_signature
 from groundingdino.util.misc import NestedTensor
 
 
@@ -99,6 +100,21 @@ class PositionEmbeddingSineHW(nn.Module):
         x = tensor_list.tensors
         mask = tensor_list.mask
         assert mask is not None
+        if self.training or not geometry_cache.enabled:
+            return self.build_pos(mask, x.device)
+
+        # the embedding only depends on the mask, i.e. on the valid size of every image
+        key = padding_signature(mask) + (
+            str(x.device),
+            self.num_pos_feats,
+            self.temperatureH,
+            self.temperatureW,
+            self.normalize,
+            self.scale,
+        )
+        return geometry_cache.get("pos_sine_hw", key, lambda: self.build_pos(mask, x.device))
+
+    def build_pos(self, mask, device):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -110,11 +126,11 @@ class PositionEmbeddingSineHW(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_tx = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_tx = torch.arange(self.num_pos_feats, dtype=torch.float32, device=device)
         dim_tx = self.temperatureW ** (2 * (torch.div(dim_tx, 2, rounding_mode='floor')) / self.num_pos_feats)
         pos_x = x_embed[:, :, :, None] / dim_tx
 
-        dim_ty = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
+        dim_ty = torch.arange(self.num_pos_feats, dtype=torch.float32, device=device)
         dim_ty = self.temperatureH ** (2 * (torch.div(dim_ty, 2, rounding_mode='floor')) / self.num_pos_feats)
         pos_y = y_embed[:, :, :, None] / dim_ty
 
@@ -18,6 +18,7 @@ import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
+from groundingdino.util.geometry_cache import geometry_cache
 from groundingdino.util.misc import NestedTensor
 
 
@@ -406,17 +407,9 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x, H, W):
-        """Forward function.
-        Args:
-            x: Input feature, tensor size (B, H*W, C).
-            H, W: Spatial resolution of the input feature.
-        """
-
-        # calculate attention mask for SW-MSA
-        Hp = int(np.ceil(H / self.window_size)) * self.window_size
-        Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
+    def build_attn_mask(self, Hp, Wp, device):
+        """Attention mask for SW-MSA of a (padded) Hp x Wp feature map."""
+        img_mask = torch.zeros((1, Hp, Wp, 1), device=device)  # 1 Hp Wp 1
         h_slices = (
             slice(0, -self.window_size),
             slice(-self.window_size, -self.shift_size),
@@ -441,6 +434,23 @@ class BasicLayer(nn.Module):
         attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(
             attn_mask == 0, float(0.0)
         )
+        return attn_mask
+
+    def forward(self, x, H, W):
+        """Forward function.
+        Args:
+            x: Input feature, tensor size (B, H*W, C).
+            H, W: Spatial resolution of the input feature.
+        """
+
+        # calculate attention mask for SW-MSA, only depends on the padded size
+        Hp = int(np.ceil(H / self.window_size)) * self.window_size
+        Wp = int(np.ceil(W / self.window_size)) * self.window_size
+        attn_mask = geometry_cache.get(
+            "swin_attn_mask",
+            (Hp, Wp, self.window_size, self.shift_size, str(x.device)),
+            lambda: self.build_attn_mask(Hp, Wp, x.device),
+        )
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -97,7 +97,12 @@ def func_attention(query, context, smooth=1, raw_feature_norm="softmax", eps=1e-
 
 
 class BiMultiHeadAttention(nn.Module):
-    def __init__(self, v_dim, l_dim, embed_dim, num_heads, dropout=0.1, cfg=None):
+    def __init__(self, v_dim, l_dim, embed_dim, num_heads, dropout=0.1, chunk_size=0, cfg=None):
+        """
+        chunk_size: if > 0, attention is computed tile by tile over image tokens (or with
+            F.scaled_dot_product_attention when available), so that the (bs*heads, n_img, n_text)
+            attention matrix is never materialized. 0 keeps the dense implementation.
+        """
         super(BiMultiHeadAttention, self).__init__()
 
         self.embed_dim = embed_dim
@@ -111,6 +116,8 @@ class BiMultiHeadAttention(nn.Module):
         ), f"embed_dim must be divisible by num_heads (got `embed_dim`: {self.embed_dim} and `num_heads`: {self.num_heads})."
         self.scale = self.head_dim ** (-0.5)
         self.dropout = dropout
+        self.chunk_size = chunk_size
+        self.use_sdpa = hasattr(F, "scaled_dot_product_attention")
 
         self.v_proj = nn.Linear(self.v_dim, self.embed_dim)
         self.l_proj = nn.Linear(self.l_dim, self.embed_dim)
@@ -157,6 +164,9 @@ class BiMultiHeadAttention(nn.Module):
         """
         # if os.environ.get('IPDB_SHILONG_DEBUG', None) == 'INFO':
         #     import ipdb; ipdb.set_trace()
+        if self.chunk_size > 0:
+            return self.forward_memory_efficient(v, l, attention_mask_v, attention_mask_l)
+
         bsz, tgt_len, _ = v.size()
 
         query_states = self.v_proj(v) * self.scale
@@ -202,20 +212,19 @@ class BiMultiHeadAttention(nn.Module):
             )  # Do not increase 50000, data type half has quite limited range
 
         # mask vison for language
+        # masks are broadcast over heads through a view instead of being repeated
         if attention_mask_v is not None:
-            attention_mask_v = (
-                attention_mask_v[:, None, None, :].repeat(1, self.num_heads, 1, 1).flatten(0, 1)
+            attn_weights_l.view(bsz, self.num_heads, src_len, tgt_len).masked_fill_(
+                attention_mask_v[:, None, None, :], float("-inf")
             )
-            attn_weights_l.masked_fill_(attention_mask_v, float("-inf"))
 
         attn_weights_l = attn_weights_l.softmax(dim=-1)
 
         # mask language for vision
         if attention_mask_l is not None:
-            attention_mask_l = (
-                attention_mask_l[:, None, None, :].repeat(1, self.num_heads, 1, 1).flatten(0, 1)
+            attn_weights.view(bsz, self.num_heads, tgt_len, src_len).masked_fill_(
+                attention_mask_l[:, None, None, :], float("-inf")
             )
-            attn_weights.masked_fill_(attention_mask_l, float("-inf"))
         attn_weights_v = attn_weights.softmax(dim=-1)
 
         attn_probs_v = F.dropout(attn_weights_v, p=self.dropout, training=self.training)
@@ -247,6 +256,110 @@ class BiMultiHeadAttention(nn.Module):
 
         return attn_output_v, attn_output_l
 
+    def forward_memory_efficient(self, v, l, attention_mask_v=None, attention_mask_l=None):
+        """Same as forward, but memory is linear in the number of image tokens.
+
+        Uses F.scaled_dot_product_attention for both directions when torch provides it.
+        Otherwise image tokens are processed in tiles of self.chunk_size: image->text
+        attention is exact per tile, text->image attention uses an online softmax.
+
+        Args:
+            v: bs, n_img, dim
+            l: bs, n_text, dim
+            attention_mask_v: bs, n_img. True for padding
+            attention_mask_l: bs, n_text. True for padding
+        """
+        bsz, tgt_len, _ = v.size()
+        src_len = l.size(1)
+
+        # bs, nhead, n, head_dim. queries are not pre-scaled here
+        query_states = self._shape(self.v_proj(v), tgt_len, bsz)
+        key_states = self._shape(self.l_proj(l), src_len, bsz)
+        value_v_states = self._shape(self.values_v_proj(v), tgt_len, bsz)
+        value_l_states = self._shape(self.values_l_proj(l), src_len, bsz)
+
+        dropout_p = self.dropout if self.training else 0.0
+        if self.use_sdpa:
+            # boolean masks for sdpa are True for tokens taking part in attention
+            mask_l = None if attention_mask_l is None else ~attention_mask_l[:, None, None, :]
+            mask_v = None if attention_mask_v is None else ~attention_mask_v[:, None, None, :]
+            attn_output_v = F.scaled_dot_product_attention(
+                query_states, key_states, value_l_states, attn_mask=mask_l, dropout_p=dropout_p
+            )
+            attn_output_l = F.scaled_dot_product_attention(
+                key_states, query_states, value_v_states, attn_mask=mask_v, dropout_p=dropout_p
+            )
+        else:
+            attn_output_v, attn_output_l = self._chunked_attention(
+                query_states * self.scale,
+                key_states,
+                value_v_states,
+                value_l_states,
+                attention_mask_v,
+                attention_mask_l,
+                dropout_p,
+            )
+
+        attn_output_v = attn_output_v.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output_l = attn_output_l.transpose(1, 2).reshape(bsz, src_len, self.embed_dim)
+
+        attn_output_v = self.out_v_proj(attn_output_v)
+        attn_output_l = self.out_l_proj(attn_output_l)
+
+        return attn_output_v, attn_output_l
+
+    def _chunked_attention(
+        self, query, key, value_v, value_l, attention_mask_v, attention_mask_l, dropout_p
+    ):
+        """
+        query/value_v: bs, nhead, n_img, head_dim (query already scaled)
+        key/value_l: bs, nhead, n_text, head_dim
+        """
+        bsz, _, tgt_len, _ = query.shape
+        src_len = key.size(2)
+
+        mask_l = None if attention_mask_l is None else attention_mask_l[:, None, None, :]
+
+        outputs_v = []
+        # running max, normalizer and numerator of the text->image softmax
+        max_l = key.new_full((bsz, self.num_heads, src_len, 1), float("-inf"))
+        sum_l = key.new_zeros((bsz, self.num_heads, src_len, 1))
+        acc_l = torch.zeros_like(key)
+
+        for start in range(0, tgt_len, self.chunk_size):
+            end = min(start + self.chunk_size, tgt_len)
+            # bs, nhead, chunk, n_text
+            attn_weights = torch.matmul(query[:, :, start:end], key.transpose(-1, -2))
+            attn_weights = torch.clamp(attn_weights, min=-50000, max=50000)
+
+            # image -> text: the softmax is over text tokens, so each tile is exact
+            attn_weights_v = attn_weights
+            if mask_l is not None:
+                attn_weights_v = attn_weights_v.masked_fill(mask_l, float("-inf"))
+            attn_probs_v = F.dropout(attn_weights_v.softmax(dim=-1), p=dropout_p)
+            outputs_v.append(torch.matmul(attn_probs_v, value_l))
+
+            # text -> image: online softmax over image tiles
+            attn_weights_l = attn_weights.transpose(-1, -2)  # bs, nhead, n_text, chunk
+            if attention_mask_v is not None:
+                attn_weights_l = attn_weights_l.masked_fill(
+                    attention_mask_v[:, None, None, start:end], float("-inf")
+                )
+            new_max = torch.maximum(max_l, attn_weights_l.max(dim=-1, keepdim=True)[0])
+            safe_max = new_max.masked_fill(torch.isinf(new_max), 0)
+            rescale = torch.exp(max_l - safe_max)
+            exp_weights = torch.exp(attn_weights_l - safe_max)
+            sum_l = sum_l * rescale + exp_weights.sum(dim=-1, keepdim=True)
+            # dropout on the unnormalized weights equals dropout on the probabilities
+            acc_l = acc_l * rescale + torch.matmul(
+                F.dropout(exp_weights, p=dropout_p), value_v[:, :, start:end]
+            )
+            max_l = new_max
+
+        attn_output_v = torch.cat(outputs_v, dim=2)
+        attn_output_l = acc_l / sum_l
+        return attn_output_v, attn_output_l
+
 
 # Bi-Direction MHA (text->image, image->text)
 class BiAttentionBlock(nn.Module):
@@ -259,6 +372,7 @@ class BiAttentionBlock(nn.Module):
         dropout=0.1,
         drop_path=0.0,
         init_values=1e-4,
+        chunk_size=0,
         cfg=None,
     ):
         """
@@ -268,6 +382,7 @@ class BiAttentionBlock(nn.Module):
                          (usually 2-4x larger than embed_dim)
             num_heads - Number of heads to use in the Multi-Head Attention block
             dropout - Amount of dropout to apply in the feed-forward network
+            chunk_size - Image-token tile size of the memory-efficient attention (0 disables it)
         """
         super(BiAttentionBlock, self).__init__()
 
@@ -275,7 +390,12 @@ class BiAttentionBlock(nn.Module):
         self.layer_norm_v = nn.LayerNorm(v_dim)
         self.layer_norm_l = nn.LayerNorm(l_dim)
         self.attn = BiMultiHeadAttention(
-            v_dim=v_dim, l_dim=l_dim, embed_dim=embed_dim, num_heads=num_heads, dropout=dropout
+            v_dim=v_dim,
+            l_dim=l_dim,
+            embed_dim=embed_dim,
+            num_heads=num_heads,
+            dropout=dropout,
+            chunk_size=chunk_size,
         )
 
         # add layer scale for training stability
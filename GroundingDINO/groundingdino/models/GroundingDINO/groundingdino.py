@@ -34,6 +34,8 @@ from torchvision.ops.boxes import batched_nms
 import torch.distributed as dist
 
 from groundingdino.util import box_ops, get_tokenlizer
+from groundingdino.util.geometry_cache import geometry_cache
+from groundingdino.util.stage_timer import stage_timer
 from groundingdino.util.misc import (
     NestedTensor,
     accuracy,
@@ -386,6 +388,36 @@ class GroundingDINO(nn.Module):
         return text_dict
 
 
+    def encode_image(self, samples: NestedTensor):
+        """Multi-scale projected backbone features, masks and position embeddings."""
+        features, poss = self.backbone(samples)
+
+        srcs = []
+        masks = []
+        for l, feat in enumerate(features):
+            src, mask = feat.decompose()
+            srcs.append(self.input_proj[l](src))
+            masks.append(mask)
+            assert mask is not None
+
+
+        if self.num_feature_levels > len(srcs):
+            _len_srcs = len(srcs)
+            for l in range(_len_srcs, self.num_feature_levels):
+                if l == _len_srcs:
+                    src = self.input_proj[l](features[-1].tensors)
+                else:
+                    src = self.input_proj[l](srcs[-1])
+                m = samples.mask
+                mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
+                pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
+                srcs.append(src)
+                masks.append(mask)
+                poss.append(pos_l)
+
+        return srcs, masks, poss
+
+
     def forward(self, samples: NestedTensor, targets: List = None, **kw):
         """The forward expects a NestedTensor, which consists of:
            - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
@@ -400,25 +432,42 @@ class GroundingDINO(nn.Module):
                            See PostProcess for information on how to retrieve the unnormalized bounding box.
            - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
                             dictionnaries containing the two above keys for each decoder layer.
+
+        With kw["inference_only"]=True (and no denoising queries) only the heads of the last decoder
+        layer are computed and "aux_outputs" / "interm_outputs" are not returned, i.e. the outputs
+        are enough for the postprocessors but not for the criterion.
+
+        kw["text_dict"] / kw["rel_text_dict"] (outputs of encode_captions, batch size matching
+        samples) replace the captions, so that the text features of a vocabulary can be reused.
         """
-        if targets is None:
-            captions = kw["captions"]
-            rel_captions = kw['rel_captions'] if 'rel_captions' in kw else []
+        if kw.get("text_dict") is not None:
+            # pre-encoded text features (encode_captions), e.g. cached per vocabulary.
+            # shallow copies: the entries are replaced below, the tensors are not modified
+            text_dict = dict(kw["text_dict"])
+            rel_text_dict = dict(kw["rel_text_dict"]) if kw.get("rel_text_dict") is not None else None
+            if self.do_sgg and self.sgg_mode != 'full' and rel_text_dict is None:
+                raise Exception("rel_text_dict cannot be None !")
         else:
-            captions = [t["caption"] for t in targets]
-            rel_captions = [t['rel_caption'] for t in targets] if 'rel_caption' \
-                            in targets[0] else [] 
+            if targets is None:
+                captions = kw["captions"]
+                rel_captions = kw['rel_captions'] if 'rel_captions' in kw else []
+            else:
+                captions = [t["caption"] for t in targets]
+                rel_captions = [t['rel_caption'] for t in targets] if 'rel_caption' \
+                                in targets[0] else [] 
 
 
-        # text features
-        text_dict = self.encode_captions(captions, samples.device, encode_relation=False)
+            # text features
+            with stage_timer("encode_captions"):
+                text_dict = self.encode_captions(captions, samples.device, encode_relation=False)
 
-        if self.do_sgg and len(rel_captions) == 0 and self.sgg_mode != 'full':
-            raise Exception("rel_caption cannot be None !")
+            if self.do_sgg and len(rel_captions) == 0 and self.sgg_mode != 'full':
+                raise Exception("rel_caption cannot be None !")
 
-        rel_text_dict = None 
-        if self.do_sgg and self.sgg_mode != 'full':
-            rel_text_dict = self.encode_captions(rel_captions, samples.device, encode_relation=True)
+            rel_text_dict = None 
+            if self.do_sgg and self.sgg_mode != 'full':
+                with stage_timer("encode_captions"):
+                    rel_text_dict = self.encode_captions(rel_captions, samples.device, encode_relation=True)
 
         concat_rel_text =  True #if os.environ.get("DEBUG") == '1' else True 
         if rel_text_dict is not None and concat_rel_text:
@@ -439,31 +488,7 @@ class GroundingDINO(nn.Module):
         # visual features
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
-        features, poss = self.backbone(samples)
-
-        srcs = []
-        masks = []
-        for l, feat in enumerate(features):
-            src, mask = feat.decompose()
-            srcs.append(self.input_proj[l](src))
-            masks.append(mask)
-            assert mask is not None
-            backbone_feature = None 
-
-
-        if self.num_feature_levels > len(srcs):
-            _len_srcs = len(srcs)
-            for l in range(_len_srcs, self.num_feature_levels):
-                if l == _len_srcs:
-                    src = self.input_proj[l](features[-1].tensors)
-                else:
-                    src = self.input_proj[l](srcs[-1])
-                m = samples.mask
-                mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
-                pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
-                srcs.append(src)
-                masks.append(mask)
-                poss.append(pos_l)
+        srcs, masks, poss = self.encode_image(samples)
 
         # dn part 
         use_dn = self.dn_number > 0 and targets is not None 
@@ -495,6 +520,9 @@ class GroundingDINO(nn.Module):
             text_dict['text_self_attention_masks'] = text_dict['text_self_attention_masks'][:, :sep_len[0], :sep_len[0]]
 
 
+        if kw.get("inference_only", False) and dn_meta is None:
+            return self.forward_last_layer(hs, hs_rln, reference, text_dict, rel_text_dict)
+
         # deformable-detr-like anchor update
         outputs_coord_list = []
         for dec_lid, (layer_ref_sig, layer_bbox_embed, layer_hs) in enumerate(
@@ -559,6 +587,21 @@ class GroundingDINO(nn.Module):
         
         return out
 
+    def forward_last_layer(self, hs, hs_rln, reference, text_dict, rel_text_dict):
+        """Box / class heads of the last decoder layer only, for inference."""
+        lid = len(hs) - 1
+        outputs_coord = (self.bbox_embed[lid](hs[lid]) + inverse_sigmoid(reference[lid])).sigmoid()
+        outputs_class = self.class_embed[lid](hs[lid], text_dict)
+
+        out = {"pred_logits": outputs_class, "pred_boxes": outputs_coord}
+        out['input_ids'] = text_dict['input_ids']
+        if self.do_sgg:
+            out['hs_rln'] = hs_rln[-1]
+            out['hs_obj'] = hs[-1]
+            out['rel_text_dict'] = rel_text_dict
+
+        return out
+
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord):
         # this is a workaround to make torchscript happy, as torchscript
@@ -599,6 +642,9 @@ class PostProcess(nn.Module):
         self.name2predicates = kwargs.get("name2predicates", None)
         self.max_text_len = kwargs.get("max_text_len", 2048)
         self.matcher = kwargs.get("matcher", None)
+        # with fewer decoder queries (Transformer.set_query_selection), the number of
+        # detections sent to graph_infer is capped at the number of queries
+        self.cap_detections_to_queries = kwargs.get("cap_detections_to_queries", False)
 
         if self.use_text_labels:
             assert self.tokenizer is not None, " tokenzier should not be None when use text labels !"
@@ -651,6 +697,9 @@ class PostProcess(nn.Module):
         num_select = self.num_select
         out_logits, out_bbox = outputs['pred_logits'], outputs['pred_boxes']
         device = out_logits.device
+        detections_per_img = self.detections_per_img
+        if self.cap_detections_to_queries:
+            detections_per_img = min(detections_per_img, out_logits.shape[1])
 
         fake_predcls = False 
         if gt_dicts is not None:
@@ -674,6 +723,8 @@ class PostProcess(nn.Module):
             prob =  prob_to_label
 
             num_cat = prob.shape[2]
+            # fewer decoder queries may leave less than num_select query x class pairs
+            num_select = min(num_select, prob.shape[1] * num_cat)
             topk_values, topk_indexes = torch.topk(prob.view(batch_size, -1), num_select, dim=1)
             scores = topk_values
             topk_boxes = topk_indexes // num_cat
@@ -725,6 +776,8 @@ class PostProcess(nn.Module):
             """
         else:
             num_cat = prob.shape[2]
+            # fewer decoder queries may leave less than num_select query x class pairs
+            num_select = min(num_select, prob.shape[1] * num_cat)
             topk_values, topk_indexes = torch.topk(prob.view(batch_size, -1), num_select, dim=1)
             scores = topk_values
             topk_boxes = topk_indexes // num_cat
@@ -774,7 +827,7 @@ class PostProcess(nn.Module):
         if self.nms_iou_threshold > 0:
             item_indices = [batched_nms(b, s, l, iou_threshold=self.nms_iou_threshold) for b,s,l in zip(boxes, scores, labels)]
 
-            item_indices = [e[:self.detections_per_img] for e in item_indices]
+            item_indices = [e[:detections_per_img] for e in item_indices]
 
             if self.do_sgg:
                 results = [{'scores': s[i], 'labels': l[i], 
@@ -785,14 +838,14 @@ class PostProcess(nn.Module):
         else:
             
             if self.do_sgg:
-                results = [{'scores': s[:self.detections_per_img], 
-                            'labels': l[:self.detections_per_img], 
-                            'boxes': b[:self.detections_per_img], 
-                            'obj_token': ot[:self.detections_per_img]} for s, l, b, ot in zip(scores, labels, boxes, obj_token)]
+                results = [{'scores': s[:detections_per_img], 
+                            'labels': l[:detections_per_img], 
+                            'boxes': b[:detections_per_img], 
+                            'obj_token': ot[:detections_per_img]} for s, l, b, ot in zip(scores, labels, boxes, obj_token)]
             else:
-                results = [{'scores': s[:self.detections_per_img], 
-                            'labels': l[:self.detections_per_img], 
-                            'boxes': b[:self.detections_per_img]} for s, l, b in zip(scores, labels, boxes)]
+                results = [{'scores': s[:detections_per_img], 
+                            'labels': l[:detections_per_img], 
+                            'boxes': b[:detections_per_img]} for s, l, b in zip(scores, labels, boxes)]
 
         if self.score_threshold > 0:
             def _score_filter(result, threshold):
@@ -813,15 +866,16 @@ class PostProcess(nn.Module):
                     for batch_id, result in enumerate(results)]
                      
 
-            sgg_out = graph_infer(results, self.rln_proj, self.rln_classifier, 
-                                  self.rln_freq_bias,
-                                  outputs['rel_text_dict'],
-                                  self.name2predicates, 
-                                  self.tokenizer, 
-                                  use_sigmoid=True,
-                                  use_classifier=self.rln_classifier is not None,
-                                  save_features=False
-                                  )
+            with stage_timer("graph_infer"):
+                sgg_out = graph_infer(results, self.rln_proj, self.rln_classifier, 
+                                      self.rln_freq_bias,
+                                      outputs['rel_text_dict'],
+                                      self.name2predicates, 
+                                      self.tokenizer, 
+                                      use_sigmoid=True,
+                                      use_classifier=self.rln_classifier is not None,
+                                      save_features=False
+                                      )
 
             for batch, res in enumerate(results):
                 res.update({'graph': sgg_out[batch]})
@@ -832,6 +886,9 @@ class PostProcess(nn.Module):
 
 @MODULE_BUILD_FUNCS.registe_with_name(module_name="groundingdino")
 def build_groundingdino(args):
+    # shape dependent masks / embeddings / proposals reused across forward passes, 0 disables
+    geometry_cache.configure(max_entries=getattr(args, "geometry_cache_size", 64),
+                             max_bytes=getattr(args, "geometry_cache_mb", 256) * 2 ** 20)
     backbone = build_backbone(args)
     frozen_backbone = getattr(args, "frozen_backbone", False)
     if frozen_backbone:
@@ -994,7 +1051,9 @@ def build_groundingdino(args):
                         detections_per_img=getattr(args, "detections_per_img", 100),
                         temperature=getattr(args, "obj_temp", 1.0) / args.hidden_dim,
                         max_text_len=getattr(args, "max_text_len", 2048),
-                        use_gt_box=getattr(args, "use_gt_box", False)
+                        use_gt_box=getattr(args, "use_gt_box", False),
+                        cap_detections_to_queries=getattr(args, "infer_num_queries", None) is not None
+                                                  or getattr(args, "infer_query_threshold", None) is not None,
                     )}
     if postprocessors['bbox'].use_gt_box:
         print("*"*10, " PostProcessing use GT Boxes !")
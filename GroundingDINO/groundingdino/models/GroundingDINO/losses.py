@@ -16,6 +16,7 @@ import copy
 from torchvision.ops import roi_pool
 
 from .matcher import search_query_pos
+from groundingdino.util.stage_timer import stage_timer
 
 import math
 import numpy as np
@@ -41,6 +42,18 @@ def tensor_to_list(x):
     return x
 
 
+def rank_within_groups(group_ids, scores):
+    """Rank (0-based, ascending score) of every element among the elements of its group."""
+    if group_ids.numel() == 0:
+        return group_ids.clone()
+    order = torch.argsort(group_ids.double() * 2 + scores.double())
+    position = torch.empty_like(order)
+    position[order] = torch.arange(len(order), device=order.device)
+    counts = torch.bincount(group_ids)
+    starts = torch.cumsum(counts, 0) - counts
+    return position - starts[group_ids]
+
+
 class SetCriterion(nn.Module):
     """ This class computes the loss for Conditional DETR.
     The process happens in two steps:
@@ -222,7 +235,8 @@ class SetCriterion(nn.Module):
             'obj_likelihood': self.loss_obj_likelihood,
         }
         assert loss in loss_map, f'do you really want to compute {loss} loss?'
-        return loss_map[loss](outputs, targets, indices, num_boxes, **kwargs)
+        with stage_timer("loss_" + loss):
+            return loss_map[loss](outputs, targets, indices, num_boxes, **kwargs)
 
     def loss_obj_likelihood(self, outputs, targets, indices, num_boxes):
         assert "pred_obj" in outputs, "pred_obj does not exist in outputs, outputs.keys:{}".format(outputs.keys())
@@ -237,6 +251,81 @@ class SetCriterion(nn.Module):
 
 
 
+    @torch.no_grad()
+    def _sample_relation_pairs(self, targets, indices, device):
+        """
+        Batched positive / negative pair sampling of loss_edges for integer predicates.
+        Matches are scattered into a (bs, num_gt) map and negatives are drawn uniformly
+        without replacement for all images at once from a (bs, num_gt, num_gt) candidate mask.
+
+        Returns:
+            sid, oid: (N, 2) [batch id, query id] of subjects and objects
+            edge_lbl: (N,) predicate labels, 0 for negatives
+            batch_ids: (N,)
+            s_labels, o_labels: (N,) gt object labels of subjects and objects
+        """
+        bs = len(targets)
+        max_gt = max(max(len(t['labels']) for t in targets), 1)
+
+        # gt id -> matched query id, -1 if not matched
+        match_map = torch.full((bs, max_gt), -1, dtype=torch.long, device=device)
+        tgt_bid, tgt_idx = self._get_tgt_permutation_idx(indices)
+        src_idx = torch.cat([src for (src, _) in indices])
+        match_map[tgt_bid.to(device), tgt_idx.to(device)] = src_idx.to(device)
+
+        gt_labels = torch.zeros((bs, max_gt), dtype=torch.long, device=device)
+        for bid, target in enumerate(targets):
+            gt_labels[bid, :len(target['labels'])] = target['labels']
+
+        edges = [torch.as_tensor(t['edges'], dtype=torch.long, device=device).reshape(-1, 3)
+                 for t in targets]
+        num_edges = torch.as_tensor([len(e) for e in edges], device=device)
+        edges = torch.cat(edges)
+        edge_bid = torch.repeat_interleave(torch.arange(bs, device=device), num_edges)
+
+        matched = (match_map[edge_bid, edges[:, 0]] >= 0) & (match_map[edge_bid, edges[:, 1]] >= 0)
+
+        # negatives: ordered pairs of matched gts without annotated relation,
+        # only for images with relations
+        node_valid = match_map >= 0
+        neg_mask = node_valid[:, :, None] & node_valid[:, None, :]
+        neg_mask &= ~torch.eye(max_gt, dtype=torch.bool, device=device)[None]
+        neg_mask &= (num_edges > 0)[:, None, None]
+        neg_mask[edge_bid[matched], edges[matched, 0], edges[matched, 1]] = False
+
+        # positives
+        keep_pos = matched
+        if not self.is_closed_set and self.fix_rel_batch:
+            pos_num_per_img = int(self.rel_batch_per_image * 0.25)
+            rank = rank_within_groups(edge_bid, torch.rand(len(edge_bid), device=device))
+            keep_pos = keep_pos & (rank < pos_num_per_img)
+        num_pos = torch.bincount(edge_bid[keep_pos], minlength=bs)
+
+        if self.is_closed_set:
+            num_neg = torch.clamp(num_pos * 3, min=1)
+        else:
+            num_neg = torch.clamp(self.rel_batch_per_image - num_pos, min=1)
+        neg_mask = neg_mask.flatten(1)
+        num_neg = torch.minimum(num_neg, neg_mask.sum(1))
+
+        # top-k of random scores over the candidates == uniform sampling without replacement
+        k = int(num_neg.max().item())
+        scores = torch.rand(neg_mask.shape, device=device).masked_fill_(~neg_mask, -1.0)
+        neg_flat = scores.topk(k, dim=1)[1]
+        keep_neg = torch.arange(k, device=device)[None] < num_neg[:, None]
+        neg_bid = torch.arange(bs, device=device)[:, None].expand(-1, k)[keep_neg]
+        neg_flat = neg_flat[keep_neg]
+
+        batch_ids = torch.cat((edge_bid[keep_pos], neg_bid))
+        s_gt = torch.cat((edges[keep_pos, 0], torch.div(neg_flat, max_gt, rounding_mode='floor')))
+        o_gt = torch.cat((edges[keep_pos, 1], neg_flat % max_gt))
+        edge_lbl = torch.cat((edges[keep_pos, 2], torch.zeros_like(neg_bid)))
+
+        sid = torch.stack((batch_ids, match_map[batch_ids, s_gt]), 1)
+        oid = torch.stack((batch_ids, match_map[batch_ids, o_gt]), 1)
+
+        return sid, oid, edge_lbl, batch_ids, gt_labels[batch_ids, s_gt], gt_labels[batch_ids, o_gt]
+
     def loss_edges(self, outputs, targets, indices, num_boxes,
                    object_token, relation_token, rel_text_dict, 
                    rel_text_dict_t=None, outputs_t=None, indices_t=None):
@@ -263,167 +352,173 @@ class SetCriterion(nn.Module):
 
         # if "edges" provided
         if not relation_wo_labels: # 
-            all_edge_lbl = []
             freq_dist = []
-            batch_ids = []
-
-            sid, oid = [], []
-            s_labels, o_labels = [], []
-            sid_t, oid_t = [], []
-            for bid, target in enumerate(targets):
-                tgt_edges = target['edges']
-                if len(tgt_edges) == 0:
-                    continue 
+            if not relation_is_str and outputs_t is None:
+                # integer predicates without teacher: sample all pairs at once on device
+                sid, oid, all_edge_lbl, batch_ids, s_labels, o_labels = \
+                        self._sample_relation_pairs(targets, indices, device)
+                assert len(sid) > 0, " Error: no relation pairs sampled"
+            else:
+                all_edge_lbl = []
+                batch_ids = []
+
+                sid, oid = [], []
+                s_labels, o_labels = [], []
+                sid_t, oid_t = [], []
+                for bid, target in enumerate(targets):
+                    tgt_edges = target['edges']
+                    if len(tgt_edges) == 0:
+                        continue 
                 
-                matched = {}
-                for src, dst in zip(indices[bid][0].tolist(), indices[bid][1].tolist()):
-                    matched[dst] = src
-                # negatives
-                num_pos = num_total = 0
-                n = len(matched)
-                full_adj = torch.ones((n,n))-torch.diag(torch.ones(n))
-                for edge in tensor_to_list(tgt_edges):
-                    if edge[0] in matched and edge[1] in matched:
-                        full_adj[edge[0], edge[1]] = 0
-
-                # teacher's matched nodes (optional)
-                if outputs_t is not None:
-                    matched_t = {}
-                    for src, dst in zip(indices_t[bid][0].tolist(), indices_t[bid][1].tolist()):
-                        matched_t[dst] = src
+                    matched = {}
+                    for src, dst in zip(indices[bid][0].tolist(), indices[bid][1].tolist()):
+                        matched[dst] = src
+                    # negatives
+                    num_pos = num_total = 0
+                    n = len(matched)
+                    full_adj = torch.ones((n,n))-torch.diag(torch.ones(n))
+                    for edge in tensor_to_list(tgt_edges):
+                        if edge[0] in matched and edge[1] in matched:
+                            full_adj[edge[0], edge[1]] = 0
+
+                    # teacher's matched nodes (optional)
+                    if outputs_t is not None:
+                        matched_t = {}
+                        for src, dst in zip(indices_t[bid][0].tolist(), indices_t[bid][1].tolist()):
+                            matched_t[dst] = src
 
                 
-                # positives 
-                if not self.is_closed_set and self.fix_rel_batch:
-                    pos_num_per_img = int(self.rel_batch_per_image * 0.25)
-                    if len(tgt_edges) > pos_num_per_img:
-                        if isinstance(tgt_edges, list):
-                            tgt_edges = random.sample(tgt_edges, pos_num_per_img)
-                        else:
-                            tgt_edges = tgt_edges[torch.randperm(len(tgt_edges))][:pos_num_per_img]
+                    # positives 
+                    if not self.is_closed_set and self.fix_rel_batch:
+                        pos_num_per_img = int(self.rel_batch_per_image * 0.25)
+                        if len(tgt_edges) > pos_num_per_img:
+                            if isinstance(tgt_edges, list):
+                                tgt_edges = random.sample(tgt_edges, pos_num_per_img)
+                            else:
+                                tgt_edges = tgt_edges[torch.randperm(len(tgt_edges))][:pos_num_per_img]
+
+                    for edge in tensor_to_list(tgt_edges):
+                        if edge[0] in matched and edge[1] in matched:
+                            sid.append([bid, matched[edge[0]]])
+                            oid.append([bid, matched[edge[1]]])
+                            if relation_is_str:
+                                rel_tgt.append(edge[2])
+                            else:
+                                all_edge_lbl.append(edge[2])
 
-                for edge in tensor_to_list(tgt_edges):
-                    if edge[0] in matched and edge[1] in matched:
+                            num_pos += 1
+                            #full_adj[edge[0], edge[1]] = 0
+
+                            if self.rln_freq_bias is not None:
+                                s_labels.append(target['labels'][edge[0]])
+                                o_labels.append(target['labels'][edge[1]])
+
+                            if outputs_t is not None:
+                                sid_t.append([bid, matched_t[edge[0]]])
+                                oid_t.append([bid, matched_t[edge[1]]])
+
+                    # negatives 
+                    neg_edges = torch.nonzero(full_adj)
+                    if self.is_closed_set or (relation_is_str and not self.fix_rel_batch):
+                        num_neg_per_img = max(1, num_pos * 3)  
+                    else:
+                        num_neg_per_img = max(1, self.rel_batch_per_image - num_pos) 
+
+                    if len(neg_edges) >= num_neg_per_img:
+                        if outputs_t is not None and not self.unsupervised_distill:
+                            # sample
+                            hs_obj_t = outputs_t['hs_obj'][bid]
+                            nsid, noid = [], []
+                            for edge in neg_edges.tolist():
+                                nsid.append(matched_t[edge[0]])
+                                noid.append(matched_t[edge[1]])
+                            nsid = torch.as_tensor(nsid)
+                            noid = torch.as_tensor(noid)
+                        
+                            feat = torch.cat((hs_obj_t[nsid], hs_obj_t[noid],
+                                              outputs_t['hs_rln'][bid].flatten(1).repeat(nsid.shape[0], 1)),
+                                              1)
+                            with torch.no_grad():
+                                feat = self.rln_proj_teacher(feat)
+                                encoded_text = rel_text_dict_t['encoded_text'][bid]
+                                feat = (feat @ encoded_text.T).sigmoid()
+
+                            feat_score = feat.max(-1)[0]
+
+                            if self.rel_proposals_threshold_enabled:
+                                keep1 = torch.where(feat_score > self.rel_proposals_threshold)[0]
+                                keep2 = feat_score.topk(num_neg_per_img)[1]
+                                keep = torch.cat((keep1, keep2)).unique()
+                            else:
+                                keep = feat_score.topk(num_neg_per_img)[1]
+
+                            neg_edges = neg_edges[keep.to(neg_edges.device)]
+                        else:
+                            if sample_cross_frame:
+                                idx_ = torch.randperm(neg_edges.shape[0])[: max(1, num_pos*3)]
+                                neg_edges = neg_edges[idx_]
+                            else:
+                                idx_ = torch.randperm(neg_edges.shape[0])[:num_neg_per_img]
+                                neg_edges = neg_edges[idx_]
+                
+                    for edge in neg_edges.tolist():
                         sid.append([bid, matched[edge[0]]])
                         oid.append([bid, matched[edge[1]]])
-                        if relation_is_str:
-                            rel_tgt.append(edge[2])
-                        else:
-                            all_edge_lbl.append(edge[2])
-
-                        num_pos += 1
-                        #full_adj[edge[0], edge[1]] = 0
 
                         if self.rln_freq_bias is not None:
                             s_labels.append(target['labels'][edge[0]])
                             o_labels.append(target['labels'][edge[1]])
 
+                        if relation_is_str:
+                            rel_tgt.append('[UNK]')
+                        else:
+                            all_edge_lbl.append(0)
+
+                        num_total += 1
                         if outputs_t is not None:
                             sid_t.append([bid, matched_t[edge[0]]])
                             oid_t.append([bid, matched_t[edge[1]]])
 
-                # negatives 
-                neg_edges = torch.nonzero(full_adj)
-                if self.is_closed_set or (relation_is_str and not self.fix_rel_batch):
-                    num_neg_per_img = max(1, num_pos * 3)  
-                else:
-                    num_neg_per_img = max(1, self.rel_batch_per_image - num_pos) 
-
-                if len(neg_edges) >= num_neg_per_img:
-                    if outputs_t is not None and not self.unsupervised_distill:
-                        # sample
-                        hs_obj_t = outputs_t['hs_obj'][bid]
-                        nsid, noid = [], []
-                        for edge in neg_edges.tolist():
-                            nsid.append(matched_t[edge[0]])
-                            noid.append(matched_t[edge[1]])
-                        nsid = torch.as_tensor(nsid)
-                        noid = torch.as_tensor(noid)
-                        
-                        feat = torch.cat((hs_obj_t[nsid], hs_obj_t[noid],
-                                          outputs_t['hs_rln'][bid].flatten(1).repeat(nsid.shape[0], 1)),
-                                          1)
-                        with torch.no_grad():
-                            feat = self.rln_proj_teacher(feat)
-                            encoded_text = rel_text_dict_t['encoded_text'][bid]
-                            feat = (feat @ encoded_text.T).sigmoid()
-
-                        feat_score = feat.max(-1)[0]
-
-                        if self.rel_proposals_threshold_enabled:
-                            keep1 = torch.where(feat_score > self.rel_proposals_threshold)[0]
-                            keep2 = feat_score.topk(num_neg_per_img)[1]
-                            keep = torch.cat((keep1, keep2)).unique()
-                        else:
-                            keep = feat_score.topk(num_neg_per_img)[1]
-
-                        neg_edges = neg_edges[keep.to(neg_edges.device)]
-                    else:
-                        if sample_cross_frame:
-                            idx_ = torch.randperm(neg_edges.shape[0])[: max(1, num_pos*3)]
-                            neg_edges = neg_edges[idx_]
-                        else:
-                            idx_ = torch.randperm(neg_edges.shape[0])[:num_neg_per_img]
-                            neg_edges = neg_edges[idx_]
-                
-                for edge in neg_edges.tolist():
-                    sid.append([bid, matched[edge[0]]])
-                    oid.append([bid, matched[edge[1]]])
-
-                    if self.rln_freq_bias is not None:
-                        s_labels.append(target['labels'][edge[0]])
-                        o_labels.append(target['labels'][edge[1]])
-
-                    if relation_is_str:
-                        rel_tgt.append('[UNK]')
-                    else:
-                        all_edge_lbl.append(0)
-
-                    num_total += 1
-                    if outputs_t is not None:
-                        sid_t.append([bid, matched_t[edge[0]]])
-                        oid_t.append([bid, matched_t[edge[1]]])
-
-                # sample within a batch if needed
-                if sample_cross_frame:
-                    sample_num = num_neg_per_img - len(neg_edges)
-                    if sample_num > 0 and len(targets) > 1:
-                        p = np.array([1]*len(targets))
-                        p[bid] = 0
-                        p = p / p.sum() 
-                        sample_bid = np.random.choice(range(len(targets)), sample_num, p=p)
-                        sample_tid = np.random.choice(range(object_token.shape[1]), sample_num)
+                    # sample within a batch if needed
+                    if sample_cross_frame:
+                        sample_num = num_neg_per_img - len(neg_edges)
+                        if sample_num > 0 and len(targets) > 1:
+                            p = np.array([1]*len(targets))
+                            p[bid] = 0
+                            p = p / p.sum() 
+                            sample_bid = np.random.choice(range(len(targets)), sample_num, p=p)
+                            sample_tid = np.random.choice(range(object_token.shape[1]), sample_num)
                          
-                        for c_bid, c_tid in zip(sample_bid, sample_tid):
-                            if len(tgt_edges) > 0:
-                                 pos_edge = random.choice(tgt_edges)
-                                 pos_edge = (matched[pos_edge[0]], matched[pos_edge[1]])
-                            else: 
-                                 if len(matched) > 0:
-                                     pos_edge = np.random.choice(list(matched.keys()), 2)
+                            for c_bid, c_tid in zip(sample_bid, sample_tid):
+                                if len(tgt_edges) > 0:
+                                     pos_edge = random.choice(tgt_edges)
                                      pos_edge = (matched[pos_edge[0]], matched[pos_edge[1]])
-                                 else:
-                                     pos_edge = np.random.choice(range(object_token.shape[1]), 2)
-
-                            if random.random() > 0.5:
-                                 sid.append([bid, pos_edge[0]])
-                                 oid.append([c_bid, c_tid])
-                            else:
-                                 oid.append([bid, pos_edge[1]])
-                                 sid.append([c_bid, c_tid])
-                            rel_tgt.append('[UNK]')
-                            num_total += 1 
-
-                num_total += num_pos
-                batch_ids.extend([bid] * num_total)
-
-            assert len(sid) == len(oid) and len(sid) > 0, " Error: len(sid):%s, len(oid):%s" %(len(sid), len(oid))
-            sid = torch.as_tensor(sid)
-            oid = torch.as_tensor(oid)
-            if not relation_is_str:
-                all_edge_lbl = torch.as_tensor(all_edge_lbl)
-
-            batch_ids = torch.as_tensor(batch_ids)
+                                else: 
+                                     if len(matched) > 0:
+                                         pos_edge = np.random.choice(list(matched.keys()), 2)
+                                         pos_edge = (matched[pos_edge[0]], matched[pos_edge[1]])
+                                     else:
+                                         pos_edge = np.random.choice(range(object_token.shape[1]), 2)
+
+                                if random.random() > 0.5:
+                                     sid.append([bid, pos_edge[0]])
+                                     oid.append([c_bid, c_tid])
+                                else:
+                                     oid.append([bid, pos_edge[1]])
+                                     sid.append([c_bid, c_tid])
+                                rel_tgt.append('[UNK]')
+                                num_total += 1 
+
+                    num_total += num_pos
+                    batch_ids.extend([bid] * num_total)
+
+                assert len(sid) == len(oid) and len(sid) > 0, " Error: len(sid):%s, len(oid):%s" %(len(sid), len(oid))
+                sid = torch.as_tensor(sid)
+                oid = torch.as_tensor(oid)
+                if not relation_is_str:
+                    all_edge_lbl = torch.as_tensor(all_edge_lbl)
+
+                batch_ids = torch.as_tensor(batch_ids)
             if self.ablation_mode == 'wo_rln':
                 relation_feature = torch.cat((object_token[sid[:, 0], sid[:, 1]],
                                  object_token[oid[:, 0], oid[:, 1]]), 1)
@@ -22,6 +22,7 @@ import torch
 import torch.utils.checkpoint as checkpoint
 from torch import Tensor, nn
 
+from groundingdino.util.geometry_cache import geometry_cache
 from groundingdino.util.misc import inverse_sigmoid
 
 from .fuse_modules import BiAttentionBlock
@@ -71,6 +72,7 @@ class Transformer(nn.Module):
         text_dropout=0.1,
         fusion_dropout=0.1,
         fusion_droppath=0.0,
+        fusion_chunk_size=0,
         # sgg
         do_sgg=False
     ):
@@ -107,6 +109,7 @@ class Transformer(nn.Module):
                 num_heads=nhead // 2,
                 dropout=fusion_dropout,
                 drop_path=fusion_droppath,
+                chunk_size=fusion_chunk_size,
             )
         else:
             feature_fusion_layer = None
@@ -189,8 +192,40 @@ class Transformer(nn.Module):
         self.enc_out_class_embed = None
         self.enc_out_bbox_embed = None
 
+        # query reduction at inference, see set_query_selection
+        self.infer_num_queries = None
+        self.infer_query_threshold = None
+        self.infer_min_queries = 10
+        self.last_num_queries = num_queries
+
         self._reset_parameters()
 
+    def set_query_selection(self, num_queries=None, threshold=None, min_queries=10):
+        """
+        Select fewer encoder proposals as decoder queries at inference (eval mode,
+        two_stage_type "standard"); the proposals are ranked by their text conditioned
+        encoder scores (enc_out_class_embed) as in training.
+            num_queries: queries kept, None: num_queries of the model
+            threshold: keep the proposals whose score (sigmoid of the max text logit)
+                is above threshold, at least min_queries and at most num_queries.
+                Images of a batch share the largest count.
+        last_num_queries is the number of queries of the last forward.
+        """
+        self.infer_num_queries = num_queries
+        self.infer_query_threshold = threshold
+        self.infer_min_queries = min_queries
+
+    def _inference_topk(self, topk_logits, mask_flatten):
+        topk = self.num_queries
+        if self.infer_num_queries is not None:
+            topk = min(topk, self.infer_num_queries)
+        if self.infer_query_threshold is not None:
+            # padded positions have zero features, they are not counted
+            scores = topk_logits.sigmoid().masked_fill(mask_flatten, 0)
+            count = int((scores > self.infer_query_threshold).sum(1).max().item())
+            topk = max(min(count, topk), min(self.infer_min_queries, topk))
+        return min(topk, topk_logits.shape[1])
+
     def _reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
@@ -288,7 +323,7 @@ class Transformer(nn.Module):
 
         if self.two_stage_type == "standard":
             output_memory, output_proposals = gen_encoder_output_proposals(
-                memory, mask_flatten, spatial_shapes
+                memory, mask_flatten, spatial_shapes, use_cache=not self.training
             )
             output_memory = self.enc_output_norm(self.enc_output(output_memory))
 
@@ -302,6 +337,9 @@ class Transformer(nn.Module):
                 self.enc_out_bbox_embed(output_memory) + output_proposals
             )  # (bs, \sum{hw}, 4) unsigmoid
             topk = self.num_queries
+            if not self.training:
+                topk = self._inference_topk(topk_logits, mask_flatten)
+            self.last_num_queries = topk
 
             topk_proposals = torch.topk(topk_logits, topk, dim=1)[1]  # bs, nq
 
@@ -320,7 +358,7 @@ class Transformer(nn.Module):
             )
             if self.embed_init_tgt:
                 tgt_ = (
-                    self.tgt_embed.weight[:, None, :].repeat(1, bs, 1).transpose(0, 1)
+                    self.tgt_embed.weight[:topk, None, :].repeat(1, bs, 1).transpose(0, 1)
                 )  # nq, bs, d_model
             else:
                 tgt_ = tgt_undetach.detach()
@@ -525,9 +563,21 @@ class TransformerEncoder(nn.Module):
 
         # preparation and reshape
         if self.num_layers > 0:
-            reference_points = self.get_reference_points(
-                spatial_shapes, valid_ratios, device=src.device
-            )
+            if self.training or not geometry_cache.enabled:
+                reference_points = self.get_reference_points(
+                    spatial_shapes, valid_ratios, device=src.device
+                )
+            else:
+                key = (
+                    tuple(spatial_shapes.view(-1).tolist()),
+                    tuple(valid_ratios.view(-1).tolist()),
+                    str(src.device),
+                )
+                reference_points = geometry_cache.get(
+                    "encoder_reference_points",
+                    key,
+                    lambda: self.get_reference_points(spatial_shapes, valid_ratios, device=src.device),
+                )
 
         if self.text_layers:
             # generate pos_text
@@ -540,10 +590,10 @@ class TransformerEncoder(nn.Module):
                     .unsqueeze(-1)
                     .repeat(bs, 1, 1)
                 )
-                pos_text = get_sine_pos_embed(pos_text, num_pos_feats=256, exchange_xy=False)
+                pos_text = get_sine_pos_embed(pos_text, num_pos_feats=self.d_model, exchange_xy=False)
             if position_ids is not None:
                 pos_text = get_sine_pos_embed(
-                    position_ids[..., None], num_pos_feats=256, exchange_xy=False
+                    position_ids[..., None], num_pos_feats=self.d_model, exchange_xy=False
                 )
 
         # main process
@@ -637,6 +687,45 @@ class TransformerDecoder(nn.Module):
 
         self.ref_anchor_head = None
 
+        # early exit at inference, see set_early_exit
+        self.exit_layer = None
+        self.exit_threshold = None
+        self.exit_topk = 100
+        self.exit_min_layers = 1
+        self.last_num_layers = num_layers
+
+    def set_early_exit(self, exit_layer=None, threshold=None, topk=100, min_layers=1):
+        """
+        Stop refining the queries early at inference (eval mode).
+            exit_layer: run at most exit_layer layers, None: all of them
+            threshold: stop once, between two layers, the boxes (normalized cxcywh) and
+                the scores (sigmoid of the max text logit) of the topk highest scoring
+                queries of every image change by less than threshold, None: never
+            min_layers: layers run before the adaptive exit is considered
+        The outputs only contain the layers that were run, last_num_layers is their number.
+        """
+        self.exit_layer = exit_layer
+        self.exit_threshold = threshold
+        self.exit_topk = topk
+        self.exit_min_layers = min_layers
+
+    def _query_scores(self, layer_id, output, memory_text, text_attention_mask):
+        # sigmoid of the max logit over the text tokens (objects and relations) per query
+        logits = self.class_embed[layer_id](
+            output.transpose(0, 1),
+            {"encoded_text": memory_text, "text_token_mask": ~text_attention_mask},
+        )
+        return logits.max(-1)[0].sigmoid()  # bs, nq
+
+    def _converged(self, scores, prev_scores, boxes, prev_boxes):
+        """Whether the topk queries of every image moved / changed less than the threshold."""
+        topk = min(self.exit_topk, scores.shape[1])
+        idx = scores.topk(topk, dim=1)[1]  # bs, k
+        score_delta = (scores.gather(1, idx) - prev_scores.gather(1, idx)).abs().max()
+        box_idx = idx.unsqueeze(-1).expand(-1, -1, boxes.shape[-1])
+        box_delta = (boxes.gather(1, box_idx) - prev_boxes.gather(1, box_idx)).abs().max()
+        return max(score_delta.item(), box_delta.item()) < self.exit_threshold
+
     def forward(
         self,
         tgt,
@@ -681,7 +770,20 @@ class TransformerDecoder(nn.Module):
         reference_points = refpoints_unsigmoid.sigmoid()
         ref_points = [reference_points]
 
-        for layer_id, layer in enumerate(self.layers):
+        num_layers = len(self.layers)
+        adaptive_exit = False
+        if not self.training:
+            if self.exit_layer is not None:
+                num_layers = max(1, min(num_layers, self.exit_layer))
+            adaptive_exit = (
+                self.exit_threshold is not None
+                and self.class_embed is not None
+                and self.bbox_embed is not None
+                and memory_text is not None
+            )
+        prev_scores = prev_boxes = None
+
+        for layer_id, layer in enumerate(self.layers[:num_layers]):
 
             if reference_points.shape[-1] == 4:
                 reference_points_input = (
@@ -692,8 +794,8 @@ class TransformerDecoder(nn.Module):
                 assert reference_points.shape[-1] == 2
                 reference_points_input = reference_points[:, :, None] * valid_ratios[None, :]
             query_sine_embed = gen_sineembed_for_position(
-                reference_points_input[:, :, 0, :]
-            )  # nq, bs, 256*2
+                reference_points_input[:, :, 0, :], self.d_model
+            )  # nq, bs, d_model*2
 
             # conditional query
             raw_query_pos = self.ref_point_head(query_sine_embed)  # nq, bs, 256
@@ -756,6 +858,20 @@ class TransformerDecoder(nn.Module):
             if tgt_rln is not None:
                 output_rln.append(hs_rln)
 
+            if adaptive_exit:
+                # boxes / scores of the queries (the denoising part is not used in eval)
+                scores = self._query_scores(layer_id, intermediate[-1], memory_text, text_attention_mask)
+                boxes = new_reference_points.transpose(0, 1)
+                if (
+                    prev_scores is not None
+                    and layer_id + 1 >= self.exit_min_layers
+                    and self._converged(scores, prev_scores, boxes, prev_boxes)
+                ):
+                    break
+                prev_scores, prev_boxes = scores, boxes
+
+        self.last_num_layers = len(intermediate)
+
         return [
             [itm_out.transpose(0, 1) for itm_out in intermediate],
             [itm_refpoint.transpose(0, 1) for itm_refpoint in ref_points],
@@ -1003,7 +1119,7 @@ class DeformableTransformerDecoderLayer(nn.Module):
 
 
 def build_transformer(args):
-    return Transformer(
+    transformer = Transformer(
         d_model=args.hidden_dim,
         dropout=args.dropout,
         nhead=args.nheads,
@@ -1031,5 +1147,19 @@ def build_transformer(args):
         text_dropout=args.text_dropout,
         fusion_dropout=args.fusion_dropout,
         fusion_droppath=args.fusion_droppath,
+        fusion_chunk_size=getattr(args, "fusion_chunk_size", 0),
         do_sgg=getattr(args, "do_sgg", False)
     )
+    # inference only, see Transformer.set_query_selection and TransformerDecoder.set_early_exit
+    transformer.set_query_selection(
+        num_queries=getattr(args, "infer_num_queries", None),
+        threshold=getattr(args, "infer_query_threshold", None),
+        min_queries=getattr(args, "infer_min_queries", 10),
+    )
+    transformer.decoder.set_early_exit(
+        exit_layer=getattr(args, "dec_exit_layer", None),
+        threshold=getattr(args, "dec_exit_threshold", None),
+        topk=getattr(args, "dec_exit_topk", 100),
+        min_layers=getattr(args, "dec_exit_min_layers", 1),
+    )
+    return transformer
@@ -12,12 +12,12 @@ import math
 import torch.nn.functional as F
 from torch import nn
 
-try:
-    import clip 
-except:
-    pass
+from groundingdino.util.geometry_cache import geometry_cache
 
 def get_clip(model='ViT-B/32', fp32=True):
+    # imported here: clip (and its torchvision / ftfy imports) is only used by get_clip
+    import clip
+
     device = "cuda" if torch.cuda.is_available() else "cpu"
     clip_model, clip_preprocess = clip.load(model, device=device)
 
@@ -72,19 +72,51 @@ def get_sine_pos_embed(
     pos_res = torch.cat(pos_res, dim=-1)
     return pos_res
 
-def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spatial_shapes:Tensor, learnedwh=None):
+def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spatial_shapes:Tensor, learnedwh=None,
+                                 use_cache=False):
     """
     Input:
         - memory: bs, \sum{hw}, d_model
         - memory_padding_mask: bs, \sum{hw}
         - spatial_shapes: nlevel, 2
         - learnedwh: 2
+        - use_cache: reuse the proposals of the same shapes / padding (groundingdino.util.geometry_cache)
     Output:
         - output_memory: bs, \sum{hw}, d_model
         - output_proposals: bs, \sum{hw}, 4
     """
-    N_, S_, C_ = memory.shape
-    base_scale = 4.0
+    if use_cache and learnedwh is None and geometry_cache.enabled:
+        shapes = spatial_shapes.tolist()
+        valid = []
+        _cur = 0
+        for H_, W_ in shapes:
+            mask_ = memory_padding_mask[:, _cur:(_cur + H_ * W_)].view(-1, H_, W_)
+            valid.extend([torch.sum(~mask_[:, :, 0], 1), torch.sum(~mask_[:, 0, :], 1)])
+            _cur += H_ * W_
+        key = (tuple(memory_padding_mask.shape), tuple(sum(shapes, [])),
+               tuple(torch.stack(valid, 1).view(-1).tolist()), str(memory.device))
+        output_proposals, output_proposals_valid = geometry_cache.get(
+            "encoder_output_proposals", key,
+            lambda: gen_encoder_proposals(memory_padding_mask, spatial_shapes))
+    else:
+        output_proposals, output_proposals_valid = gen_encoder_proposals(
+            memory_padding_mask, spatial_shapes, learnedwh)
+
+    output_memory = memory
+    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
+    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
+
+    return output_memory, output_proposals
+
+
+def gen_encoder_proposals(memory_padding_mask:Tensor, spatial_shapes:Tensor, learnedwh=None):
+    """
+    Output:
+        - output_proposals: bs, \sum{hw}, 4 (unsigmoided, inf at padded / invalid positions)
+        - output_proposals_valid: bs, \sum{hw}, 1
+    """
+    N_ = memory_padding_mask.shape[0]
+    device = memory_padding_mask.device
     proposals = []
     _cur = 0
     for lvl, (H_, W_) in enumerate(spatial_shapes):
@@ -92,8 +124,8 @@ def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spat
         valid_H = torch.sum(~mask_flatten_[:, :, 0, 0], 1)
         valid_W = torch.sum(~mask_flatten_[:, 0, :, 0], 1)
 
-        grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory.device),
-                                        torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory.device))
+        grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=device),
+                                        torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=device))
         grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1) # H_, W_, 2
 
         scale = torch.cat([valid_W.unsqueeze(-1), valid_H.unsqueeze(-1)], 1).view(N_, 1, 1, 2)
@@ -114,11 +146,7 @@ def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spat
     output_proposals = output_proposals.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
     output_proposals = output_proposals.masked_fill(~output_proposals_valid, float('inf'))
 
-    output_memory = memory
-    output_memory = output_memory.masked_fill(memory_padding_mask.unsqueeze(-1), float(0))
-    output_memory = output_memory.masked_fill(~output_proposals_valid, float(0))
-
-    return output_memory, output_proposals
+    return output_proposals, output_proposals_valid
 
 
 class RandomBoxPerturber():
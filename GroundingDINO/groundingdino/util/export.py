@@ -0,0 +1,280 @@
+"""
+TorchScript / ONNX export of the scene graph model with a frozen vocabulary.
+
+SceneGraphExportModel wraps a trained GroundingDINO (OvSGTR) model for a fixed set of
+object classes and predicates:
+    - the captions are tokenized and encoded by bert once, the text features
+      (before the image-text fusion of the encoder) are kept as buffers
+    - token -> class and token -> predicate maps replace the phrase decoding
+      of PostProcess / graph_infer (tokenizer.decode)
+    - all the candidate subject-object pairs of the top detections are scored,
+      so every output has a fixed shape and the graph can be traced
+
+Outputs for a batch of B padded images:
+    boxes            (B, K, 4)      xyxy in pixels of orig_sizes
+    labels           (B, K)         class index, 0 for __background__
+    scores           (B, K)
+    pair_index       (B, P, 2)      subject / object index into the K detections
+    relation_scores  (B, P, R)      predicate scores, column 0 is __background__
+    pair_scores      (B, P)         max relation score * subject score * object score,
+                                    pairs are sorted by it, 0 for background nodes
+with K = detections_per_img, P = K * (K - 1) and R = len(predicate_names).
+
+Export with:
+    python -m groundingdino.util.export -c config/GroundingDINO_SwinT_OGC_ovr.py \
+        --checkpoint vg-ovr-swint.pth --output ovsgtr.onnx
+"""
+import torch
+import torch.nn as nn
+
+from groundingdino.util import box_ops
+from groundingdino.util.misc import NestedTensor, inverse_sigmoid
+
+
+def build_caption(names):
+    """Caption of a vocabulary as built by the datasets, names[0] is __background__."""
+    return ". ".join(names[1:]) + "."
+
+
+def build_predicate_map(input_ids, tokenizer, name2predicates, num_predicates):
+    """
+    (num_predicates, num_tokens) map averaging the token scores of every predicate
+    phrase, the phrases are split at the [CLS] / [SEP] / "." tokens like graph_infer.
+    """
+    input_ids = input_ids.tolist()
+    sep_idx = [i for i in range(len(input_ids)) if input_ids[i] in [101, 102, 1012]]
+    predicate_map = torch.zeros((num_predicates, len(input_ids)))
+    for ii in range(1, len(sep_idx)):
+        right_idx = sep_idx[ii]
+        left_idx = sep_idx[ii - 1] + 1
+        if left_idx >= right_idx:
+            continue
+        row = name2predicates[tokenizer.decode(input_ids[left_idx:right_idx])]
+        predicate_map[row] = 0
+        predicate_map[row, left_idx:right_idx] = 1.0 / (right_idx - left_idx)
+    return predicate_map
+
+
+class SceneGraphExportModel(nn.Module):
+    """
+    Args:
+        model: GroundingDINO built with do_sgg=True, in eval mode
+        class_names: object classes, class_names[0] is __background__
+        predicate_names: predicates, predicate_names[0] is __background__
+        num_select: top-k (query, class) pairs as in PostProcess
+        detections_per_img: detections used to build the pairs (K)
+    """
+
+    def __init__(self, model, class_names, predicate_names, num_select=100, detections_per_img=100):
+        super().__init__()
+        # local import, the model package imports this util package
+        from groundingdino.models.GroundingDINO.groundingdino import PostProcess
+
+        assert model.do_sgg, "export requires a scene graph model (do_sgg=True)"
+        self.model = model.eval()
+        self.num_select = num_select
+        self.detections_per_img = min(detections_per_img, num_select)
+        self.use_rel_text = model.sgg_mode != "full"
+        self.rln_proj = model.rln_proj
+        self.rln_classifier = getattr(model, "rln_classifier", None)
+        self.rln_freq_bias = getattr(model, "rln_freq_bias", None)
+        # graph_infer switches to softmax when the frequency bias is used
+        self.use_sigmoid = self.rln_freq_bias is None
+
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            text_dict = model.encode_captions([build_caption(class_names)], device)
+            self.obj_len = text_dict["encoded_text"].shape[1]
+            if self.use_rel_text:
+                rel_text_dict = model.encode_captions([build_caption(predicate_names)], device,
+                                                      encode_relation=True)
+                rel_len = rel_text_dict["encoded_text"].shape[1]
+                name2predicates = {name: idx for idx, name in enumerate(predicate_names)}
+                self.register_buffer("predicate_map", build_predicate_map(
+                    rel_text_dict["input_ids"][0], model.tokenizer, name2predicates, len(predicate_names)))
+                for k in ("encoded_text", "text_token_mask", "position_ids"):
+                    text_dict[k] = torch.cat((text_dict[k], rel_text_dict[k]), 1)
+                total_len = self.obj_len + rel_len
+                attn_mask = torch.zeros((1, total_len, total_len), device=device, dtype=torch.bool)
+                attn_mask[:, :self.obj_len, :self.obj_len] = text_dict["text_self_attention_masks"]
+                attn_mask[:, self.obj_len:, self.obj_len:] = rel_text_dict["text_self_attention_masks"]
+                text_dict["text_self_attention_masks"] = attn_mask
+
+        self.register_buffer("encoded_text", text_dict["encoded_text"])
+        self.register_buffer("text_token_mask", text_dict["text_token_mask"])
+        self.register_buffer("position_ids", text_dict["position_ids"])
+        self.register_buffer("text_self_attention_masks", text_dict["text_self_attention_masks"])
+
+        postprocessor = PostProcess(
+            num_select=num_select, use_text_labels=True, tokenizer=model.tokenizer,
+            name2classes={name: idx for idx, name in enumerate(class_names) if name != "__background__"},
+            max_text_len=model.max_text_len,
+        )
+        self.register_buffer("label_map", postprocessor.get_positive_map(model.max_text_len).to(device))
+
+        # all ordered pairs in the order of graph_infer
+        pairs = torch.combinations(torch.arange(self.detections_per_img))
+        self.register_buffer("pair_index", torch.cat((pairs, pairs[:, [1, 0]]), 0).to(device))
+
+    def forward(self, images, masks, orig_sizes):
+        """
+        images: (B, 3, H, W) normalized and padded, masks: (B, H, W) True on padding,
+        orig_sizes: (B, 2) as (h, w) to scale the boxes to.
+        """
+        bs = images.shape[0]
+        text_dict = {
+            "encoded_text": self.encoded_text.expand(bs, -1, -1),
+            "text_token_mask": self.text_token_mask.expand(bs, -1),
+            "position_ids": self.position_ids.expand(bs, -1),
+            "text_self_attention_masks": self.text_self_attention_masks.expand(bs, -1, -1),
+        }
+        srcs, feat_masks, poss = self.model.encode_image(NestedTensor(images, masks))
+        hs, hs_rln, reference, _, _, _ = self.model.transformer(
+            srcs, feat_masks, None, poss, None, None, text_dict)
+
+        # the encoder updates encoded_text with the image features
+        encoded_text = text_dict["encoded_text"]
+        obj_text_dict = {
+            "encoded_text": encoded_text[:, :self.obj_len],
+            "text_token_mask": text_dict["text_token_mask"][:, :self.obj_len],
+        }
+        lid = len(hs) - 1
+        out_bbox = (self.model.bbox_embed[lid](hs[lid]) + inverse_sigmoid(reference[lid])).sigmoid()
+        out_logits = self.model.class_embed[lid](hs[lid], obj_text_dict)
+
+        # PostProcess with use_text_labels=True
+        prob = out_logits.sigmoid() @ self.label_map.T
+        num_cat = prob.shape[2]
+        scores, topk_indexes = torch.topk(prob.view(bs, -1), self.num_select, dim=1)
+        topk_boxes = topk_indexes // num_cat
+        labels = topk_indexes % num_cat
+        boxes = torch.gather(out_bbox, 1, topk_boxes.unsqueeze(-1).repeat(1, 1, 4))
+        obj_token = torch.gather(hs[lid], 1, topk_boxes.unsqueeze(-1).repeat(1, 1, hs[lid].shape[-1]))
+
+        k = self.detections_per_img
+        scores, labels, boxes, obj_token = scores[:, :k], labels[:, :k], boxes[:, :k], obj_token[:, :k]
+        img_h, img_w = orig_sizes.unbind(1)
+        scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
+        boxes = box_ops.box_cxcywh_to_xyxy(boxes) * scale_fct[:, None, :]
+
+        # graph_infer on all the pairs
+        sub, obj = self.pair_index[:, 0], self.pair_index[:, 1]
+        num_pairs = self.pair_index.shape[0]
+        rln_token = hs_rln[-1].flatten(1)
+        relation_feat = torch.cat((
+            obj_token[:, sub], obj_token[:, obj],
+            rln_token[:, None, :].expand(bs, num_pairs, rln_token.shape[-1])), dim=2)
+        relation_feat = self.rln_proj(relation_feat)
+
+        if self.use_rel_text:
+            rel_text = encoded_text[:, self.obj_len:]
+            relation_logits = torch.einsum("bpd,btd->bpt", relation_feat, rel_text)
+        else:
+            relation_logits = self.rln_classifier(relation_feat)
+            if self.rln_freq_bias is not None:
+                pair_labels = torch.stack((labels[:, sub], labels[:, obj]), 2).view(-1, 2)
+                relation_logits = relation_logits + self.rln_freq_bias(pair_labels).view(
+                    bs, num_pairs, -1)
+
+        if self.use_sigmoid:
+            relation_prob = relation_logits.sigmoid()
+        else:
+            relation_prob = relation_logits.softmax(-1)
+        if self.use_rel_text:
+            relation_scores = relation_prob @ self.predicate_map.T
+        else:
+            relation_scores = relation_prob
+
+        pair_scores = relation_scores[:, :, 1:].max(-1)[0] * scores[:, sub] * scores[:, obj]
+        # graph_infer drops the detections labeled as background
+        valid = (labels[:, sub] != 0) & (labels[:, obj] != 0)
+        pair_scores = pair_scores * valid.to(pair_scores.dtype)
+
+        pair_scores, order = pair_scores.sort(dim=1, descending=True)
+        pair_index = self.pair_index[order]
+        relation_scores = torch.gather(
+            relation_scores, 1, order.unsqueeze(-1).repeat(1, 1, relation_scores.shape[-1]))
+
+        return boxes, labels, scores, pair_index, relation_scores, pair_scores
+
+
+OUTPUT_NAMES = ["boxes", "labels", "scores", "pair_index", "relation_scores", "pair_scores"]
+
+
+def example_inputs(batch_size=1, height=800, width=1333, device="cpu"):
+    images = torch.zeros((batch_size, 3, height, width), device=device)
+    masks = torch.zeros((batch_size, height, width), dtype=torch.bool, device=device)
+    orig_sizes = torch.tensor([[height, width]] * batch_size, dtype=torch.float, device=device)
+    return images, masks, orig_sizes
+
+
+def export_torchscript(export_model, path, inputs):
+    with torch.no_grad():
+        traced = torch.jit.trace(export_model, inputs, check_trace=False)
+    traced.save(path)
+    return traced
+
+
+def export_onnx(export_model, path, inputs, opset_version=16):
+    """
+    The pytorch deformable attention (grid_sample) needs opset >= 16,
+    i.e. torch >= 1.12 for the export. The input shape is fixed.
+    """
+    with torch.no_grad():
+        torch.onnx.export(
+            export_model, inputs, path,
+            input_names=["images", "masks", "orig_sizes"],
+            output_names=OUTPUT_NAMES,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from groundingdino.models import build_model
+    from groundingdino.util.misc import clean_state_dict
+    from groundingdino.util.mmap_checkpoint import load_checkpoint
+    from groundingdino.util.slconfig import SLConfig
+
+    parser = argparse.ArgumentParser("Export the scene graph model with a frozen vocabulary")
+    parser.add_argument("--config_file", "-c", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True, help="*.onnx or *.pt (TorchScript)")
+    parser.add_argument("--vocab", type=str, default=None,
+                        help="json with 'classes' and 'predicates' lists (index 0: __background__), "
+                             "defaults to VG150")
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--width", type=int, default=1333)
+    parser.add_argument("--num_select", type=int, default=100)
+    parser.add_argument("--detections_per_img", type=int, default=100)
+    parser.add_argument("--opset", type=int, default=16)
+    opts = parser.parse_args()
+
+    args = SLConfig.fromfile(opts.config_file)
+    args.device = "cpu"
+    model, _ = build_model(args)
+    checkpoint = load_checkpoint(opts.checkpoint, map_location="cpu", sections=("model",))
+    model.load_state_dict(clean_state_dict(checkpoint["model"]), strict=False)
+    model.eval()
+
+    if opts.vocab is not None:
+        with open(opts.vocab, "r") as f:
+            vocab = json.load(f)
+        class_names, predicate_names = vocab["classes"], vocab["predicates"]
+    else:
+        from datasets.vg import VG150_OBJ_CATEGORIES, VG150_PREDICATES
+
+        class_names, predicate_names = VG150_OBJ_CATEGORIES, VG150_PREDICATES
+
+    export_model = SceneGraphExportModel(model, class_names, predicate_names,
+                                         num_select=opts.num_select,
+                                         detections_per_img=opts.detections_per_img)
+    inputs = example_inputs(1, opts.height, opts.width)
+    if opts.output.endswith(".onnx"):
+        export_onnx(export_model, opts.output, inputs, opset_version=opts.opset)
+    else:
+        export_torchscript(export_model, opts.output, inputs)
+    print("exported to %s" % opts.output)
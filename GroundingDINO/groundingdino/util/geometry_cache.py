@@ -0,0 +1,118 @@
+"""
+LRU cache of the shape dependent tensors rebuilt on every forward pass: the Swin
+shifted window attention masks, the sine position embeddings, the encoder reference
+points and the encoder output proposals.
+
+Entries are keyed by the module name, the input shapes, the padding signature (valid
+height / width of every image, i.e. the valid ratios) and the device, and bounded by
+the number of entries and the total size of the cached tensors. Cached tensors are
+shared between calls and must not be modified in place.
+
+The keys do not include a dtype: every cached builder returns float32 (the Swin
+masks the default dtype) whatever the dtype of its inputs. A builder whose output
+follows the input dtype must add it to its key.
+
+    from groundingdino.util.geometry_cache import geometry_cache
+    geometry_cache.stats()  # {"swin_attn_mask": {"hits": .., "misses": .., "hit_rate": ..}, ...}
+"""
+import threading
+from collections import OrderedDict, defaultdict
+
+import torch
+
+
+def _nbytes(value):
+    if torch.is_tensor(value):
+        return value.nelement() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class GeometryCache(object):
+    """
+    Args:
+        max_entries: number of cached entries, 0 disables the cache
+        max_bytes: total size of the cached tensors
+    """
+
+    def __init__(self, max_entries=64, max_bytes=256 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    @property
+    def enabled(self):
+        # traced graphs (TorchScript / ONNX export) must not bake in cached tensors
+        return self.max_entries > 0 and not torch.jit.is_tracing()
+
+    def configure(self, max_entries=None, max_bytes=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        with self._lock:
+            self._evict()
+
+    def get(self, name, key, build_fn):
+        """Cached build_fn() for (name, key), build_fn is called on a miss."""
+        if not self.enabled:
+            return build_fn()
+        key = (name,) + tuple(key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits[name] += 1
+                return self._entries[key]
+
+        value = build_fn()
+        nbytes = _nbytes(value)
+        with self._lock:
+            self.misses[name] += 1
+            if nbytes <= self.max_bytes and key not in self._entries:
+                self._entries[key] = value
+                self._nbytes += nbytes
+                self._evict()
+        return value
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._nbytes > self.max_bytes):
+            _, value = self._entries.popitem(last=False)
+            self._nbytes -= _nbytes(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self):
+        with self._lock:
+            names = sorted(set(self.hits) | set(self.misses))
+            stats = {}
+            for name in names:
+                total = self.hits[name] + self.misses[name]
+                stats[name] = {
+                    "hits": self.hits[name],
+                    "misses": self.misses[name],
+                    "hit_rate": self.hits[name] / total if total > 0 else 0.0,
+                }
+            stats["cached_entries"] = len(self._entries)
+            stats["cached_mb"] = self._nbytes / 2 ** 20
+        return stats
+
+
+def padding_signature(mask):
+    """Valid (height, width) of every image of a padding mask [bs, h, w] (True: padding),
+    padding is assumed at the bottom / right as in NestedTensor."""
+    valid_H = torch.sum(~mask[:, :, 0], 1)
+    valid_W = torch.sum(~mask[:, 0, :], 1)
+    return tuple(mask.shape) + tuple(torch.stack([valid_H, valid_W], 1).view(-1).tolist())
+
+
+geometry_cache = GeometryCache()
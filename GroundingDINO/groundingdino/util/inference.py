@@ -1,4 +1,5 @@
-from typing import Tuple, List
+from functools import lru_cache
+from typing import Tuple, List, Optional, Sequence, Union
 
 import bisect
 import cv2
@@ -10,7 +11,9 @@ from torchvision.ops import box_convert
 
 import groundingdino.datasets.transforms as T
 from groundingdino.models import build_model
-from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.misc import clean_state_dict, nested_tensor_from_tensor_list
+from groundingdino.util.mmap_checkpoint import load_checkpoint
+from groundingdino.util.quantization import quantize_dynamic_model
 from groundingdino.util.slconfig import SLConfig
 from groundingdino.util.utils import get_phrases_from_posmap
 
@@ -26,13 +29,17 @@ def preprocess_caption(caption: str) -> str:
     return result + "."
 
 
-def load_model(model_config_path: str, model_checkpoint_path: str, device: str = "cuda"):
+def load_model(model_config_path: str, model_checkpoint_path: str, device: str = "cuda", quantize: bool = False):
+    """quantize=True applies int8 dynamic quantization, the model then runs on cpu only."""
     args = SLConfig.fromfile(model_config_path)
     args.device = device
     model, _ = build_model(args)
-    checkpoint = torch.load(model_checkpoint_path, map_location="cpu")
+    checkpoint = load_checkpoint(model_checkpoint_path, map_location="cpu", sections=("model",))
     model.load_state_dict(clean_state_dict(checkpoint["model"]), strict=False)
     model.eval()
+    if quantize:
+        assert device == "cpu", "dynamic quantization is only supported on cpu"
+        model = quantize_dynamic_model(model)
     return model
 
 
@@ -89,6 +96,104 @@ def predict(
     return boxes, logits.max(dim=1)[0], phrases
 
 
+def _transform_image(image: Union[str, np.ndarray, torch.Tensor]) -> torch.Tensor:
+    """Path or RGB array -> normalized tensor, tensors are assumed to be transformed already."""
+    if isinstance(image, torch.Tensor):
+        return image
+    if isinstance(image, str):
+        return load_image(image)[1]
+    transform = T.Compose(
+        [
+            T.RandomResize([800], max_size=1333),
+            T.ToTensor(),
+            T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        ]
+    )
+    image_transformed, _ = transform(Image.fromarray(image), None)
+    return image_transformed
+
+
+@lru_cache(maxsize=256)
+def _phrase_segments(input_ids: Tuple[int, ...]) -> np.ndarray:
+    """Positions of the [CLS] / [SEP] / "." tokens that delimit the phrases of a caption."""
+    return np.array([i for i, t in enumerate(input_ids) if t in [101, 102, 1012]], dtype=np.int64)
+
+
+@lru_cache(maxsize=4096)
+def _decode_phrase(tokenizer, token_ids: Tuple[int, ...]) -> str:
+    return tokenizer.decode(list(token_ids))
+
+
+def phrases_from_logits(logits: torch.Tensor, input_ids: Sequence[int], tokenizer, text_threshold: float) -> List[str]:
+    """
+    Same phrases as predict: the tokens above text_threshold inside the phrase that
+    contains the argmax token of each box. The phrase boundaries are looked up for all
+    boxes at once and the decoded strings are cached by token ids.
+    """
+    if len(logits) == 0:
+        return []
+    input_ids = tuple(int(t) for t in input_ids)
+    sep_idx = _phrase_segments(input_ids)
+    logits = logits.cpu()
+
+    insert_idx = np.searchsorted(sep_idx, logits.argmax(dim=1).numpy(), side="left")
+    left_idx = torch.as_tensor(sep_idx[insert_idx - 1])
+    right_idx = torch.as_tensor(sep_idx[insert_idx])
+    positions = torch.arange(logits.shape[1])
+    posmap = (logits > text_threshold) & (positions[None] > left_idx[:, None]) & (positions[None] < right_idx[:, None])
+
+    phrases = []
+    for row in posmap:
+        token_ids = tuple(input_ids[i] for i in row.nonzero(as_tuple=True)[0].tolist())
+        phrases.append(_decode_phrase(tokenizer, token_ids))
+    return phrases
+
+
+def predict_batch(
+        model,
+        images: Sequence[Union[str, np.ndarray, torch.Tensor]],
+        captions: Union[str, Sequence[str]],
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda",
+        rel_captions: Optional[Union[str, Sequence[str]]] = None
+) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """
+    Batched predict: images are paths, RGB arrays or transformed tensors, captions is
+    one caption shared by all images or one caption per image. The images are padded
+    into one batch and run in a single forward pass.
+    Returns a (boxes, logits, phrases) tuple per image, as predict.
+    """
+    if isinstance(captions, str):
+        captions = [captions] * len(images)
+    assert len(captions) == len(images), "one caption per image or a shared caption"
+    captions = [preprocess_caption(caption=c) for c in captions]
+    kw = {"captions": captions}
+    if rel_captions is not None:
+        kw["rel_captions"] = [rel_captions] * len(images) if isinstance(rel_captions, str) else list(rel_captions)
+
+    # move the model only when needed, .to() walks all the parameters
+    if next(model.parameters()).device.type != torch.device(device).type:
+        model = model.to(device)
+    samples = nested_tensor_from_tensor_list([_transform_image(image) for image in images]).to(device)
+
+    with torch.no_grad():
+        outputs = model(samples, **kw)
+
+    prediction_logits = outputs["pred_logits"].sigmoid()  # (bs, nq, 256)
+    prediction_boxes = outputs["pred_boxes"]  # (bs, nq, 4)
+    keep = prediction_logits.max(dim=2)[0] > box_threshold
+    input_ids = outputs["input_ids"].cpu()
+
+    results = []
+    for bid in range(len(images)):
+        logits = prediction_logits[bid][keep[bid]].cpu()
+        boxes = prediction_boxes[bid][keep[bid]].cpu()
+        phrases = phrases_from_logits(logits, input_ids[bid].tolist(), model.tokenizer, text_threshold)
+        results.append((boxes, logits.max(dim=1)[0], phrases))
+    return results
+
+
 def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor, phrases: List[str]) -> np.ndarray:
     h, w, _ = image_source.shape
     boxes = boxes * torch.Tensor([w, h, w, h])
@@ -118,12 +223,14 @@ class Model:
         self,
         model_config_path: str,
         model_checkpoint_path: str,
-        device: str = "cuda"
+        device: str = "cuda",
+        quantize: bool = False
     ):
         self.model = load_model(
             model_config_path=model_config_path,
             model_checkpoint_path=model_checkpoint_path,
-            device=device
+            device=device,
+            quantize=quantize
         ).to(device)
         self.device = device
 
@@ -213,6 +320,49 @@ class Model:
         detections.class_id = class_id
         return detections
 
+    def predict_batch_with_caption(
+        self,
+        images: List[np.ndarray],
+        caption: Union[str, List[str]],
+        box_threshold: float = 0.35,
+        text_threshold: float = 0.25
+    ) -> List[Tuple[sv.Detections, List[str]]]:
+        """predict_with_caption for a list of BGR images in one forward pass."""
+        processed_images = [Model.preprocess_image(image_bgr=image) for image in images]
+        results = predict_batch(
+            model=self.model,
+            images=processed_images,
+            captions=caption,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold,
+            device=self.device)
+        outputs = []
+        for image, (boxes, logits, phrases) in zip(images, results):
+            source_h, source_w, _ = image.shape
+            detections = Model.post_process_result(
+                source_h=source_h,
+                source_w=source_w,
+                boxes=boxes,
+                logits=logits)
+            outputs.append((detections, phrases))
+        return outputs
+
+    def predict_batch_with_classes(
+        self,
+        images: List[np.ndarray],
+        classes: List[str],
+        box_threshold: float,
+        text_threshold: float
+    ) -> List[sv.Detections]:
+        """predict_with_classes for a list of BGR images in one forward pass."""
+        caption = ". ".join(classes)
+        outputs = []
+        for detections, phrases in self.predict_batch_with_caption(
+                images, caption, box_threshold=box_threshold, text_threshold=text_threshold):
+            detections.class_id = Model.phrases2classes(phrases=phrases, classes=classes)
+            outputs.append(detections)
+        return outputs
+
     @staticmethod
     def preprocess_image(image_bgr: np.ndarray) -> torch.Tensor:
         transform = T.Compose(
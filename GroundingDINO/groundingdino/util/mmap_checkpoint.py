@@ -0,0 +1,213 @@
+"""
+Memory-mapped checkpoint format.
+
+A checkpoint is a directory
+    manifest.json     dtype / shape / byte offset of every tensor of every section
+    model.bin         raw tensor data of checkpoint["model"]
+    ema_model.bin     raw tensor data of checkpoint["ema_model"]       (if present)
+    optimizer.bin     raw tensor data of checkpoint["optimizer"]["state"] (if present)
+    extra.pth         everything else (epoch, args, lr_scheduler, optimizer param_groups)
+
+Tensors are returned as views of copy-on-write memmaps, so loading does not read
+the file: pages are brought in when load_state_dict copies them, only the sections
+that are asked for are mapped, and the page cache is shared by all processes
+loading the same checkpoint on a host.
+
+Convert a torch.save checkpoint with:
+    python -m groundingdino.util.mmap_checkpoint checkpoint.pth checkpoint_mmap
+"""
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+MANIFEST = "manifest.json"
+EXTRA = "extra.pth"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+TENSOR_SECTIONS = ("model", "ema_model", "optimizer")
+
+_NP_DTYPES = {
+    torch.float64: np.float64,
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.int16: np.int16,
+    torch.int8: np.int8,
+    torch.uint8: np.uint8,
+    torch.bool: np.bool_,
+}
+# numpy has no bfloat16, the raw bits are stored as int16
+_VIEW_DTYPES = {torch.bfloat16: torch.int16}
+_TORCH_DTYPES = {str(k).replace("torch.", ""): k for k in list(_NP_DTYPES) + list(_VIEW_DTYPES)}
+
+
+def is_mmap_checkpoint(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST))
+
+
+def _split_optimizer(state_dict):
+    """Move the tensors of optimizer.state_dict()["state"] into a flat dict."""
+    tensors = OrderedDict()
+    state = {}
+    for pid, param_state in state_dict["state"].items():
+        state[pid] = {}
+        for key, value in param_state.items():
+            if torch.is_tensor(value):
+                tensors["%s/%s" % (pid, key)] = value
+            else:
+                state[pid][key] = value
+    skeleton = dict(state_dict)
+    skeleton["state"] = state
+    return tensors, skeleton
+
+
+def _merge_optimizer(tensors, skeleton):
+    state_dict = dict(skeleton)
+    state = {pid: dict(param_state) for pid, param_state in skeleton["state"].items()}
+    pids = {str(pid): pid for pid in state}
+    for name, tensor in tensors.items():
+        pid, key = name.rsplit("/", 1)
+        state[pids[pid]][key] = tensor
+    state_dict["state"] = state
+    return state_dict
+
+
+def _write_tensors(tensors, filename):
+    index = OrderedDict()
+    offset = 0
+    with open(filename, "wb") as f:
+        for name, tensor in tensors.items():
+            tensor = tensor.detach().cpu().contiguous()
+            dtype = tensor.dtype
+            if dtype in _VIEW_DTYPES:
+                tensor = tensor.view(_VIEW_DTYPES[dtype])
+            assert tensor.dtype in _NP_DTYPES, "unsupported dtype %s of %s" % (dtype, name)
+            array = tensor.numpy()
+
+            pad = -offset % ALIGNMENT
+            f.write(b"\0" * pad)
+            offset += pad
+            array.tofile(f)
+            index[name] = {
+                "dtype": str(dtype).replace("torch.", ""),
+                "shape": list(tensor.shape),
+                "offset": offset,
+                "nbytes": array.nbytes,
+            }
+            offset += array.nbytes
+    return index
+
+
+def save_mmap_checkpoint(checkpoint, path):
+    """
+    Write checkpoint (the dict given to torch.save) as a memory-mapped checkpoint
+    directory at path. An existing checkpoint at path is replaced only once the
+    new one is complete.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    manifest = {"version": FORMAT_VERSION, "sections": OrderedDict(), "extra": EXTRA}
+    extra = OrderedDict()
+    for key, value in checkpoint.items():
+        if key not in TENSOR_SECTIONS:
+            extra[key] = value
+            continue
+        if key == "optimizer":
+            value, extra[key] = _split_optimizer(value)
+        filename = key + ".bin"
+        manifest["sections"][key] = {
+            "file": filename,
+            "tensors": _write_tensors(value, os.path.join(tmp_path, filename)),
+        }
+
+    torch.save(extra, os.path.join(tmp_path, EXTRA))
+    with open(os.path.join(tmp_path, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+
+    old_path = None
+    if os.path.exists(path):
+        old_path = path + ".old"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path)
+
+
+def _map_tensors(filename, index):
+    tensors = OrderedDict()
+    if os.path.getsize(filename) == 0:
+        buffer = np.zeros(0, dtype=np.uint8)
+    else:
+        # copy-on-write: writable views without touching the file
+        buffer = np.memmap(filename, dtype=np.uint8, mode="c")
+    for name, info in index.items():
+        dtype = _TORCH_DTYPES[info["dtype"]]
+        storage_dtype = _VIEW_DTYPES.get(dtype, dtype)
+        start = info["offset"]
+        array = buffer[start: start + info["nbytes"]].view(_NP_DTYPES[storage_dtype])
+        tensor = torch.from_numpy(array.reshape(info["shape"]))
+        if storage_dtype is not dtype:
+            tensor = tensor.view(dtype)
+        tensors[name] = tensor
+    return tensors
+
+
+def load_mmap_checkpoint(path, sections=None):
+    """
+    Load a memory-mapped checkpoint directory into a dict laid out like the
+    torch.save checkpoint. sections limits the tensor sections that are mapped,
+    e.g. ("model", ) for evaluation; the small extra entries are always loaded.
+    """
+    with open(os.path.join(path, MANIFEST), "r") as f:
+        manifest = json.load(f)
+    assert manifest["version"] == FORMAT_VERSION, "unknown checkpoint version %s" % manifest["version"]
+
+    checkpoint = torch.load(os.path.join(path, manifest["extra"]), map_location="cpu")
+    for key, section in manifest["sections"].items():
+        if sections is not None and key not in sections:
+            checkpoint.pop(key, None)
+            continue
+        tensors = _map_tensors(os.path.join(path, section["file"]), section["tensors"])
+        if key == "optimizer":
+            tensors = _merge_optimizer(tensors, checkpoint[key])
+        checkpoint[key] = tensors
+    return checkpoint
+
+
+def load_checkpoint(path, map_location="cpu", sections=None):
+    """Load a checkpoint saved either with torch.save or with save_mmap_checkpoint."""
+    if is_mmap_checkpoint(path):
+        return load_mmap_checkpoint(path, sections=sections)
+    return torch.load(path, map_location=map_location)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser("Convert a torch.save checkpoint into a memory-mapped checkpoint")
+    parser.add_argument("checkpoint", type=str)
+    parser.add_argument("output", type=str)
+    parser.add_argument(
+        "--sections", type=str, nargs="+", default=None,
+        help="tensor sections to keep, e.g. model for an inference-only checkpoint"
+    )
+    opts = parser.parse_args()
+
+    ckpt = torch.load(opts.checkpoint, map_location="cpu")
+    if opts.sections is not None:
+        for k in TENSOR_SECTIONS:
+            if k not in opts.sections:
+                ckpt.pop(k, None)
+    save_mmap_checkpoint(ckpt, opts.output)
+    print("saved %s" % opts.output)
@@ -0,0 +1,58 @@
+"""
+Dynamic int8 quantization of the GroundingDINO / OvSGTR model for cpu inference.
+
+The nn.Linear layers of the text encoder (bert), the text projections (feat_map,
+rln_text_proj), the transformer FFNs (linear1 / linear2), the relation projection
+(rln_proj, rln_classifier) and the box MLP heads are replaced with dynamically
+quantized int8 layers: weights are stored in int8, activations are quantized
+on the fly per batch. The backbone, the deformable attention sampling and the
+text-image fusion layers stay in float.
+"""
+import io
+
+import torch
+import torch.nn as nn
+
+# prefixes of the quantized modules, the FFN layers are matched by name suffix
+QUANT_PREFIXES = (
+    "bert.",
+    "feat_map",
+    "rln_text_proj",
+    "rln_proj.",
+    "rln_classifier",
+    "bbox_embed.",
+    "transformer.decoder.bbox_embed.",
+    "transformer.enc_out_bbox_embed.",
+)
+QUANT_SUFFIXES = (".linear1", ".linear2")
+
+
+def dynamic_quant_module_names(model, prefixes=QUANT_PREFIXES, suffixes=QUANT_SUFFIXES):
+    """Names of the nn.Linear modules of model to quantize."""
+    names = set()
+    # named_modules() lists a shared module (e.g. bbox_embed) once, under the name
+    # that torch.quantization visits first
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Linear):
+            continue
+        if name.startswith(prefixes) or (name.startswith("transformer.") and name.endswith(suffixes)):
+            names.add(name)
+    return names
+
+
+def quantize_dynamic_model(model, prefixes=QUANT_PREFIXES, suffixes=QUANT_SUFFIXES, inplace=True):
+    """
+    Apply int8 dynamic quantization to the linear layers selected by
+    dynamic_quant_module_names. The model is moved to cpu and set to eval mode,
+    dynamically quantized layers only run on cpu.
+    """
+    model = model.cpu().eval()
+    names = dynamic_quant_module_names(model, prefixes, suffixes)
+    return torch.quantization.quantize_dynamic(model, qconfig_spec=names, dtype=torch.qint8, inplace=inplace)
+
+
+def state_dict_nbytes(model):
+    """Bytes of the serialized state dict, int8 packed weights included."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
@@ -0,0 +1,145 @@
+"""
+Opt-in latency / memory instrumentation of the hot path stages of a training or
+evaluation step (backbone, text encoding, encoder, decoder, matcher, loss terms,
+postprocess, graph_infer, evaluator update, ...).
+
+Stages are timed with forward hooks on modules (hook()) or explicitly with the
+timer as a context manager; both cost a single attribute check while disabled.
+On cuda, stages record cuda events (no synchronization inside the step) and the
+peak allocated memory of every stage; the events are resolved by flush(), once per
+step, which returns the time (ms) and peak memory (MB) of every stage in the step:
+
+    from groundingdino.util.stage_timer import stage_timer
+    stage_timer.configure(enabled=True)
+    handles = stage_timer.hook(model.backbone, "backbone")
+    with stage_timer("graph_infer"):
+        ...
+    stage_timer.flush()  # {"time_backbone": .., "mem_backbone": .., "time_graph_infer": .., ...}
+
+Stages may be nested and may run several times in a step (e.g. the matcher of
+every decoder layer), their times are summed. The peak memory statistics of torch
+are reset at the start of every stage, so torch.cuda.max_memory_allocated() only
+covers the last stage while enabled.
+"""
+import contextlib
+import time
+from collections import OrderedDict
+
+import torch
+
+MB = 2.0 ** 20
+
+
+class _Stage(object):
+    __slots__ = ("name", "start", "mem_start", "peak")
+
+    def __init__(self, name, start, mem_start):
+        self.name = name
+        self.start = start
+        self.mem_start = mem_start
+        self.peak = mem_start
+
+
+class StageTimer(object):
+    """
+    Args:
+        enabled: record stages
+        device: cuda device to record events and memory on, None: wall clock only
+    """
+
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.device = None
+        self._stack = []
+        self._records = []
+        self._null = contextlib.nullcontext()
+        self.configure(enabled, device)
+
+    def configure(self, enabled=None, device=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if device is not None:
+            device = torch.device(device)
+            self.device = device if device.type == "cuda" and torch.cuda.is_available() else None
+        self.reset()
+
+    def reset(self):
+        self._stack = []
+        self._records = []
+
+    @property
+    def cuda(self):
+        return self.device is not None
+
+    def _now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self, name):
+        if not self.enabled or torch.jit.is_tracing():
+            return
+        mem = 0
+        if self.cuda:
+            mem = torch.cuda.memory_allocated(self.device)
+            if self._stack:
+                parent = self._stack[-1]
+                parent.peak = max(parent.peak, torch.cuda.max_memory_allocated(self.device))
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._stack.append(_Stage(name, self._now(), mem))
+
+    def stop(self, name):
+        if not self.enabled or not self._stack or self._stack[-1].name != name:
+            return
+        stage = self._stack.pop()
+        end = self._now()
+        peak = 0
+        if self.cuda:
+            peak = max(stage.peak, torch.cuda.max_memory_allocated(self.device))
+            if self._stack:
+                self._stack[-1].peak = max(self._stack[-1].peak, peak)
+        self._records.append((name, stage.start, end, peak))
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def __call__(self, name):
+        """Context manager timing a stage."""
+        if not self.enabled:
+            return self._null
+        return self._timed(name)
+
+    def hook(self, module, name):
+        """Times every forward of module as stage name, returns the hook handles."""
+        return [
+            module.register_forward_pre_hook(lambda m, inputs: self.start(name)),
+            module.register_forward_hook(lambda m, inputs, outputs: self.stop(name)),
+        ]
+
+    def flush(self):
+        """Time (ms) and peak memory (MB, cuda only) of the stages recorded since the
+        last flush, summed / maximized over the calls of a stage."""
+        records, self._records = self._records, []
+        # stages left open (an exception in a hooked forward) are dropped
+        self._stack = []
+        if not records:
+            return {}
+        if self.cuda:
+            records[-1][2].synchronize()
+        stats = OrderedDict()
+        for name, start, end, peak in records:
+            ms = start.elapsed_time(end) if self.cuda else 1000 * (end - start)
+            stats["time_" + name] = stats.get("time_" + name, 0.0) + ms
+            if self.cuda:
+                stats["mem_" + name] = max(stats.get("mem_" + name, 0.0), peak / MB)
+        return stats
+
+
+stage_timer = StageTimer()
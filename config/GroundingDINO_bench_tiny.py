@@ -0,0 +1,116 @@
+# tiny cpu sized model for the synthetic benchmarks (tools/benchmark.py), not for training
+modelname = "groundingdino"
+backbone = "swin_T_224_1k"
+# small swin, the benchmark runs on cpu
+swin_kwargs = dict(embed_dim=32, depths=[1, 1, 2, 1], num_heads=[1, 2, 4, 8], window_size=7)
+position_embedding = "sine"
+pe_temperatureH = 20
+pe_temperatureW = 20
+return_interm_indices = [1, 2, 3]
+backbone_freeze_keywords = None
+enc_layers = 1
+dec_layers = 2
+pre_norm = False
+dim_feedforward = 256
+hidden_dim = 64
+dropout = 0.0
+nheads = 4
+num_queries = 100
+query_dim = 4
+num_patterns = 0
+num_feature_levels = 4
+enc_n_points = 4
+dec_n_points = 4
+two_stage_type = "standard"
+two_stage_bbox_embed_share = False
+two_stage_class_embed_share = False
+transformer_activation = "relu"
+dec_pred_bbox_embed_share = True
+dn_box_noise_scale = 1.0
+dn_label_noise_ratio = 0.5
+dn_label_coef = 1.0
+dn_bbox_coef = 1.0
+embed_init_tgt = True
+dn_labelbook_size = 2000
+# the val caption of all 150 VG names is ~300 tokens with the word level vocab of
+# tools/benchmark.py, the matcher needs every name of the caption
+max_text_len = 512
+# tools/benchmark.py generates a small random bert and sets its path
+text_encoder_type = "bert-base-uncased"
+use_text_enhancer = True
+use_fusion_layer = True
+use_checkpoint = False
+use_transformer_ckpt = False
+use_text_cross_attention = True
+text_dropout = 0.0
+fusion_dropout = 0.0
+fusion_droppath = 0.1
+sub_sentence_present = True
+
+
+# train
+frozen_weights = None 
+frozen_backbone = True 
+
+lr =  1e-5 #0.0001
+lr_rln_mult = 10
+param_dict_type = 'default'
+lr_backbone = 1e-05
+lr_text_backbone = 1e-05
+lr_backbone_names = ['backbone.0']
+lr_linear_proj_names = ['reference_points', 'sampling_offsets']
+lr_linear_proj_mult = 0.1
+ddetr_lr_param = False
+batch_size = 2
+weight_decay = 0.0001
+epochs = 6
+lr_drop = 5
+save_checkpoint_interval = 1
+clip_max_norm = 0.1
+onecyclelr = False
+multi_step_lr = False
+lr_drop_list = [20, 23] #[33, 45]
+
+aux_loss = True
+set_cost_class = 1.0
+set_cost_bbox = 5.0
+set_cost_giou = 2.0
+
+cls_loss_coef = 2.0
+mask_loss_coef = 1.0
+dice_loss_coef = 1.0
+bbox_loss_coef = 5.0
+giou_loss_coef = 2.0
+interm_loss_coef = 1.0
+no_interm_box_loss = False
+focal_alpha = 0.25
+
+# for dn
+use_dn = False
+dn_number  = 100
+masks = False
+use_text_labels = True 
+
+
+# for SGG
+vg_roidb_key = 'split'
+num_select = 50
+nms_iou_threshold = 0.5
+
+do_sgg = True 
+num_rln_cat = 51
+num_rln_queries = 1
+edge_loss_coef = 1.0
+
+
+sgg_mode = 'full'
+
+rln_freq_bias = None
+focal_loss_for_edges = False  # set True if rln_freq_bias is None and u want to use a sigmoid focal loss for edges
+
+
+detections_per_img = 20
+
+# small images
+data_aug_scales = [256]
+data_aug_max_size = 384
@@ -3,13 +3,28 @@ import torch.utils.data
 import torchvision
 import copy
 
-from .coco import build as build_coco
-from .vg import build_vg
-from .custom import CustomDataset
-
 from torch.utils.data import ConcatDataset
 
 
+# the dataset modules (pycocotools, h5py, ...) are imported by the builders on use,
+# importing the package (e.g. in spawned DataLoader workers) stays cheap
+def build_coco(image_set, args):
+    from .coco import build
+    return build(image_set, args)
+
+
+def build_vg(image_set, args):
+    from .vg import build_vg
+    return build_vg(image_set, args)
+
+
+def __getattr__(name):
+    if name == 'CustomDataset':
+        from .custom import CustomDataset
+        return CustomDataset
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 def get_coco_api_from_dataset(dataset):
     for _ in range(10):
         # if isinstance(dataset, torchvision.datasets.CocoDetection):
@@ -80,6 +95,7 @@ def build_dataset(image_set, args):
         return ConcatDataset([coco_data, flickr_data, sbu_data])
 
     if args.dataset_file == 'custom':
+        from .custom import CustomDataset
         return CustomDataset(args, image_set)
 
 
@@ -0,0 +1,151 @@
+"""
+Indexed, memory-mapped annotation store.
+
+Large json / jsonl annotation files (e.g. OpenImages v6) are converted once into
+    <prefix>.bin      concatenated utf-8 json records, one per image
+    <prefix>.idx.npy  int64 offsets of the records, shape (N + 1,)
+    <prefix>.ids.npy  image ids, shape (N,)
+Records are decoded on access from a read-only memmap, so the OS page cache is
+shared by all dataloader workers instead of every worker holding a python copy
+of the full annotation list.
+
+Convert with:
+    python -m datasets.ann_store data/open-imagev6/annotations/oiv6-train-bbox.json
+"""
+import json
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+
+def store_prefix(ann_file):
+    return os.path.splitext(ann_file)[0]
+
+
+def store_exists(prefix):
+    return all(os.path.exists(prefix + ext) for ext in ('.bin', '.idx.npy', '.ids.npy'))
+
+
+def convert_annotations(ann_file, prefix=None, id_key='image_id'):
+    """Convert a json (list of dicts) or jsonl annotation file into an indexed store."""
+    prefix = prefix or store_prefix(ann_file)
+
+    if 'jsonl' in ann_file:
+        with open(ann_file, 'r') as fin:
+            records = (json.loads(line) for line in fin)
+            return _write_store(records, prefix, id_key)
+
+    with open(ann_file, 'r') as fin:
+        records = json.load(fin)
+    return _write_store(records, prefix, id_key)
+
+
+def _write_store(records, prefix, id_key):
+    offsets = [0]
+    ids = []
+    # write to temporary files first so that a partial conversion is never picked up
+    with open(prefix + '.bin.tmp', 'wb') as fout:
+        for record in records:
+            data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+            fout.write(data)
+            offsets.append(offsets[-1] + len(data))
+            ids.append(record[id_key])
+
+    with open(prefix + '.idx.npy.tmp', 'wb') as fout:
+        np.save(fout, np.asarray(offsets, dtype=np.int64))
+    with open(prefix + '.ids.npy.tmp', 'wb') as fout:
+        # fixed-width string / int array, no pickled objects
+        np.save(fout, np.asarray(ids))
+
+    for ext in ('.bin', '.idx.npy', '.ids.npy'):
+        os.replace(prefix + ext + '.tmp', prefix + ext)
+
+    return len(ids)
+
+
+class ImageIds(Sequence):
+    """Read-only list-like view of the image ids of a store."""
+
+    def __init__(self, ids):
+        self._ids = ids
+        self._lookup = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._ids[index].item()
+
+    def index(self, value, start=0, stop=None):
+        if self._lookup is None:
+            self._lookup = {v: i for i, v in enumerate(self._ids.tolist())}
+        index = self._lookup.get(value)
+        if index is None or index < start or (stop is not None and index >= stop):
+            raise ValueError("%s is not in ids" % (value, ))
+        return index
+
+
+class IndexedAnnotationStore(Sequence):
+    """
+    List-like access to the records of a store, store[i] returns a new dict.
+    The memmaps are opened lazily in each process and are not pickled, so the
+    store is cheap to send to dataloader workers.
+    """
+
+    def __init__(self, prefix):
+        assert store_exists(prefix), "annotation store %s.{bin,idx.npy,ids.npy} does not exist!" % prefix
+        self.prefix = prefix
+        self._data = None
+        self._offsets = None
+        self._ids = None
+
+    def _open(self):
+        self._offsets = np.load(self.prefix + '.idx.npy', mmap_mode='r')
+        self._ids = np.load(self.prefix + '.ids.npy', mmap_mode='r')
+        if self._offsets[-1] > 0:
+            self._data = np.memmap(self.prefix + '.bin', dtype=np.uint8, mode='r')
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._open()
+        return ImageIds(self._ids)
+
+    def __len__(self):
+        if self._offsets is None:
+            self._open()
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if self._offsets is None:
+            self._open()
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return json.loads(self._data[start:end].tobytes().decode('utf-8'))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = state['_offsets'] = state['_ids'] = None
+        return state
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser('Convert a json/jsonl annotation file into an indexed store')
+    parser.add_argument('ann_file', type=str)
+    parser.add_argument('--prefix', type=str, default=None,
+                        help='output prefix, defaults to ann_file without extension')
+    parser.add_argument('--id_key', type=str, default='image_id')
+    opts = parser.parse_args()
+
+    num = convert_annotations(opts.ann_file, opts.prefix, opts.id_key)
+    print("converted %d records to %s.{bin,idx.npy,ids.npy}" % (num, opts.prefix or store_prefix(opts.ann_file)))
@@ -0,0 +1,397 @@
+"""
+Incremental, array based COCO bbox evaluation.
+
+Gives the same precision / recall / stats as COCO.loadRes + COCOEval.evaluate (including the
+group-of matching of datasets/cocoeval.py used for OpenImages) + COCOEval.accumulate, but
+  - does not build a COCO result object per batch,
+  - keeps for every image only compact arrays (one row per kept detection with its score,
+    category, rank in the image and tp / fp bits per iou threshold and area range, and the
+    number of non-ignored gts per category and area range),
+  - gathers these arrays across ranks instead of the per (image, category, area) dicts,
+  - accumulates all categories from one global sort.
+"""
+import threading
+
+import numpy as np
+
+from util.misc import all_gather
+from .bbox_overlaps import bbox_overlaps
+
+
+def _last_argmax(mask, values):
+    """Index of the last maximum of values[j] over mask[t, j] for every row t, and mask.any(1)."""
+    masked = np.where(mask, values[None, :], -np.inf)
+    idx = masked.shape[1] - 1 - np.argmax(masked[:, ::-1], axis=1)
+    return idx, mask.any(1)
+
+
+def _last_true(mask):
+    idx = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    return idx, mask.any(1)
+
+
+def box_iou_xywh(dt, gt, iscrowd):
+    """pycocotools.mask.iou for boxes, (D, G) in float64."""
+    dt = np.asarray(dt, dtype=np.float64).reshape(-1, 4)
+    gt = np.asarray(gt, dtype=np.float64).reshape(-1, 4)
+    w = np.minimum(dt[:, None, 2] + dt[:, None, 0], gt[None, :, 2] + gt[None, :, 0]) - \
+        np.maximum(dt[:, None, 0], gt[None, :, 0])
+    h = np.minimum(dt[:, None, 3] + dt[:, None, 1], gt[None, :, 3] + gt[None, :, 1]) - \
+        np.maximum(dt[:, None, 1], gt[None, :, 1])
+    inter = w * h
+    dt_area = (dt[:, 2] * dt[:, 3])[:, None]
+    gt_area = (gt[:, 2] * gt[:, 3])[None, :]
+    union = np.where(np.asarray(iscrowd, dtype=bool)[None, :], dt_area, dt_area + gt_area - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = np.where((w > 0) & (h > 0), inter / union, 0.0)
+    return ious
+
+
+class IncrementalBoxEvaluator(object):
+    """
+    Args:
+        coco_gt: COCO api of the ground truth
+        params: COCOeval params (iouThrs, recThrs, areaRng, maxDets, catIds), useCats only
+    """
+
+    def __init__(self, coco_gt, params):
+        self.coco_gt = coco_gt
+        self.params = params
+        self.cat_ids = list(np.unique(params.catIds))
+        self.cat_index = {c: k for k, c in enumerate(self.cat_ids)}
+        self.iou_thrs = np.minimum(np.asarray(params.iouThrs, dtype=np.float64), 1 - 1e-10)
+        self.area_rngs = [tuple(a) for a in params.areaRng]
+        self.max_det = max(params.maxDets)
+
+        T = len(self.iou_thrs)
+        assert T <= 64, "at most 64 iou thresholds are supported"
+        self.bits_dtype = np.uint16 if T <= 16 else np.uint64
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.img_ids = []
+        self._seen = set()
+        self._records = []
+        self._merged = None
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def _to_bits(self, mask):
+        """(T, D) bool -> (D,) bitmask."""
+        weights = (1 << np.arange(mask.shape[0], dtype=np.uint64))
+        return (mask.astype(np.uint64) * weights[:, None]).sum(0).astype(self.bits_dtype)
+
+    def _from_bits(self, bits):
+        shifts = np.arange(len(self.iou_thrs), dtype=np.uint64)
+        return ((bits.astype(np.uint64)[None, :] >> shifts[:, None]) & 1).astype(bool)
+
+    def update(self, image_id, boxes, scores, labels):
+        """
+        Add the detections of one image.
+        boxes: (N, 4) xywh in the original image size, scores: (N,), labels: (N,) category ids
+        """
+        with self.lock:
+            if image_id in self._seen:
+                return
+            self._seen.add(image_id)
+
+        record = self.evaluate_image(image_id, boxes, scores, labels)
+
+        with self.lock:
+            self.img_ids.append(image_id)
+            self._records.append(record)
+            self._merged = None
+
+    def evaluate_image(self, image_id, boxes, scores, labels):
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        scores = np.asarray(scores).reshape(-1)
+        labels = np.asarray(labels).reshape(-1)
+
+        gts_per_cat = {}
+        for ann in self.coco_gt.imgToAnns.get(image_id, []):
+            if ann['category_id'] in self.cat_index:
+                gts_per_cat.setdefault(ann['category_id'], []).append(ann)
+
+        cats = set(gts_per_cat.keys())
+        cats.update(c for c in np.unique(labels).tolist() if c in self.cat_index)
+
+        det_cat, det_rank, det_score, det_tp, det_fp = [], [], [], [], []
+        gt_cat, gt_count = [], []
+        for cat in sorted(cats):
+            dt_idx = np.nonzero(labels == cat)[0]
+            # highest score first, as COCOeval.computeIoU / evaluateImg
+            dt_idx = dt_idx[np.argsort(-scores[dt_idx], kind='mergesort')][:self.max_det]
+            gts = gts_per_cat.get(cat, [])
+
+            tp, fp, num_gt = self.evaluate_pair(gts, boxes[dt_idx])
+
+            k = self.cat_index[cat]
+            if len(gts) > 0:
+                gt_cat.append(k)
+                gt_count.append(num_gt)
+            if len(dt_idx) > 0:
+                det_cat.append(np.full(len(dt_idx), k, dtype=np.int64))
+                det_rank.append(np.arange(len(dt_idx), dtype=np.int64))
+                det_score.append(scores[dt_idx])
+                det_tp.append(np.stack([self._to_bits(e) for e in tp]))
+                det_fp.append(np.stack([self._to_bits(e) for e in fp]))
+
+        A = len(self.area_rngs)
+        if len(det_cat) > 0:
+            dets = dict(cat=np.concatenate(det_cat), rank=np.concatenate(det_rank),
+                        score=np.concatenate(det_score),
+                        tp=np.concatenate(det_tp, 1), fp=np.concatenate(det_fp, 1))
+        else:
+            dets = dict(cat=np.zeros(0, dtype=np.int64), rank=np.zeros(0, dtype=np.int64),
+                        score=np.zeros(0, dtype=scores.dtype),
+                        tp=np.zeros((A, 0), dtype=self.bits_dtype),
+                        fp=np.zeros((A, 0), dtype=self.bits_dtype))
+        gts = dict(cat=np.asarray(gt_cat, dtype=np.int64),
+                   count=np.asarray(gt_count, dtype=np.int64).reshape(-1, A).T)
+        return dict(dets=dets, gts=gts)
+
+    def evaluate_pair(self, gts, dt_boxes):
+        """
+        Match the (score sorted) detections of one image and category to its gts,
+        as COCOEval.evaluateImg for every area range.
+
+        Returns:
+            tp, fp: (A, T, D) bool, (not) matched and not ignored
+            num_gt: (A,) number of non-ignored gts
+        """
+        T, A = len(self.iou_thrs), len(self.area_rngs)
+        D, G = len(dt_boxes), len(gts)
+
+        # area of the detections as COCO.loadRes, in the dtype of the boxes
+        dt_area = (dt_boxes[:, 2] * dt_boxes[:, 3]).astype(np.float64)
+        tp = np.zeros((A, T, D), dtype=bool)
+        fp = np.zeros((A, T, D), dtype=bool)
+        num_gt = np.zeros(A, dtype=np.int64)
+
+        if G == 0:
+            for a, (lo, hi) in enumerate(self.area_rngs):
+                fp[a] = ~((dt_area < lo) | (dt_area > hi))[None, :]
+            return tp, fp, num_gt
+
+        gt_bbox = [g['bbox'] for g in gts]
+        gt_area = np.array([g['area'] for g in gts], dtype=np.float64)
+        iscrowd = np.array([int(g.get('iscrowd', 0)) for g in gts]) != 0
+        gt_ids = np.array([g['id'] for g in gts], dtype=np.float64)
+        has_group_of = D > 0 and 'is_group_of' in gts[0]
+        if has_group_of:
+            is_group_of = np.array([g['is_group_of'] for g in gts], dtype=bool)
+
+        ious = box_iou_xywh(dt_boxes, gt_bbox, iscrowd) if D > 0 else np.zeros((0, G))
+        iofs = None
+        if has_group_of and is_group_of.any():
+            dt_xyxy = np.array(dt_boxes).reshape(-1, 4)
+            gt_xyxy = np.array(gt_bbox).reshape(-1, 4)
+            dt_xyxy[:, 2:] = dt_xyxy[:, 2:] + dt_xyxy[:, :2]
+            gt_xyxy[:, 2:] = gt_xyxy[:, 2:] + gt_xyxy[:, :2]
+            iofs = bbox_overlaps(dt_xyxy, gt_xyxy, mode='iof')
+
+        for a, (lo, hi) in enumerate(self.area_rngs):
+            gt_ig = iscrowd | (gt_area < lo) | (gt_area > hi)
+            # gt ignore last
+            gtind = np.argsort(gt_ig, kind='mergesort')
+            gt_ig_s = gt_ig[gtind]
+            num_gt[a] = np.count_nonzero(~gt_ig)
+
+            dtm = np.zeros((T, D))
+            dt_ig = np.zeros((T, D), dtype=bool)
+            if D > 0:
+                allowed = ~is_group_of[gtind] if has_group_of else np.ones(G, dtype=bool)
+                self._match(ious[:, gtind], gt_ig_s, iscrowd[gtind], gt_ids[gtind], allowed, dtm, dt_ig)
+                if iofs is not None:
+                    group_idx = np.nonzero(is_group_of[gtind])[0]
+                    self._match_group_of(iofs[:, gtind][:, group_idx], gt_ids[gtind][group_idx], dtm, dt_ig)
+
+            # unmatched detections outside of the area range are ignored
+            dt_out = (dt_area < lo) | (dt_area > hi)
+            dt_ig = dt_ig | ((dtm == 0) & dt_out[None, :])
+            tp[a] = (dtm != 0) & ~dt_ig
+            fp[a] = (dtm == 0) & ~dt_ig
+
+        return tp, fp, num_gt
+
+    def _match(self, ious, gt_ig, iscrowd, gt_ids, allowed, dtm, dt_ig):
+        """Greedy matching of COCOeval, all iou thresholds at once. gts are sorted ignore last."""
+        G = ious.shape[1]
+        gtm = np.zeros((len(self.iou_thrs), G), dtype=bool)
+        candidates = np.where(allowed[None, :], ious, -1.0).max(1) >= self.iou_thrs.min()
+        for d in np.nonzero(candidates)[0]:
+            iou = ious[d]
+            cand = (iou[None, :] >= self.iou_thrs[:, None]) & allowed[None, :] & \
+                   (~gtm | iscrowd[None, :])
+            # a match to a regular gt is preferred, ignored gts are only tried otherwise
+            m_reg, has_reg = _last_argmax(cand & ~gt_ig[None, :], iou)
+            m_ig, has_ig = _last_argmax(cand & gt_ig[None, :], iou)
+            m = np.where(has_reg, m_reg, m_ig)
+            t = np.nonzero(has_reg | has_ig)[0]
+            dt_ig[t, d] = gt_ig[m[t]]
+            dtm[t, d] = gt_ids[m[t]]
+            gtm[t, m[t]] = True
+
+    def _match_group_of(self, iofs, gt_ids, dtm, dt_ig):
+        """Group-of matching of datasets/cocoeval.py (step 2), all iou thresholds at once."""
+        T, Gg = len(self.iou_thrs), iofs.shape[1]
+        if Gg == 0:
+            return
+        max_iof = -np.ones((T, Gg))
+        max_dt = -np.ones((T, Gg), dtype=np.int64)
+        for d in range(iofs.shape[0]):
+            active = ~(dtm[:, d] > 0) & ~dt_ig[:, d]
+            over = (iofs[d][None, :] > self.iou_thrs[:, None]) & active[:, None]
+            if not over.any():
+                continue
+            improve = over & (iofs[d][None, :] > max_iof)
+            # the previous best detection of an improved gt is ignored
+            t_prev, g_prev = np.nonzero(improve & (max_dt >= 0))
+            dt_ig[t_prev, max_dt[t_prev, g_prev]] = True
+            max_iof = np.where(improve, iofs[d][None, :], max_iof)
+            max_dt = np.where(improve, d, max_dt)
+
+            # ignored unless the last gt it is inside of was improved
+            last_over, has_over = _last_true(over)
+            t = np.nonzero(has_over)[0]
+            dt_ig[t, d] = ~improve[t, last_over[t]]
+
+            m, has_m = _last_true(improve)
+            t = np.nonzero(has_m)[0]
+            dtm[t, d] = gt_ids[m[t]]
+
+    def _local_arrays(self):
+        A = len(self.area_rngs)
+        records = self._records
+        num_dets = [len(r['dets']['cat']) for r in records]
+        num_gts = [len(r['gts']['cat']) for r in records]
+
+        def cat(key, sub, empty):
+            arrays = [r[key][sub] for r in records]
+            return np.concatenate(arrays, -1) if arrays else empty
+
+        bits_empty = np.zeros((A, 0), dtype=self.bits_dtype)
+        return dict(
+            img_ids=list(self.img_ids),
+            det_img=np.repeat(np.arange(len(records)), num_dets),
+            det_cat=cat('dets', 'cat', np.zeros(0, dtype=np.int64)),
+            det_rank=cat('dets', 'rank', np.zeros(0, dtype=np.int64)),
+            det_score=cat('dets', 'score', np.zeros(0)),
+            det_tp=cat('dets', 'tp', bits_empty),
+            det_fp=cat('dets', 'fp', bits_empty),
+            gt_img=np.repeat(np.arange(len(records)), num_gts),
+            gt_cat=cat('gts', 'cat', np.zeros(0, dtype=np.int64)),
+            gt_count=cat('gts', 'count', np.zeros((A, 0), dtype=np.int64)),
+        )
+
+    def synchronize_between_processes(self):
+        """Gather the arrays of all ranks, every image is kept once (first rank that has it)."""
+        all_arrays = all_gather(self._local_arrays())
+
+        img_ids, seen = [], set()
+        merged = {k: [] for k in all_arrays[0].keys() if k != 'img_ids'}
+        for arrays in all_arrays:
+            # local image index -> merged image index, -1 if already seen
+            local_to_merged = np.full(len(arrays['img_ids']), -1, dtype=np.int64)
+            for i, img_id in enumerate(arrays['img_ids']):
+                if img_id in seen:
+                    continue
+                seen.add(img_id)
+                local_to_merged[i] = len(img_ids)
+                img_ids.append(img_id)
+
+            for prefix in ('det', 'gt'):
+                new_img = local_to_merged[arrays[prefix + '_img']]
+                keep = new_img >= 0
+                merged[prefix + '_img'].append(new_img[keep])
+                for k, v in arrays.items():
+                    if k.startswith(prefix + '_') and k != prefix + '_img':
+                        merged[k].append(v[..., keep])
+
+        self._merged = {k: np.concatenate(v, -1) for k, v in merged.items()}
+        self._merged['img_ids'] = img_ids
+
+    def gt_dt_valid(self):
+        """Per category number of non-ignored gts / dets (summed over area ranges), as COCOEval.gt_dt_valid."""
+        arrays = self._merged if self._merged is not None else self._local_arrays()
+        T = len(self.iou_thrs)
+        res = {}
+        gts = np.zeros(len(self.cat_ids), dtype=np.int64)
+        np.add.at(gts, arrays['gt_cat'], arrays['gt_count'].sum(0))
+        dts = np.zeros((len(self.cat_ids), T), dtype=np.int64)
+        for tp, fp in zip(arrays['det_tp'], arrays['det_fp']):
+            valid = self._from_bits(tp) | self._from_bits(fp)  # (T, N)
+            np.add.at(dts, arrays['det_cat'], valid.T.astype(np.int64))
+        for k in np.nonzero(gts + dts.sum(1))[0]:
+            res[self.cat_ids[k]] = {'gts': int(gts[k]), 'dts': dts[k].tolist()}
+        return res
+
+    def accumulate(self, coco_eval):
+        """Fill coco_eval.eval (precision / recall / scores) as COCOeval.accumulate."""
+        arrays = self._merged if self._merged is not None else self._local_arrays()
+        p = coco_eval.params
+        p.catIds = list(self.cat_ids)
+        p.maxDets = sorted(p.maxDets)
+
+        T, R, K = len(p.iouThrs), len(p.recThrs), len(self.cat_ids)
+        A, M = len(p.areaRng), len(p.maxDets)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+        scores = -np.ones((T, R, K, A, M))
+
+        # images are concatenated in sorted id order by COCOeval
+        img_ids = arrays['img_ids']
+        sorted_ids, img_rank = np.unique(np.array(img_ids), return_inverse=True)
+        p.imgIds = list(sorted_ids)
+
+        npig = np.zeros((K, A), dtype=np.int64)
+        np.add.at(npig, arrays['gt_cat'], arrays['gt_count'].T)
+
+        det_score = arrays['det_score']
+        det_rank = arrays['det_rank']
+        # per category: score (desc), then image, then rank in the image == stable sort of the concatenation
+        order = np.lexsort((det_rank, img_rank[arrays['det_img']], -det_score, arrays['det_cat']))
+
+        for m, max_det in enumerate(p.maxDets):
+            order_m = order[det_rank[order] < max_det]
+            cat_m = arrays['det_cat'][order_m]
+            starts = np.searchsorted(cat_m, np.arange(K), side='left')
+            ends = np.searchsorted(cat_m, np.arange(K), side='right')
+            score_m = det_score[order_m]
+            for a in range(A):
+                tps = self._from_bits(arrays['det_tp'][a][order_m])
+                fps = self._from_bits(arrays['det_fp'][a][order_m])
+                for k in np.nonzero(npig[:, a])[0]:
+                    s, e = starts[k], ends[k]
+                    nd = e - s
+                    tp_sum = np.cumsum(tps[:, s:e], axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps[:, s:e], axis=1).astype(dtype=np.float64)
+                    rc = tp_sum / npig[k, a]
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if nd else 0
+                    if nd == 0:
+                        precision[:, :, k, a, m] = 0
+                        scores[:, :, k, a, m] = 0
+                        continue
+                    # make precision monotonically decreasing
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                        valid = inds < nd
+                        q = np.zeros(R)
+                        ss = np.zeros(R)
+                        q[valid] = pr[t, inds[valid]]
+                        ss[valid] = score_m[s:e][inds[valid]]
+                        precision[t, :, k, a, m] = q
+                        scores[t, :, k, a, m] = ss
+
+        coco_eval.eval = {
+            'params': p,
+            'counts': [T, R, K, A, M],
+            'precision': precision,
+            'recall': recall,
+            'scores': scores,
+        }
+        coco_eval.gt_dt_valid = self.gt_dt_valid()
@@ -0,0 +1,108 @@
+"""
+CSR index over a class hierarchy (e.g. the OpenImages 600 classes) used to add
+super-category boxes and to filter unannotated classes for COCO-style evaluation.
+"""
+import numpy as np
+
+
+class ClassHierarchyIndex(object):
+    """
+    Ancestors / descendants of every class stored in CSR form
+    (indptr, indices), built once from relation_matrix where
+    relation_matrix[child, parent] = 1 and the diagonal is 1.
+    Ancestors and descendants include the class itself and are sorted ascending.
+    """
+
+    def __init__(self, relation_matrix):
+        relation_matrix = np.asarray(relation_matrix) > 0
+        self.num_classes = relation_matrix.shape[0]
+        self.anc_indptr, self.anc_indices = self._to_csr(relation_matrix)
+        self.desc_indptr, self.desc_indices = self._to_csr(relation_matrix.T)
+
+    @staticmethod
+    def _to_csr(matrix):
+        rows, cols = np.nonzero(matrix)  # row-major, cols sorted within each row
+        indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=matrix.shape[0]), out=indptr[1:])
+        return indptr, cols.astype(np.int64)
+
+    def ancestors(self, label):
+        return self.anc_indices[self.anc_indptr[label]: self.anc_indptr[label + 1]]
+
+    def descendants(self, label):
+        return self.desc_indices[self.desc_indptr[label]: self.desc_indptr[label + 1]]
+
+    def _gather(self, indptr, indices, labels):
+        labels = np.unique(np.asarray(labels, dtype=np.int64))
+        if len(labels) == 0:
+            return labels
+        starts, ends = indptr[labels], indptr[labels + 1]
+        lengths = ends - starts
+        # concatenation of indices[starts[i]:ends[i]] without a python loop
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return np.unique(indices[offsets + np.arange(lengths.sum())])
+
+    def ancestor_closure(self, labels):
+        """Sorted unique labels together with all their super-categories."""
+        return self._gather(self.anc_indptr, self.anc_indices, labels)
+
+    def descendant_closure(self, labels):
+        """Sorted unique labels together with all their sub-categories."""
+        return self._gather(self.desc_indptr, self.desc_indices, labels)
+
+    def expand(self, labels, allowed_classes=None):
+        """
+        Add super-category copies of the entries of labels and, if allowed_classes
+        is given, drop the entries whose class is not allowed.
+
+        Gives the same entries as the reference per-class loop (mmdet OpenImagesMetric):
+            for c in unique(labels):
+                for a in ancestors(c):
+                    if a allowed and a != c: append copies of entries labeled c, labeled a
+                    elif a not allowed: remove entries labeled a
+        but tracks the number of copies per (original class, label) instead of growing
+        the arrays, so the cost does not depend on the number of entries.
+
+        Returns:
+            src_idx: index into labels of every output entry, the kept originals
+                     first (in input order) and then the super-category copies
+            out_labels: label of every output entry
+        """
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        if len(labels) == 0:
+            return np.zeros(0, dtype=np.int64), labels
+
+        uniq, inverse = np.unique(labels, return_inverse=True)
+        cols = self.ancestor_closure(uniq)
+        if allowed_classes is None:
+            allowed = np.ones(len(cols), dtype=bool)
+        else:
+            allowed = np.isin(cols, np.asarray(allowed_classes, dtype=np.int64))
+
+        # counts[u, j]: copies labeled cols[j] of every entry whose original class is uniq[u]
+        counts = np.zeros((len(uniq), len(cols)), dtype=np.int64)
+        uniq_cols = np.searchsorted(cols, uniq)
+        counts[np.arange(len(uniq)), uniq_cols] = 1
+
+        for label, jp in zip(uniq.tolist(), uniq_cols.tolist()):
+            anc = np.searchsorted(cols, self.ancestors(label))
+            src = counts[:, jp].copy()
+            lower = allowed[anc] & (cols[anc] < label)
+            # entries labeled `label` are removed before the higher ancestors are visited
+            upper = allowed[anc] & (cols[anc] > label) & allowed[jp]
+            counts[:, anc[lower]] += src[:, None]
+            counts[:, anc[upper]] += src[:, None]
+            counts[:, anc[~allowed[anc]]] = 0
+
+        # own class count is 0 or 1 since the hierarchy has no cycles
+        keep = counts[inverse, uniq_cols[inverse]] > 0
+        counts[np.arange(len(uniq)), uniq_cols] = 0
+
+        src_idx = [np.nonzero(keep)[0]]
+        out_labels = [labels[keep]]
+        for u, j in zip(*np.nonzero(counts)):
+            members = np.nonzero(inverse == u)[0]
+            src_idx.append(np.repeat(members, counts[u, j]))
+            out_labels.append(np.full(len(members) * counts[u, j], cols[j], dtype=np.int64))
+
+        return np.concatenate(src_idx), np.concatenate(out_labels)
@@ -22,6 +22,9 @@ import torchvision
 from pycocotools import mask as coco_mask
 
 from datasets.data_util import preparing_dataset
+from datasets.vocab_sampler import VocabSampler
+from datasets.image_io import get_decode_size, load_image, box_scale
+from datasets.image_shards import open_image_shards
 import datasets.transforms as T
 from util.box_ops import box_cxcywh_to_xyxy, box_iou
 
@@ -341,10 +344,18 @@ class CocoDetection(torchvision.datasets.CocoDetection):
                  caption_file=None, use_text_labels=False, do_text_shuffle=True,
                  nouns_list=None, relations_list=None, rln_pretraining=False,
                  gpt4sgg_file=None, name2predicates=None, 
-                 coco_ids_in_vg_file=None):
+                 coco_ids_in_vg_file=None,
+                 noun_sampler=None, relation_sampler=None,
+                 draft_decode=False, image_shards=None):
 
         super(CocoDetection, self).__init__(img_folder, ann_file)
         self._transforms = transforms
+        # packed images (datasets/image_shards.py) are read instead of img_folder
+        self.image_shards = image_shards
+        # large JPEGs are decoded at reduced resolution (datasets/image_io.py), not with masks
+        self.decode_size = None
+        if draft_decode and transforms is not None and not return_masks:
+            self.decode_size = get_decode_size(transforms)
         self.prepare = ConvertCocoPolysToMask(return_masks)
         self.aux_target_hacks = aux_target_hacks
         self.rln_pretraining = rln_pretraining
@@ -398,6 +409,52 @@ class CocoDetection(torchvision.datasets.CocoDetection):
             assert self.nouns_list is not None, "nouns list cannot be None!"
             assert self.relations_list is not None, "relations list cannot be None !"
 
+            self.noun_sampler = noun_sampler if noun_sampler is not None else VocabSampler(nouns_list)
+            self.relation_sampler = relation_sampler if relation_sampler is not None \
+                                        else VocabSampler(relations_list)
+
+
+    def _load_image(self, id):
+        path = self.coco.loadImgs(id)[0]["file_name"]
+        if self.image_shards is not None:
+            img, _ = self.image_shards.load_image(path, self.decode_size)
+        else:
+            img, _ = load_image(os.path.join(self.root, path), self.decode_size)
+        return img
+
+    def image_key(self, index):
+        return self.coco.loadImgs(self.ids[index])[0]["file_name"]
+
+    def get_shard_position(self, index):
+        if self.image_shards is None:
+            return None
+        return self.image_shards.position(self.image_key(index))
+
+    def pack_record(self, index):
+        """(key, image path, annotation) of an image for datasets/image_shards.py"""
+        image_id = self.ids[index]
+        img_info = self.coco.imgs[image_id]
+        anns = self.coco.loadAnns(self.coco.getAnnIds(image_id))
+        annotation = {'image_id': image_id,
+                      'width': img_info.get('width'),
+                      'height': img_info.get('height'),
+                      'boxes': [ann['bbox'] for ann in anns], # xywh in pixels
+                      'labels': [self.coco.cats[ann['category_id']]['name'] for ann in anns],
+                      }
+        if self.caption_data is not None:
+            # parsed caption triplets with their grounded boxes
+            annotation['captions'] = self.caption_data[index]
+        if self.gpt4sgg_data is not None:
+            annotation['gpt4sgg'] = self.gpt4sgg_data[str(image_id)]
+        key = self.image_key(index)
+        return key, os.path.join(self.root, key), annotation
+
+    def _orig_size(self, image_id, img):
+        """(w, h) of the annotated image, img may be smaller (draft mode decoding)"""
+        img_info = self.coco.imgs[image_id]
+        if 'width' in img_info and 'height' in img_info:
+            return img_info['width'], img_info['height']
+        return img.size
 
     def change_hack_attr(self, hackclassname, attrkv_dict):
         target_class = dataset_hook_register[hackclassname]
@@ -412,6 +469,10 @@ class CocoDetection(torchvision.datasets.CocoDetection):
             if isinstance(item, target_class):
                 return item
 
+    def get_img_info(self, idx):
+        img_info = self.coco.imgs[self.ids[idx]]
+        return {'height': img_info['height'], 'width': img_info['width']}
+
     def __getitem__(self, idx):
         """
         Output:
@@ -432,7 +493,8 @@ class CocoDetection(torchvision.datasets.CocoDetection):
 
         image_id = self.ids[idx]
         target = {'image_id': image_id, 'annotations': target}
-        img, target = self.prepare(img, target)
+        orig_size = self._orig_size(image_id, img)
+        img, target = self.prepare(img, target, orig_size=orig_size)
 
         # text 
         if self.use_text_labels:
@@ -444,14 +506,14 @@ class CocoDetection(torchvision.datasets.CocoDetection):
                 del target['iscrowd']
 
                 target['boxes'] = torch.as_tensor(gpt4sgg_data['bboxes'])
+                if img.size != orig_size:
+                    target['boxes'] = target['boxes'] * box_scale(img, orig_size)
                 names = [e.split('.')[0] for e in gpt4sgg_data['names']]
                 target['gt_names'] = copy.deepcopy(names)
                 target['labels'] = torch.tensor([self.name2classes[e] for e in names])
                 
-                neg_names = list(set(self.nouns_list) - set(names))
-                neg_sample = []
                 neg_count = max(1, 80 - len(set(names)))
-                neg_sample = np.random.choice(neg_names, size=neg_count, replace=False).tolist()
+                neg_sample = self.noun_sampler.sample(neg_count, exclude=names)
 
                 nouns = target['gt_names'] + neg_sample
                 random.shuffle(nouns)
@@ -468,12 +530,10 @@ class CocoDetection(torchvision.datasets.CocoDetection):
                     relations.append([sub, obj, pred])
 
                 gt_rels = list(set([e[2] for e in relations]))
-                neg_rels = list(set(self.relations_list) - set(gt_rels))
-                neg_rel_sample = []
 
                 neg_count = max(1, 80 - len(gt_rels))
                 #neg_count = min(len(rels)*3, neg_count)
-                neg_rel_sample = np.random.choice(neg_rels, size=neg_count, replace=False).tolist()
+                neg_rel_sample = self.relation_sampler.sample(neg_count, exclude=gt_rels)
                 target['gt_rels'] = gt_rels
              
                 rels = gt_rels + neg_rel_sample
@@ -524,11 +584,9 @@ class CocoDetection(torchvision.datasets.CocoDetection):
                     target['gt_names'] = cap_data['phrases'][ridx]
                     gt_sample = target['gt_names']
 
-                neg_names = list(set(self.nouns_list) - set(nouns))
-                neg_sample = []
                 neg_count = max(1, 80 - len(gt_sample))
                 #neg_count = min(3*len(gt_sample), neg_count)
-                neg_sample = np.random.choice(neg_names, size=neg_count, replace=False).tolist()
+                neg_sample = self.noun_sampler.sample(neg_count, exclude=nouns)
                 
                 nouns = gt_sample + neg_sample
                 if os.environ.get("DEBUG") == '1':
@@ -542,12 +600,9 @@ class CocoDetection(torchvision.datasets.CocoDetection):
                 target['caption'] = preprocess_caption(target['caption'])
 
                 # rel
-                neg_rels = list(set(self.relations_list) - set(rels))
-                neg_rel_sample = []
-
                 neg_count = max(1, 80 - len(rels))
                 #neg_count = min(len(rels)*3, neg_count)
-                neg_rel_sample = np.random.choice(neg_rels, size=neg_count, replace=False).tolist()
+                neg_rel_sample = self.relation_sampler.sample(neg_count, exclude=rels)
 
                 target['gt_rels'] = copy.deepcopy(rels)
                 #rels = ['[UNK]'] + rels + neg_rel_sample
@@ -572,11 +627,16 @@ class CocoDetection(torchvision.datasets.CocoDetection):
         img, target = super(CocoDetection, self).__getitem__(idx)
         image_id = self.ids[idx]
         target = {'image_id': image_id, 'annotations': target}
-        img, target = self.prepare(img, target)
+        orig_size = self._orig_size(image_id, img)
+        img, target = self.prepare(img, target, orig_size=orig_size)
         relation = None 
 
+        boxes = target['boxes']
+        if img.size != orig_size:
+            # ground truth in pixels of the annotated image
+            boxes = boxes / box_scale(img, orig_size)
 
-        return target['boxes'], target['labels'], relation
+        return boxes, target['labels'], relation
 
 
 
@@ -601,8 +661,12 @@ class ConvertCocoPolysToMask(object):
     def __init__(self, return_masks=False):
         self.return_masks = return_masks
 
-    def __call__(self, image, target):
+    def __call__(self, image, target, orig_size=None):
+        """orig_size: (w, h) of the annotated image if image was decoded at a reduced size"""
         w, h = image.size
+        scale = None
+        if orig_size is not None and tuple(orig_size) != (w, h):
+            scale = box_scale(image, orig_size)
 
         image_id = target["image_id"]
         #image_id = torch.tensor([image_id])
@@ -615,6 +679,8 @@ class ConvertCocoPolysToMask(object):
         # guard against no boxes via resizing
         boxes = torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4)
         boxes[:, 2:] += boxes[:, :2]
+        if scale is not None:
+            boxes = boxes * scale
         boxes[:, 0::2].clamp_(min=0, max=w)
         boxes[:, 1::2].clamp_(min=0, max=h)
 
@@ -632,6 +698,8 @@ class ConvertCocoPolysToMask(object):
             num_keypoints = keypoints.shape[0]
             if num_keypoints:
                 keypoints = keypoints.view(num_keypoints, -1, 3)
+                if scale is not None:
+                    keypoints[..., :2] *= scale[:2]
 
         keep = (boxes[:, 3] > boxes[:, 1]) & (boxes[:, 2] > boxes[:, 0])
         boxes = boxes[keep]
@@ -652,11 +720,17 @@ class ConvertCocoPolysToMask(object):
 
         # for conversion to coco api
         area = torch.tensor([obj["area"] for obj in anno])
+        if scale is not None:
+            area = area * (scale[0] * scale[1])
         iscrowd = torch.tensor([obj["iscrowd"] if "iscrowd" in obj else 0 for obj in anno])
         target["area"] = area[keep]
         target["iscrowd"] = iscrowd[keep]
 
-        target["orig_size"] = torch.as_tensor([int(h), int(w)])
+        # orig_size is the annotated size, which the postprocessor rescales the predictions to
+        if scale is not None:
+            target["orig_size"] = torch.as_tensor([int(orig_size[1]), int(orig_size[0])])
+        else:
+            target["orig_size"] = torch.as_tensor([int(h), int(w)])
         target["size"] = torch.as_tensor([int(h), int(w)])
 
         return image, target
@@ -865,19 +939,24 @@ def build(image_set, args):
     use_text_labels = getattr(args, "use_text_labels", False)
 
     nouns_list, relations_list = None, None
+    noun_sampler = relation_sampler = None
     name2predicates = None
     if use_text_labels:
         if gpt4sgg_file is not None:
-            nouns_list = [line.split(',')[0] for line in \
-                    open(os.path.join(str(root), 'annotations', 'coco_nouns_gpt.txt'), 'r')]
-            relations_list = [line.split(',')[0] for line in \
-                    open(os.path.join(str(root), 'annotations', 'coco_relations_gpt.txt'), 'r')]
-            name2predicates = {name: idx+1 for idx, name in enumerate(relations_list)}
+            nouns_file = os.path.join(str(root), 'annotations', 'coco_nouns_gpt.txt')
+            relations_file = os.path.join(str(root), 'annotations', 'coco_relations_gpt.txt')
         else:
-            nouns_list = [line.split(',')[0] for line in \
-                    open(os.path.join(str(root), 'annotations', 'coco_nouns.txt'), 'r')]
-            relations_list = [line.split(',')[0] for line in \
-                    open(os.path.join(str(root), 'annotations', 'coco_relations.txt'), 'r')]
+            nouns_file = os.path.join(str(root), 'annotations', 'coco_nouns.txt')
+            relations_file = os.path.join(str(root), 'annotations', 'coco_relations.txt')
+        nouns_list = [line.split(',')[0] for line in open(nouns_file, 'r')]
+        relations_list = [line.split(',')[0] for line in open(relations_file, 'r')]
+        if gpt4sgg_file is not None:
+            name2predicates = {name: idx+1 for idx, name in enumerate(relations_list)}
+
+        neg_sampling_power = getattr(args, "neg_sampling_power", 0.0)
+        if neg_sampling_power != 0:
+            noun_sampler = VocabSampler.from_file(nouns_file, neg_sampling_power)
+            relation_sampler = VocabSampler.from_file(relations_file, neg_sampling_power)
 
     dataset = CocoDetection(img_folder, ann_file, 
             transforms=make_coco_transforms(image_set, 
@@ -893,7 +972,11 @@ def build(image_set, args):
             gpt4sgg_file=gpt4sgg_file,
             name2predicates=name2predicates,
             coco_ids_in_vg_file=getattr(args, "coco_ids_in_vg_file", 
-                os.path.join(str(root), "annotations", "coco_ids_in_vg_test.pth"))
+                os.path.join(str(root), "annotations", "coco_ids_in_vg_test.pth")),
+            noun_sampler=noun_sampler,
+            relation_sampler=relation_sampler,
+            draft_decode=getattr(args, "draft_decode", True),
+            image_shards=open_image_shards(data_path, image_set, args)
         )
 
     return dataset
@@ -5,20 +5,28 @@ import random
 import numpy as np
 import copy
 
-from PIL import Image
 from torchvision.datasets import Flickr30k
 
 from datasets.coco import make_coco_transforms
+from datasets.vocab_sampler import VocabSampler
+from datasets.image_io import get_decode_size, load_image
 
 
 class Flickr(torch.utils.data.Dataset):
     def __init__(self, root, ann_file,
             transforms, 
-            nouns_list=None, relations_list=None):
+            nouns_list=None, relations_list=None,
+            noun_sampler=None, relation_sampler=None,
+            draft_decode=False):
         self.transforms = transforms
+        # boxes are normalized, large JPEGs can be decoded at reduced resolution
+        self.decode_size = get_decode_size(transforms) if (draft_decode and transforms is not None) else None
         self.root = root
         self.nouns_list = nouns_list
         self.relations_list = relations_list
+        self.noun_sampler = noun_sampler if noun_sampler is not None else VocabSampler(nouns_list)
+        self.relation_sampler = relation_sampler if relation_sampler is not None \
+                                    else VocabSampler(relations_list)
 
         with open(ann_file, 'r') as fin:
             self.data = json.load(fin)
@@ -33,7 +41,7 @@ class Flickr(torch.utils.data.Dataset):
 
         # Image
         filename = os.path.join(self.root, img_id +'.jpg')
-        img = Image.open(filename).convert("RGB")
+        img, _ = load_image(filename, self.decode_size)
 
         rels = []
         boxes = []
@@ -64,8 +72,7 @@ class Flickr(torch.utils.data.Dataset):
         # sample negative phrases.
         gt_names = copy.deepcopy(target['gt_names'])
         neg_count = max(1, 80 - len(gt_names))
-        neg_names = list(set(self.nouns_list) - set(gt_names))
-        neg_sample = np.random.choice(neg_names, size=neg_count, replace=False).tolist()
+        neg_sample = self.noun_sampler.sample(neg_count, exclude=gt_names)
         nouns = gt_names + neg_sample
         random.shuffle(nouns)
         
@@ -76,8 +83,7 @@ class Flickr(torch.utils.data.Dataset):
             rels.append(rel[2])
         rels = list(set(rels))
         neg_count = max(1, 80 - len(rels))
-        neg_names = list(set(self.relations_list) - set(rels))
-        neg_sample = np.random.choice(neg_names, size=neg_count, replace=False).tolist()
+        neg_sample = self.relation_sampler.sample(neg_count, exclude=rels)
         rel_cap = rels + neg_sample
         target['rel_caption'] = '. '.join(rel_cap) + '.'
 
@@ -95,17 +101,28 @@ def build_flickr(image_set, args, nouns_list=None, relations_list=None):
         strong_aug=getattr(args, "strong_aug", False), 
         args=args)
 
+    noun_sampler = relation_sampler = None
     if nouns_list is None or relations_list is None:
         with open(os.path.join(args.data_path, "flickr30k/flickr30k_nouns.txt")) as fin:
             nouns_list = [line.split(',')[0] for line in fin]
         with open(os.path.join(args.data_path, "flickr30k/flickr30k_relations.txt")) as fin:
             relations_list = [line.split(',')[0] for line in fin]
 
+        neg_sampling_power = getattr(args, "neg_sampling_power", 0.0)
+        if neg_sampling_power != 0:
+            noun_sampler = VocabSampler.from_file(
+                os.path.join(args.data_path, "flickr30k/flickr30k_nouns.txt"), neg_sampling_power)
+            relation_sampler = VocabSampler.from_file(
+                os.path.join(args.data_path, "flickr30k/flickr30k_relations.txt"), neg_sampling_power)
+
     return Flickr(data_path, 
                   os.path.join(args.data_path, "flickr30k/flickr30k_triple_grounded.json"),
                   transforms=transforms,
                   nouns_list=nouns_list,
-                  relations_list=relations_list)
+                  relations_list=relations_list,
+                  noun_sampler=noun_sampler,
+                  relation_sampler=relation_sampler,
+                  draft_decode=getattr(args, "draft_decode", True))
 
 
 
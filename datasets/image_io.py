@@ -0,0 +1,80 @@
+"""
+Image decoding at the resolution the transforms need.
+
+The transforms resize every image to at most `max(scales)` on the short side
+(`max_size` on the long side) before anything else changes the resolution.
+JPEG images that are at least twice as large are decoded with PIL's draft mode,
+which downscales by 1/2, 1/4 or 1/8 in the DCT domain, while staying at or above
+that size, so the following resize sees the same content at less decoding cost.
+
+The decoded image is smaller than the annotated image: datasets scale their pixel
+boxes with box_scale() and keep `orig_size` at the annotated size.
+"""
+import torch
+from PIL import Image
+
+import datasets.transforms as T
+from datasets.samplers import estimate_resized_size
+
+
+def get_decode_size(transforms):
+    """
+    (min_size, max_size) of the largest resize of a T.Compose pipeline, None if the
+    pipeline does not start with resizes (e.g. crops first or fixed debug sizes),
+    then images are decoded at full resolution.
+    """
+    result = _resize_bound(transforms)
+    if result in (None, 'unsafe'):
+        return None
+    return result
+
+
+def _merge(a, b):
+    if a == 'unsafe' or b == 'unsafe':
+        return 'unsafe'
+    if a is None:
+        return b
+    if b is None:
+        return a
+    max_size = None if (a[1] is None or b[1] is None) else max(a[1], b[1])
+    return max(a[0], b[0]), max_size
+
+
+def _resize_bound(t):
+    if isinstance(t, T.RandomResize):
+        if not all(isinstance(s, int) for s in t.sizes):
+            return 'unsafe'
+        return max(t.sizes), t.max_size
+    if isinstance(t, T.RandomSelect):
+        return _merge(_resize_bound(t.transforms1), _resize_bound(t.transforms2))
+    if isinstance(t, T.Compose):
+        # the first resolution dependent transform of the pipeline has to be a resize
+        for sub in t.transforms:
+            if isinstance(sub, (T.RandomResize, T.RandomSelect, T.Compose)):
+                return _resize_bound(sub)
+            if isinstance(sub, (T.RandomSizeCrop, T.RandomCrop, T.CenterCrop, T.ResizeDebug, T.RandomPad)):
+                return 'unsafe'
+        return None
+    return None
+
+
+def load_image(path, decode_size=None):
+    """
+    Returns the RGB image and the (width, height) of the file, the image is smaller
+    than that when it was decoded in draft mode.
+    decode_size: (min_size, max_size) from get_decode_size, None decodes at full size.
+    """
+    img = Image.open(path)
+    w, h = img.size
+    if decode_size is not None and img.format == 'JPEG':
+        min_size, max_size = decode_size
+        rh, rw = estimate_resized_size(h, w, min_size, max_size)
+        if 2 * rw <= w and 2 * rh <= h:
+            img.draft('RGB', (rw, rh))
+    img = img.convert('RGB')
+    return img, (w, h)
+
+
+def box_scale(img, size):
+    """[sx, sy, sx, sy] from boxes in pixels of an image of size (w, h) to img"""
+    return torch.as_tensor([img.size[0] / size[0], img.size[1] / size[1]] * 2, dtype=torch.float32)
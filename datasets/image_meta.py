@@ -0,0 +1,119 @@
+"""
+Verified image metadata sidecar.
+
+The size of every image is read from its header only (PIL opens images lazily),
+in parallel over a process pool, together with the format, the file size and a
+crc32 of the file bytes. The result is written next to the image list as
+    <image_file stem>.meta.json  {"version": 1, "images": {name: {"width", "height",
+                                  "format", "bytes", "crc32"}}, "errors": {name: msg}}
+and trusted by VGDataset: the sizes of image_data.json are replaced by the
+verified ones, so neither the existence check of every file at startup nor the
+per-sample size check are needed anymore.
+
+Verify with:
+    python -m datasets.image_meta data/visual_genome/VG_100K \\
+        data/visual_genome/stanford_filtered/image_data.json --num_workers 32
+"""
+import json
+import os
+import zlib
+from multiprocessing import Pool
+
+from PIL import Image
+
+
+META_VERSION = 1
+
+
+def meta_file(image_file):
+    return os.path.splitext(image_file)[0] + '.meta.json'
+
+
+def read_image_meta(path, checksum=True, chunk_size=1 << 20):
+    """(name, meta, error) of an image file, the pixels are not decoded.
+    Missing files have neither meta nor error."""
+    name = os.path.basename(path)
+    if not os.path.exists(path):
+        return name, None, None
+    try:
+        with Image.open(path) as img:
+            meta = {'width': img.size[0], 'height': img.size[1], 'format': img.format}
+        meta['bytes'] = os.path.getsize(path)
+        if checksum:
+            crc = 0
+            with open(path, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(chunk_size), b''):
+                    crc = zlib.crc32(chunk, crc)
+            meta['crc32'] = crc & 0xffffffff
+    except (OSError, SyntaxError, ValueError) as e:
+        return name, None, '%s: %s' % (type(e).__name__, e)
+    return name, meta, None
+
+
+def _read_image_meta(args):
+    return read_image_meta(*args)
+
+
+def verify_images(paths, num_workers=16, checksum=True, log_every=10000):
+    """Reads the metadata of the images in a process pool, returns (images, errors)."""
+    images, errors = {}, {}
+    tasks = [(path, checksum) for path in paths]
+    with Pool(num_workers) as pool:
+        for i, (name, meta, error) in enumerate(pool.imap_unordered(_read_image_meta, tasks, chunksize=64)):
+            if error is not None:
+                errors[name] = error
+            elif meta is not None:
+                images[name] = meta
+            if log_every and (i + 1) % log_every == 0:
+                print("verified %d / %d images" % (i + 1, len(tasks)))
+    return images, errors
+
+
+def write_meta(path, images, errors):
+    data = {'version': META_VERSION, 'images': images, 'errors': errors}
+    with open(path + '.tmp', 'w') as fout:
+        json.dump(data, fout)
+    os.replace(path + '.tmp', path)
+
+
+def load_meta(path):
+    """sidecar dict (images, errors), None if it is missing or outdated"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fin:
+        data = json.load(fin)
+    if data.get('version') != META_VERSION:
+        return None
+    return data
+
+
+def verify_image_file(img_dir, image_file, num_workers=16, checksum=True):
+    """Verifies the images of a VG image_data.json style list and writes its sidecar."""
+    with open(image_file, 'r') as fin:
+        im_data = json.load(fin)
+    paths = [os.path.join(img_dir, '{}.jpg'.format(img['image_id'])) for img in im_data]
+    images, errors = verify_images(paths, num_workers, checksum)
+
+    wrong_size = 0
+    for img in im_data:
+        meta = images.get('{}.jpg'.format(img['image_id']))
+        if meta is not None and (meta['width'] != img['width'] or meta['height'] != img['height']):
+            wrong_size += 1
+    write_meta(meta_file(image_file), images, errors)
+    return len(images), len(errors), wrong_size
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser('Verify image sizes from the headers and write a metadata sidecar')
+    parser.add_argument('img_dir', type=str)
+    parser.add_argument('image_file', type=str, help='image list (json) with image_id, width, height')
+    parser.add_argument('--num_workers', type=int, default=16)
+    parser.add_argument('--no_checksum', action='store_true', help='do not read the file bytes')
+    opts = parser.parse_args()
+
+    num, num_errors, wrong_size = verify_image_file(opts.img_dir, opts.image_file, opts.num_workers,
+                                                    checksum=not opts.no_checksum)
+    print("verified %d images (%d unreadable, %d with a wrong size in %s) -> %s" % (
+        num, num_errors, wrong_size, opts.image_file, meta_file(opts.image_file)))
@@ -0,0 +1,236 @@
+"""
+Packed image shards.
+
+The images of a dataset split (VG, COCO, OpenImages) are packed once, in dataset
+order, with their annotations into a few large files
+    <prefix>-00000.bin, <prefix>-00001.bin, ...
+                      records: the image file bytes followed by a utf-8 json
+                      annotation (boxes, labels, edges, captions, width, height)
+    <prefix>.idx.npy  int64 (N, 4): shard, offset, image bytes, annotation bytes
+    <prefix>.keys.npy image keys (file name relative to the image folder)
+so training reads a handful of large files instead of hundreds of thousands of
+small JPEGs. ImageShards serves the images by key from read-only memmaps (random
+access, page cache shared by the dataloader workers), iter_shard() streams the
+records of a shard with plain sequential reads, and ShardSequentialSampler
+(datasets/samplers.py) orders the training indices shard by shard so random access
+turns into bulk sequential reads on network filesystems.
+
+The builders pick up the shards of a split if they exist (args.use_image_shards,
+default True) at <data_path>/<dataset>/shards/<image_set>. Pack with:
+    python tools/pack_shards.py -c config/GroundingDINO_SwinT_OGC_full.py \\
+        --pack_dataset vg --image_set train
+"""
+import io
+import json
+import os
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from datasets.image_io import load_image
+
+
+def shard_prefix(data_path, image_set):
+    return os.path.join(data_path, "shards", image_set)
+
+
+def shard_file(prefix, shard):
+    return "%s-%05d.bin" % (prefix, shard)
+
+
+def shards_exist(prefix):
+    return all(os.path.exists(prefix + ext) for ext in ('.idx.npy', '.keys.npy')) \
+        and os.path.exists(shard_file(prefix, 0))
+
+
+def open_image_shards(data_path, image_set, args):
+    """ImageShards of a split if they exist and args.use_image_shards (default True)"""
+    if not getattr(args, "use_image_shards", True):
+        return None
+    prefix = shard_prefix(data_path, image_set)
+    if not shards_exist(prefix):
+        return None
+    print("%s: reading images from packed shards %s" % (image_set, prefix))
+    return ImageShards(prefix)
+
+
+class ShardWriter(object):
+    """
+    Appends records to <prefix>-%05d.bin, starting a new shard once shard_bytes are
+    written. The index is written by close(); files are written under a .tmp name
+    and renamed at the end, so a partial packing is never picked up.
+    """
+
+    def __init__(self, prefix, shard_bytes=1 << 30):
+        self.prefix = prefix
+        self.shard_bytes = shard_bytes
+        self.index = []
+        self.keys = []
+        self._shard = -1
+        self._offset = 0
+        self._fout = None
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+
+    def _next_shard(self):
+        if self._fout is not None:
+            self._fout.close()
+        self._shard += 1
+        self._offset = 0
+        self._fout = open(shard_file(self.prefix, self._shard) + '.tmp', 'wb')
+
+    def add(self, key, image_bytes, annotation):
+        if self._fout is None or (self._offset > 0 and self._offset + len(image_bytes) > self.shard_bytes):
+            self._next_shard()
+        ann_bytes = json.dumps(annotation, separators=(',', ':')).encode('utf-8')
+        self._fout.write(image_bytes)
+        self._fout.write(ann_bytes)
+        self.index.append((self._shard, self._offset, len(image_bytes), len(ann_bytes)))
+        self.keys.append(key)
+        self._offset += len(image_bytes) + len(ann_bytes)
+
+    def close(self):
+        if self._fout is None:
+            self._next_shard()
+        self._fout.close()
+        self._fout = None
+
+        with open(self.prefix + '.idx.npy.tmp', 'wb') as fout:
+            np.save(fout, np.asarray(self.index, dtype=np.int64).reshape(-1, 4))
+        with open(self.prefix + '.keys.npy.tmp', 'wb') as fout:
+            # fixed-width strings, no pickled objects
+            np.save(fout, np.asarray(self.keys, dtype=np.str_))
+
+        for shard in range(self._shard + 1):
+            os.replace(shard_file(self.prefix, shard) + '.tmp', shard_file(self.prefix, shard))
+        for ext in ('.idx.npy', '.keys.npy'):
+            os.replace(self.prefix + ext + '.tmp', self.prefix + ext)
+        return len(self.keys)
+
+
+def _read_file(path):
+    with open(path, 'rb') as fin:
+        return fin.read()
+
+
+def pack_dataset(dataset, prefix, shard_bytes=1 << 30, num_threads=16, log_every=10000):
+    """
+    Packs every image of dataset into shards, in dataset order. The dataset provides
+    pack_record(index) -> (key, image path, annotation dict); the image files are
+    read ahead by num_threads threads.
+    """
+    writer = ShardWriter(prefix, shard_bytes)
+    records = (dataset.pack_record(index) for index in range(len(dataset)))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = []
+        for key, path, annotation in records:
+            pending.append((key, executor.submit(_read_file, path), annotation))
+            # bounded read ahead, records are written in order
+            if len(pending) >= 4 * num_threads:
+                key, data, annotation = pending.pop(0)
+                writer.add(key, data.result(), annotation)
+            if log_every and len(writer.keys) and len(writer.keys) % log_every == 0:
+                print("packed %d / %d images" % (len(writer.keys), len(dataset)))
+        for key, data, annotation in pending:
+            writer.add(key, data.result(), annotation)
+    return writer.close()
+
+
+def iter_shard(prefix, shard, buffer_bytes=64 << 20):
+    """Streams (key, image bytes, annotation) of a shard with sequential reads."""
+    index = np.load(prefix + '.idx.npy', mmap_mode='r')
+    keys = np.load(prefix + '.keys.npy', mmap_mode='r')
+    records = np.nonzero(np.asarray(index[:, 0]) == shard)[0]
+    with open(shard_file(prefix, shard), 'rb', buffering=buffer_bytes) as fin:
+        for i in records.tolist():
+            _, offset, image_len, ann_len = index[i].tolist()
+            fin.seek(offset)
+            image_bytes = fin.read(image_len)
+            annotation = json.loads(fin.read(ann_len).decode('utf-8'))
+            yield keys[i].item(), image_bytes, annotation
+
+
+class ImageShards(Sequence):
+    """
+    Random access to the records of packed shards, shards[i] returns
+    (key, image bytes, annotation). The memmaps are opened lazily in each process
+    and are not pickled, so the reader is cheap to send to dataloader workers.
+    """
+
+    def __init__(self, prefix):
+        assert shards_exist(prefix), "image shards %s.{idx.npy,keys.npy} do not exist!" % prefix
+        self.prefix = prefix
+        self._index = None
+        self._keys = None
+        self._shards = {}
+        self._lookup = None
+
+    def _open(self):
+        self._index = np.load(self.prefix + '.idx.npy', mmap_mode='r')
+        self._keys = np.load(self.prefix + '.keys.npy', mmap_mode='r')
+
+    def _shard(self, shard):
+        data = self._shards.get(shard)
+        if data is None:
+            data = np.memmap(shard_file(self.prefix, shard), dtype=np.uint8, mode='r')
+            self._shards[shard] = data
+        return data
+
+    @property
+    def num_shards(self):
+        if self._index is None:
+            self._open()
+        return int(self._index[:, 0].max()) + 1 if len(self._index) else 0
+
+    def __len__(self):
+        if self._index is None:
+            self._open()
+        return len(self._index)
+
+    def index(self, key):
+        """record index of an image key"""
+        if self._lookup is None:
+            if self._keys is None:
+                self._open()
+            self._lookup = {k: i for i, k in enumerate(self._keys.tolist())}
+        index = self._lookup.get(key)
+        if index is None:
+            raise KeyError("image %s is not in shards %s" % (key, self.prefix))
+        return index
+
+    def position(self, key):
+        """(shard, offset) of an image key, the order of sequential reads"""
+        shard, offset, _, _ = self._index[self.index(key)].tolist()
+        return shard, offset
+
+    def image_bytes(self, index):
+        if self._index is None:
+            self._open()
+        shard, offset, image_len, _ = self._index[index].tolist()
+        return self._shard(shard)[offset:offset + image_len].tobytes()
+
+    def annotation(self, index):
+        if self._index is None:
+            self._open()
+        shard, offset, image_len, ann_len = self._index[index].tolist()
+        start = offset + image_len
+        return json.loads(self._shard(shard)[start:start + ann_len].tobytes().decode('utf-8'))
+
+    def __getitem__(self, index):
+        if self._index is None:
+            self._open()
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self._keys[index].item(), self.image_bytes(index), self.annotation(index)
+
+    def load_image(self, key, decode_size=None):
+        """Same as datasets.image_io.load_image for the packed file of key."""
+        return load_image(io.BytesIO(self.image_bytes(self.index(key))), decode_size)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_index'] = state['_keys'] = state['_lookup'] = None
+        state['_shards'] = {}
+        return state
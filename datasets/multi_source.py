@@ -0,0 +1,213 @@
+"""
+Weighted, interleaved loading of the sources of a mixed training set (coco_vg,
+coco_flickr30k, coco_flickr30k_sbucaptions).
+
+Instead of one DataLoader shuffling a ConcatDataset, every source gets its own
+stream: a DataLoader with its own workers and prefetch depth over an endless,
+per rank, shuffled batch order of that source. Each training step takes the next
+batch of one source, drawn with the configured weights, so a slow source (e.g. SBU
+on network storage) is prefetched by its own workers and cannot hold up the
+batches of the others, and the mixing ratio no longer depends on the source sizes.
+
+Everything is a function of (seed, epoch, number of batches consumed per source):
+the source of every step is the same on all ranks, the order of a source is the
+DistributedSampler split of a permutation seeded by (seed, source, pass), and
+state_dict() / load_state_dict() resume the streams where a checkpoint left them.
+
+Enabled with --options multi_source=True; per source, in the order of build_dataset:
+    source_weights      sampling weights, default: proportional to the source sizes
+    source_num_workers  dataloader workers, default: num_workers split by weight
+    source_prefetch     batches prefetched per worker, default 2
+    source_num_batches  steps per epoch, default: batches of all sources in one pass
+"""
+import torch
+import torch.distributed as dist
+from torch.utils.data import ConcatDataset, DataLoader
+
+
+class SourceBatchSampler(torch.utils.data.Sampler):
+    """
+    Endless batches of one source. Pass p shuffles the source with seed
+    (seed, source, p), drops the tail so it splits evenly over the ranks, takes the
+    indices of rank (as DistributedSampler) and cuts them into full batches.
+    Starts at batch start_batch of the stream.
+    """
+
+    def __init__(self, num_indices, batch_size, source=0, seed=0, start_batch=0,
+                 num_replicas=1, rank=0, shuffle=True):
+        self.num_indices = num_indices
+        self.batch_size = batch_size
+        self.source = source
+        self.seed = seed
+        self.start_batch = start_batch
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.num_samples = num_indices // num_replicas
+        self.batches_per_pass = self.num_samples // batch_size
+        assert self.batches_per_pass > 0, \
+            "source %d has %d samples, less than one batch per rank" % (source, num_indices)
+
+    def pass_batches(self, p):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + 1000003 * self.source + p)
+            indices = torch.randperm(self.num_indices, generator=g).tolist()
+        else:
+            indices = list(range(self.num_indices))
+        indices = indices[:self.num_samples * self.num_replicas][self.rank::self.num_replicas]
+        return [indices[i * self.batch_size:(i + 1) * self.batch_size] for i in range(self.batches_per_pass)]
+
+    def __iter__(self):
+        p, skip = divmod(self.start_batch, self.batches_per_pass)
+        while True:
+            for batch in self.pass_batches(p)[skip:]:
+                yield batch
+            p, skip = p + 1, 0
+
+
+class MultiSourceLoader(object):
+    """
+    Iterates num_batches batches per epoch, each from one source, drawn with weights.
+    Exposes the DataLoader parts used by the training loop (dataset, len, set_epoch)
+    and state_dict() / load_state_dict() for checkpoints.
+
+    Args:
+        datasets: the sources
+        weights: sampling weight of every source
+        num_workers, prefetch: dataloader workers and prefetch_factor of every source
+        num_batches: steps per epoch, None: the batches of one pass over the drawn sources
+    """
+
+    def __init__(self, datasets, batch_size, weights, num_workers, prefetch, num_batches=None,
+                 collate_fn=None, seed=0, num_replicas=None, rank=None, pin_memory=True):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        assert len(weights) == len(datasets) == len(num_workers) == len(prefetch)
+        assert all(w >= 0 for w in weights) and sum(weights) > 0
+
+        self.datasets = datasets
+        self.dataset = ConcatDataset(datasets)
+        self.batch_size = batch_size
+        self.weights = [float(w) for w in weights]
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.num_batches = num_batches
+        self.collate_fn = collate_fn
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pin_memory = pin_memory
+        if not self.num_batches:
+            self.num_batches = sum(self._batch_sampler(i).batches_per_pass
+                                   for i, w in enumerate(self.weights) if w > 0)
+
+        self.epoch = 0
+        self.step = 0
+        self.consumed = [0] * len(datasets)
+        self._iters = None
+
+    def __len__(self):
+        return self.num_batches
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.step = 0
+
+    def schedule(self, epoch):
+        """source of every step of an epoch, the same on all ranks"""
+        g = torch.Generator()
+        g.manual_seed(self.seed + epoch)
+        return torch.multinomial(torch.tensor(self.weights), self.num_batches,
+                                 replacement=True, generator=g).tolist()
+
+    def _batch_sampler(self, source, start_batch=0):
+        return SourceBatchSampler(len(self.datasets[source]), self.batch_size, source=source,
+                                  seed=self.seed, start_batch=start_batch,
+                                  num_replicas=self.num_replicas, rank=self.rank)
+
+    def _loader(self, source):
+        batch_sampler = self._batch_sampler(source, self.consumed[source])
+        # deterministic worker seeds
+        g = torch.Generator()
+        g.manual_seed(self.seed + 1000003 * source + self.rank)
+        kw = dict(prefetch_factor=self.prefetch[source]) if self.num_workers[source] > 0 else {}
+        return DataLoader(self.datasets[source], batch_sampler=batch_sampler, collate_fn=self.collate_fn,
+                          num_workers=self.num_workers[source], pin_memory=self.pin_memory,
+                          generator=g, **kw)
+
+    def _stream(self, source):
+        if self._iters is None:
+            self._iters = [None] * len(self.datasets)
+        if self._iters[source] is None:
+            self._iters[source] = iter(self._loader(source))
+        return self._iters[source]
+
+    def __iter__(self):
+        schedule = self.schedule(self.epoch)
+        # start the workers of every source drawn in this epoch, so that all of them
+        # prefetch from the first step on; sources that are not drawn spawn no workers
+        for source in sorted(set(schedule[self.step:])):
+            self._stream(source)
+        while self.step < self.num_batches:
+            source = schedule[self.step]
+            batch = next(self._stream(source))
+            self.consumed[source] += 1
+            self.step += 1
+            yield batch
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'step': self.step, 'consumed': list(self.consumed),
+                'weights': list(self.weights), 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        if len(state['consumed']) != len(self.datasets):
+            print("multi source loader: %d sources in the checkpoint, %d now, not resumed" % (
+                  len(state['consumed']), len(self.datasets)))
+            return
+        self.epoch = state['epoch']
+        self.step = state['step']
+        self.consumed = list(state['consumed'])
+        # the streams restart at the restored positions
+        self._iters = None
+
+    def stats(self):
+        return {'weights': self.weights, 'num_workers': self.num_workers, 'prefetch': self.prefetch,
+                'num_batches': self.num_batches, 'sizes': [len(d) for d in self.datasets]}
+
+
+def _per_source(value, num, default):
+    if value is None:
+        return [default] * num
+    if isinstance(value, (list, tuple)):
+        assert len(value) == num, "%d values for %d sources" % (len(value), num)
+        return list(value)
+    return [value] * num
+
+
+def build_multi_source_loader(dataset, args, collate_fn=None, seed=0):
+    """MultiSourceLoader over the sources of a ConcatDataset, None for a single source."""
+    if not isinstance(dataset, ConcatDataset) or len(dataset.datasets) < 2:
+        return None
+    datasets = dataset.datasets
+    num = len(datasets)
+
+    weights = _per_source(getattr(args, 'source_weights', None), num, None)
+    if any(w is None for w in weights):
+        weights = [len(d) for d in datasets]
+    total = float(sum(weights))
+
+    num_workers = getattr(args, 'source_num_workers', None)
+    if num_workers is None:
+        # the workers of --num_workers, split by weight, at least one per drawn source
+        num_workers = [max(1, int(round(args.num_workers * w / total))) if w > 0 and args.num_workers > 0 else 0
+                       for w in weights]
+    num_workers = _per_source(num_workers, num, 0)
+    prefetch = _per_source(getattr(args, 'source_prefetch', None), num, 2)
+
+    return MultiSourceLoader(datasets, args.batch_size, weights, num_workers, prefetch,
+                             num_batches=getattr(args, 'source_num_batches', None),
+                             collate_fn=collate_fn, seed=seed)
@@ -25,6 +25,11 @@ from util.bounding_box import BoxList
 from pycocotools.coco import COCO
 
 from datasets.coco import make_coco_transforms
+from datasets.class_hierarchy import ClassHierarchyIndex
+from datasets.ann_store import IndexedAnnotationStore, store_prefix, store_exists
+from datasets.vocab_sampler import VocabSampler
+from datasets.image_io import get_decode_size, load_image
+from datasets.image_shards import open_image_shards
 
 
 def preprocess_caption(caption: str) -> str: 
@@ -51,6 +56,8 @@ Args:
    label2cls_file: label id - name
    img_level_ann_file:
    hierarch_file: 
+   use_ann_store: load annotations from the indexed store next to ann_file
+                  (see datasets/ann_store.py) if it exists
 """
 class OICAPDataset(torch.utils.data.Dataset):
     def __init__(self, img_dir, ann_file, 
@@ -62,15 +69,29 @@ class OICAPDataset(torch.utils.data.Dataset):
                  use_text_labels=False,
                  do_text_shuffle=True,
                  nouns_list=None,
-                 relations_list=None):
+                 relations_list=None,
+                 use_ann_store=True,
+                 noun_sampler=None,
+                 relation_sampler=None,
+                 draft_decode=False,
+                 image_shards=None):
         super().__init__()
         self.img_dir = img_dir
-        data = read_json(ann_file)
-
-        self.images = data
+        # packed images (datasets/image_shards.py) are read instead of img_dir
+        self.image_shards = image_shards
+        ann_store_prefix = store_prefix(ann_file)
+        if use_ann_store and store_exists(ann_store_prefix):
+            # records are decoded lazily from a memmap shared by all workers
+            self.images = IndexedAnnotationStore(ann_store_prefix)
+            print("OpenImages: using indexed annotation store %s" % ann_store_prefix)
+        else:
+            self.images = read_json(ann_file)
+        self.uses_ann_store = isinstance(self.images, IndexedAnnotationStore)
         self.transforms = transforms
         if self.transforms is None:
             print("Warning : transforms is None ")
+        # large JPEGs are decoded at reduced resolution, see datasets/image_io.py
+        self.decode_size = get_decode_size(transforms) if (draft_decode and transforms is not None) else None
 
         with open(label2cls_file, 'rb') as fin:
             self.label2cls = pickle.load(fin)
@@ -86,6 +107,10 @@ class OICAPDataset(torch.utils.data.Dataset):
             self.name2classes = {v['name'].lower(): int(v['idx'])  for k, v in self.label2cls.items() if v['name'] != '__background__'}
             self.class2name = {v: k for k, v in self.name2classes.items()}
 
+            self.noun_sampler = noun_sampler if noun_sampler is not None else VocabSampler(nouns_list)
+            self.relation_sampler = relation_sampler if relation_sampler is not None \
+                                        else VocabSampler(relations_list)
+
         self.img_info_file = img_info_file
         if self.img_info_file is not None:
             with open(img_info_file, 'rb') as fin:
@@ -106,12 +131,15 @@ class OICAPDataset(torch.utils.data.Dataset):
         assert hierarchy_file is not None, "hierarchy_file should not be None!"
         # label2cls start from 1 instead of 0
         self.relation_matrix = self._get_relation_matrix(self.hierarchy_file, self.num_classes+1)
+        self.hierarchy = ClassHierarchyIndex(self.relation_matrix)
 
-        self.ids = [item['image_id'] for item in self.images]
         self._coco = None 
-
-        for image in self.images:
-            image['id'] = image['image_id']
+        if self.uses_ann_store:
+            self.ids = self.images.ids
+        else:
+            self.ids = [item['image_id'] for item in self.images]
+            for image in self.images:
+                image['id'] = image['image_id']
 
         #  label start from 1 to 601
         self.ind_to_classes = ['__background__'] + [v['name'] for k, v in self.label2cls.items()]
@@ -130,36 +158,31 @@ class OICAPDataset(torch.utils.data.Dataset):
         if self._coco is None:
             # for custom datasets
             _coco = COCO()
+            images = list(self.images)
+            if self.uses_ann_store:
+                for image in images:
+                    image['id'] = image['image_id']
             coco_dicts = dict(
-                            images=self.images, 
+                            images=images, 
                             annotations=[],
                             categories=self.categories)
             
-            for index, ann in enumerate(self.images):
+            for index, ann in enumerate(images):
                 img_id = ann['image_id']
                 assert self.img_info is not None, " img_info_file cannot be None!"
                 ih, iw = self.img_info[img_id]['orig_size']
 
                 scale_fct = torch.tensor([iw, ih, iw, ih])
-                gt_boxes, gt_classes, relation = self.get_groundtruth(index)
+                gt_boxes, gt_classes, relation = self.get_groundtruth(index, item=ann)
                 gt_boxes = gt_boxes * scale_fct
                 gt_boxes   = gt_boxes.numpy()
                 gt_classes = gt_classes.numpy()
 
                 # add supercategories to gt. 
-                is_group_ofs = np.array(self.images[index]['is_group_of'], dtype=bool)
-                gt_labels_unique = np.unique(gt_classes)
-                for label in gt_labels_unique:
-                    super_labels = np.where(self.relation_matrix[label])[0]
-                    for cls in super_labels:
-                        if cls == label:
-                            continue
-                        idx = np.where(gt_classes == label)[0]
-                        gt_boxes = np.concatenate((gt_boxes, gt_boxes[idx]))
-                        extend_labels = np.full(idx.shape, cls, dtype=np.int64)
-                        gt_classes = np.concatenate((gt_classes, extend_labels))
-                        is_group_ofs = np.concatenate((is_group_ofs, is_group_ofs[idx]))
-
+                is_group_ofs = np.array(ann['is_group_of'], dtype=bool)
+                src_idx, gt_classes = self.hierarchy.expand(gt_classes)
+                gt_boxes = gt_boxes[src_idx]
+                is_group_ofs = is_group_ofs[src_idx]
 
                 for box, cls, is_group_of in zip(gt_boxes, gt_classes, is_group_ofs):
                     item = {
@@ -182,23 +205,53 @@ class OICAPDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.images)
 
+    def get_img_info(self, index):
+        item = self.images[index]
+        if 'height' in item and 'width' in item:
+            return {'height': item['height'], 'width': item['width']}
+        if self.img_info is not None:
+            ih, iw = self.img_info[item['image_id']]['orig_size']
+            return {'height': ih, 'width': iw}
+        return None
+
+    def image_key(self, index, item=None):
+        if item is None:
+            item = self.images[index]
+        return '%s.jpg' % item['image_id']
+
+    def get_shard_position(self, index):
+        if self.image_shards is None:
+            return None
+        return self.image_shards.position(self.image_key(index))
+
+    def pack_record(self, index):
+        """(key, image path, annotation) of an image for datasets/image_shards.py,
+        the annotation is the record of the image (normalized boxes, labels, relations)"""
+        item = self.images[index]
+        key = self.image_key(index, item)
+        return key, os.path.join(self.img_dir, key), item
+
     def __getitem__(self, index):
         item = self.images[index]
         
-        img_name = os.path.join(self.img_dir, '%s.jpg' % item['image_id'])
-        image = Image.open(img_name).convert("RGB")
+        img_name = os.path.join(self.img_dir, self.image_key(index, item))
+        if self.image_shards is not None:
+            image, (fw, fh) = self.image_shards.load_image(self.image_key(index, item), self.decode_size)
+        else:
+            image, (fw, fh) = load_image(img_name, self.decode_size)
         assert image is not None, "image:%s is None!" % img_name
 
+        # boxes are normalized to the decoded image, orig_size is the size of the file
         iw, ih = image.size
 
         target = dict(image_id=item['image_id'])
 
-        gt_boxes, gt_classes, relation = self.get_groundtruth(index)
+        gt_boxes, gt_classes, relation = self.get_groundtruth(index, item=item)
 
         target["iscrowd"] = torch.zeros(gt_boxes.shape[0])
         target['labels'] = gt_classes
         target['boxes'] = gt_boxes * torch.tensor([iw, ih, iw, ih]).reshape(1, 4)
-        target["orig_size"] = torch.tensor([ih, iw])
+        target["orig_size"] = torch.tensor([fh, fw])
         target['is_occluded'] = item['is_occluded']
         target['is_truncated'] = item['is_truncated']
         target['is_group_of'] = item['is_group_of']
@@ -226,11 +279,8 @@ class OICAPDataset(torch.utils.data.Dataset):
 
             target['gt_names'] = copy.deepcopy(nouns) #gt_sample
 
-            neg_names = list(set(self.nouns_list) - set(nouns))
-            neg_sample = []
-
             neg_count = max(1, 80 - len(gt_sample))
-            neg_sample = np.random.choice(neg_names, size=neg_count, replace=False).tolist()
+            neg_sample = self.noun_sampler.sample(neg_count, exclude=nouns)
 
             nouns = gt_sample + neg_sample
             nouns = list(set(nouns))
@@ -242,11 +292,8 @@ class OICAPDataset(torch.utils.data.Dataset):
             target['caption'] = preprocess_caption(target['caption'])
 
             # rel
-            neg_rels = list(set(self.relations_list) - set(rels))
-            neg_rel_sample = []
-
             neg_count = max(1, 80 - len(rels))
-            neg_rel_sample = np.random.choice(neg_rels, size=neg_count, replace=False).tolist()
+            neg_rel_sample = self.relation_sampler.sample(neg_count, exclude=rels)
 
             target['gt_rels'] = copy.deepcopy(rels)
             rels = rels + neg_rel_sample
@@ -256,9 +303,10 @@ class OICAPDataset(torch.utils.data.Dataset):
 
         return image, target 
 
-    def get_groundtruth(self, index):
+    def get_groundtruth(self, index, item=None):
         relation = None
-        item = self.images[index]
+        if item is None:
+            item = self.images[index]
 
         gt_boxes = torch.tensor(item['bboxes'], dtype=torch.float)
         gt_classes = torch.tensor([self.label2cls[e]['idx'] for e in item['labels']], dtype=torch.long)
@@ -406,8 +454,10 @@ def build_oicap(image_set, args, disable_transforms=False):
     hierarchy_file= os.path.join(data_path, "annotations/bbox_labels_600_hierarchy.json")
 
     use_text_labels = getattr(args, "use_text_labels", False)
+    use_ann_store = getattr(args, "oi_use_ann_store", True)
 
     nouns_list, relations_list = None, None
+    noun_sampler = relation_sampler = None
     if use_text_labels:
         oi_nouns_file = getattr(args, "oi_nouns_file", 
                                 os.path.join(data_path, "annotations/oi-nouns.txt")
@@ -425,6 +475,11 @@ def build_oicap(image_set, args, disable_transforms=False):
             nouns_list = relations_list = []
             print("Warning: nouns_list and relations_list are empty!")
 
+        neg_sampling_power = getattr(args, "neg_sampling_power", 0.0)
+        if neg_sampling_power != 0 and len(nouns_list) > 0 and len(relations_list) > 0:
+            noun_sampler = VocabSampler.from_file(oi_nouns_file, neg_sampling_power)
+            relation_sampler = VocabSampler.from_file(oi_relations_file, neg_sampling_power)
+
     return OICAPDataset(img_dir=img_dir, ann_file=ann_file, 
                         label2cls_file=label2cls_file,
                         img_info_file=img_info_file,
@@ -435,7 +490,12 @@ def build_oicap(image_set, args, disable_transforms=False):
                         hierarchy_file=hierarchy_file,
                         use_text_labels=use_text_labels,
                         nouns_list=nouns_list,
-                        relations_list=relations_list
+                        relations_list=relations_list,
+                        use_ann_store=use_ann_store,
+                        noun_sampler=noun_sampler,
+                        relation_sampler=relation_sampler,
+                        draft_decode=getattr(args, "draft_decode", True),
+                        image_shards=open_image_shards(data_path, image_set, args)
                         )
 
 
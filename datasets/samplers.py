@@ -0,0 +1,332 @@
+"""
+Batch samplers for training.
+
+TokenBudgetBatchSampler packs images into batches under a budget on the padded
+pixel count (batch_size * max_h * max_w after resizing) instead of using a fixed
+batch size, so the memory used by a batch is bounded and padding is reduced.
+
+ShardSequentialSampler visits the images of packed shards (datasets/image_shards.py)
+shard by shard in shuffled blocks of consecutive records, so they are read sequentially.
+"""
+import math
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import ConcatDataset, Subset
+
+
+def estimate_resized_size(height, width, min_size=800, max_size=1333):
+    """(h, w) of an image after T.RandomResize([min_size], max_size), i.e. the largest
+    size the training/eval transforms can produce. Mirrors datasets.transforms.resize."""
+    size = min_size
+    if max_size is not None:
+        min_original_size = float(min(width, height))
+        max_original_size = float(max(width, height))
+        if max_original_size / min_original_size * size > max_size:
+            size = int(round(max_size * min_original_size / max_original_size))
+
+    if (width <= height and width == size) or (height <= width and height == size):
+        return height, width
+
+    if width < height:
+        return int(size * height / width), size
+    return size, int(size * width / height)
+
+
+def get_dataset_image_sizes(dataset, default_size=None):
+    """
+    Return a list of original (height, width) for every sample of dataset.
+    Datasets expose their sizes through get_img_info(index) -> dict(height=, width=);
+    ConcatDataset and Subset are unrolled. Samples without size info get default_size.
+    """
+    if isinstance(dataset, ConcatDataset):
+        sizes = []
+        for d in dataset.datasets:
+            sizes.extend(get_dataset_image_sizes(d, default_size))
+        return sizes
+
+    if isinstance(dataset, Subset):
+        sizes = get_dataset_image_sizes(dataset.dataset, default_size)
+        return [sizes[i] for i in dataset.indices]
+
+    get_img_info = getattr(dataset, "get_img_info", None)
+    sizes = []
+    for idx in range(len(dataset)):
+        info = get_img_info(idx) if get_img_info is not None else None
+        if info is None or info.get("height") is None or info.get("width") is None:
+            sizes.append(default_size)
+        else:
+            sizes.append((int(info["height"]), int(info["width"])))
+    return sizes
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Packs dataset indices into batches whose padded area (num_images * max_h * max_w)
+    stays under max_pixels. Images are grouped by aspect ratio (landscape / portrait)
+    and sorted by size within windows of sort_window indices before packing, then the
+    batches are shuffled.
+
+    Follows the DistributedSampler semantics: every rank builds the same global list of
+    batches from seed + epoch, the list is made divisible by num_replicas and each rank
+    takes every num_replicas-th batch, so all ranks run the same number of steps.
+    Call set_epoch(epoch) before each epoch.
+
+    Args:
+        image_sizes: list of (h, w) in pixels as seen by the model (after resizing)
+        max_pixels: budget on num_images * max_h * max_w of a batch
+        max_batch_size: optional cap on the number of images per batch
+    """
+
+    def __init__(self, image_sizes, max_pixels, max_batch_size=None, shuffle=True,
+                 group_by_aspect_ratio=True, sort_window=1000,
+                 num_replicas=None, rank=None, seed=0, drop_last=False):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+        self.image_sizes = image_sizes
+        self.max_pixels = max_pixels
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.group_by_aspect_ratio = group_by_aspect_ratio
+        self.sort_window = sort_window
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        self._batches = None
+        self.padding_efficiency = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _pack(self, indices):
+        # greedy packing of indices sorted by size
+        batches = []
+        batch, max_h, max_w = [], 0, 0
+        for idx in indices:
+            h, w = self.image_sizes[idx]
+            new_h, new_w = max(max_h, h), max(max_w, w)
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (full or (len(batch) + 1) * new_h * new_w > self.max_pixels):
+                batches.append(batch)
+                batch, new_h, new_w = [], h, w
+            batch.append(idx)
+            max_h, max_w = new_h, new_w
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _build_batches(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        if self.shuffle:
+            order = torch.randperm(len(self.image_sizes), generator=g).tolist()
+        else:
+            order = list(range(len(self.image_sizes)))
+
+        groups = {}
+        for idx in order:
+            h, w = self.image_sizes[idx]
+            key = (w >= h) if self.group_by_aspect_ratio else 0
+            groups.setdefault(key, []).append(idx)
+
+        batches = []
+        for key in sorted(groups):
+            group = groups[key]
+            for start in range(0, len(group), self.sort_window):
+                window = sorted(group[start: start + self.sort_window],
+                                key=lambda i: (self.image_sizes[i][0], self.image_sizes[i][1]))
+                batches.extend(self._pack(window))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+
+        # make the number of batches divisible by the number of replicas
+        if self.drop_last:
+            num_batches = len(batches) // self.num_replicas * self.num_replicas
+            batches = batches[:num_batches]
+        else:
+            num_batches = int(math.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+            batches += batches[: num_batches - len(batches)]
+
+        batches = batches[self.rank:num_batches:self.num_replicas]
+
+        valid, padded = 0, 0
+        for batch in batches:
+            hs = [self.image_sizes[i][0] for i in batch]
+            ws = [self.image_sizes[i][1] for i in batch]
+            valid += sum(h * w for h, w in zip(hs, ws))
+            padded += len(batch) * max(hs) * max(ws)
+        self.padding_efficiency = valid / padded if padded > 0 else 1.0
+
+        return batches
+
+    def get_batches(self):
+        if self._batches is None:
+            self._batches = self._build_batches()
+        return self._batches
+
+    def stats(self):
+        batches = self.get_batches()
+        num_images = sum(len(b) for b in batches)
+        return {
+            'num_batches': len(batches),
+            'mean_batch_size': num_images / max(len(batches), 1),
+            'padding_efficiency': self.padding_efficiency,
+        }
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield batch
+
+    def __len__(self):
+        return len(self.get_batches())
+
+
+def build_token_budget_batch_sampler(dataset, args, seed=0):
+    """Build a TokenBudgetBatchSampler for dataset from the config (batch_max_pixels, ...)."""
+    scales = getattr(args, 'data_aug_scales', [480, 512, 544, 576, 608, 640, 672, 704, 736, 768, 800])
+    max_size = getattr(args, 'data_aug_max_size', 1333)
+    min_size = max(scales)
+
+    default_size = getattr(args, 'batch_default_img_size', (max_size, max_size))
+    sizes = get_dataset_image_sizes(dataset, default_size=tuple(default_size))
+    sizes = [estimate_resized_size(h, w, min_size, max_size) for h, w in sizes]
+
+    return TokenBudgetBatchSampler(
+        sizes,
+        max_pixels=args.batch_max_pixels,
+        max_batch_size=getattr(args, 'batch_max_images', None),
+        shuffle=True,
+        group_by_aspect_ratio=getattr(args, 'batch_group_by_aspect_ratio', True),
+        seed=seed,
+        drop_last=True,
+    )
+
+
+def get_dataset_shard_positions(dataset):
+    """
+    (shard, offset) of every sample of dataset in its packed image shards
+    (datasets/image_shards.py), None for samples read from single files.
+    Datasets expose get_shard_position(index); the shards of the datasets of a
+    ConcatDataset get distinct shard numbers.
+    """
+    if isinstance(dataset, ConcatDataset):
+        positions, shard_base = [], 0
+        for d in dataset.datasets:
+            sub = get_dataset_shard_positions(d)
+            positions.extend(None if p is None else (shard_base + p[0], p[1]) for p in sub)
+            shard_base += 1 + max([p[0] for p in sub if p is not None], default=-1)
+        return positions
+
+    if isinstance(dataset, Subset):
+        positions = get_dataset_shard_positions(dataset.dataset)
+        return [positions[i] for i in dataset.indices]
+
+    get_shard_position = getattr(dataset, "get_shard_position", None)
+    if get_shard_position is None:
+        return [None] * len(dataset)
+    return [get_shard_position(idx) for idx in range(len(dataset))]
+
+
+class ShardSequentialSampler(torch.utils.data.Sampler):
+    """
+    Samples the indices of packed datasets shard by shard so the images are read
+    in large sequential chunks instead of by random access.
+
+    Every epoch the shards are visited in a random order; within a shard the records
+    are cut into blocks of block_size consecutive records, the blocks are visited in a
+    random order and the indices of a block are shuffled. Samples that are not packed
+    form one extra pseudo shard. Follows the DistributedSampler semantics: every rank
+    builds the same global order from seed + epoch, which is made divisible by
+    num_replicas, and each rank takes one contiguous part of it.
+    Call set_epoch(epoch) before each epoch.
+
+    Args:
+        positions: (shard, offset) of every index or None, see get_dataset_shard_positions
+        block_size: number of consecutive records shuffled together
+    """
+
+    def __init__(self, positions, block_size=64, shuffle=True,
+                 num_replicas=None, rank=None, seed=0, drop_last=True):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.block_size = block_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        shards = {}
+        for idx, position in enumerate(positions):
+            shard, offset = position if position is not None else (-1, idx)
+            shards.setdefault(shard, []).append((offset, idx))
+        # indices of every shard in file order
+        self.shards = [[idx for _, idx in sorted(shards[s])] for s in sorted(shards)]
+        self.num_indices = len(positions)
+
+        if self.drop_last:
+            self.num_samples = self.num_indices // self.num_replicas
+        else:
+            self.num_samples = int(math.ceil(self.num_indices / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _build_indices(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        shard_order = range(len(self.shards))
+        if self.shuffle:
+            shard_order = torch.randperm(len(self.shards), generator=g).tolist()
+
+        indices = []
+        for s in shard_order:
+            shard = self.shards[s]
+            blocks = [shard[start: start + self.block_size] for start in range(0, len(shard), self.block_size)]
+            if self.shuffle:
+                blocks = [blocks[i] for i in torch.randperm(len(blocks), generator=g).tolist()]
+            for block in blocks:
+                if self.shuffle:
+                    block = [block[i] for i in torch.randperm(len(block), generator=g).tolist()]
+                indices.extend(block)
+
+        if self.total_size <= len(indices):
+            indices = indices[:self.total_size]
+        else:
+            indices += indices[:self.total_size - len(indices)]
+
+        # contiguous parts keep the reads of a rank sequential
+        return indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+
+    def __iter__(self):
+        return iter(self._build_indices())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def build_shard_sequential_sampler(dataset, args, seed=0):
+    """ShardSequentialSampler for dataset, None if none of its images are packed."""
+    positions = get_dataset_shard_positions(dataset)
+    if all(p is None for p in positions):
+        return None
+    return ShardSequentialSampler(positions,
+                                  block_size=getattr(args, 'shard_block_size', 64),
+                                  shuffle=True,
+                                  seed=seed,
+                                  drop_last=True)
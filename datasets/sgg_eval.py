@@ -27,6 +27,8 @@ import pycocotools.mask as mask_util
 import torch.distributed as dist
 from util.misc import get_rank, all_gather, get_world_size
 from util import box_ops
+from .class_hierarchy import ClassHierarchyIndex
+from .box_eval import IncrementalBoxEvaluator
 
 
 from concurrent.futures import ThreadPoolExecutor 
@@ -38,7 +40,8 @@ import threading
 from .sgg_metrics import (SGRecall, SGNoGraphConstraintRecall, SGZeroShotRecall, 
                         OvdSGZeroShotRecall, OvrSGZeroShotRecall,
                         SGNGZeroShotRecall, SGPairAccuracy, SGMeanRecall, 
-                        SGNGMeanRecall, SGAccumulateRecall)
+                        SGNGMeanRecall, SGAccumulateRecall,
+                        MetricSums, synchronize_metric_sums)
 
 __all__ = ["SggEvaluator"]
 
@@ -83,11 +86,14 @@ class SggEvaluator(object):
                 output_folder=None,
                 num_workers=4,
                 ovd_enabled=False,
-                ovr_enabled=False
+                ovr_enabled=False,
+                incremental_bbox_eval=True
                 ):
         """
             @iou_types: 'bbox'
             @mode: predcls, sgcls, sgdet
+            @incremental_bbox_eval: evaluate boxes with the array based IncrementalBoxEvaluator
+                                    instead of COCO.loadRes + COCOEval per batch (same stats)
         """
         assert isinstance(iou_types, (list, tuple))
 
@@ -97,6 +103,11 @@ class SggEvaluator(object):
             self.is_oiv6 = self.dataset.relation_matrix is not None
         except:
             pass
+        if self.is_oiv6:
+            self.hierarchy = getattr(self.dataset, 'hierarchy', None)
+            if self.hierarchy is None:
+                self.hierarchy = ClassHierarchyIndex(self.dataset.relation_matrix)
+        self._id_to_index = None
 
         self.mode = mode 
         assert self.mode in ['predcls', 'sgcls', 'sgdet', 'det']
@@ -123,6 +134,10 @@ class SggEvaluator(object):
             if self.is_oiv6:
                 self.coco_eval['bbox'].params.maxDets = [1, 10, 300]
 
+        self.box_evaluator = None
+        if 'bbox' in iou_types and incremental_bbox_eval and self.useCats:
+            self.box_evaluator = IncrementalBoxEvaluator(self.coco_gt, self.coco_eval['bbox'].params)
+
         if 'relation' in iou_types:
             self.do_sgg = True
         else:
@@ -159,6 +174,9 @@ class SggEvaluator(object):
         if 'bbox' in self.coco_eval:
             self.coco_eval['bbox'].gt_dt_valid = {}
 
+        if self.box_evaluator is not None:
+            self.box_evaluator.reset()
+
 
 
     def update(self, predictions):
@@ -176,10 +194,21 @@ class SggEvaluator(object):
         self.pending_tasks.append(self.executor.submit(update_relation_fn))        
 
 
+    def index_of(self, image_id):
+        """Dataset index of image_id (dataset.ids.index without the linear scan)."""
+        if self._id_to_index is None:
+            self._id_to_index = {img_id: index for index, img_id in enumerate(self.dataset.ids)}
+        return self._id_to_index[image_id]
+
     def update_coco(self, predictions):
         if 'bbox' not in self.iou_types:
             return 
 
+        if self.box_evaluator is not None:
+            for image_id, boxes, scores, labels in self.prepare_box_pred(predictions):
+                self.box_evaluator.update(image_id, boxes, scores, labels)
+            return
+
         img_ids = list(np.unique(list(predictions.keys())))
 
         coco_res = self.prepare_coco_pred(predictions)
@@ -207,7 +236,7 @@ class SggEvaluator(object):
                 if 'graph' not in prediction:
                     self.do_sgg = False 
                     return 
-                index = self.dataset.ids.index(image_id)
+                index = self.index_of(image_id)
                 groundtruth = {}
                 gt_boxes, gt_labels, gt_edges = self.dataset.get_groundtruth(index)
 
@@ -289,11 +318,10 @@ class SggEvaluator(object):
 
         return result_dict, evaluator
 
-    def prepare_coco_pred(self, predictions):
-        coco_results = []
+    def prepare_box_pred(self, predictions):
+        """(image_id, xywh boxes, scores, labels) numpy arrays of every non-empty prediction."""
         for original_id, prediction in predictions.items():
             if len(prediction) == 0:
-                coco_results.append([])
                 continue
 
             pred_boxes = copy.deepcopy(prediction["boxes"]).cpu()
@@ -302,57 +330,29 @@ class SggEvaluator(object):
             pred_labels = copy.deepcopy(prediction["labels"]).cpu().numpy()
             # add supercategories to gt
             if self.is_oiv6:     
-                get_supercategory = True 
-                filter_labels = True 
-                index = self.dataset.ids.index(original_id)
-                gt_boxes_, gt_labels_, gt_edges_ = self.dataset.get_groundtruth(index) 
-                gt_boxes, gt_labels, gt_edges = copy.deepcopy(gt_boxes_), copy.deepcopy(gt_labels_), copy.deepcopy(gt_edges_)
-                gt_labels_unique = np.unique(gt_labels)
-
-                for label in gt_labels_unique:
-                    super_labels = np.where(self.dataset.relation_matrix[label])[0]
-                    for cls in super_labels:
-                        if cls == label:
-                            continue
-                        idx = np.where(gt_labels == label)[0]
-                        gt_boxes = np.concatenate((gt_boxes, gt_boxes[idx]))
-                        extend_labels = np.full(idx.shape, cls, dtype=np.int64)
-                        gt_labels = np.concatenate((gt_labels, extend_labels))
+                index = self.index_of(original_id)
+                _, gt_labels, _ = self.dataset.get_groundtruth(index) 
+                gt_labels = np.asarray(gt_labels, dtype=np.int64)
 
-            
                 img_level_anns = self.dataset.img_level_anns[original_id]
-                img_labels = []
-                confidences = []
-                for ann in img_level_anns:
-                    img_labels.append(int(ann['image_level_label']))
-                    confidences.append(float(ann['confidence']))
-                img_labels = np.array(img_labels, dtype=np.int64)
-                allowed_classes = np.unique(
-                        np.append(gt_labels, img_labels))
-
-                pred_classes = np.unique(pred_labels)
-                for pred_class in pred_classes:
-                    classes = np.where(self.dataset.relation_matrix[pred_class])[0] # parent class 
-                    for cls in classes:
-                        if (cls in allowed_classes and cls != pred_class
-                                and get_supercategory):
-                            # add super-supercategory preds
-                            idx = np.where(pred_labels == pred_class)[0]
-
-                            pred_scores = np.concatenate((pred_scores, pred_scores[idx]))
-                            pred_boxes = np.concatenate((pred_boxes, pred_boxes[idx]))
-                            extend_labels = np.full(idx.shape, cls, dtype=np.int64)
-                            pred_labels = np.concatenate((pred_labels, extend_labels))
-                                
-                        elif cls not in allowed_classes and filter_labels:
-                            # remove unannotated preds
-                            index = np.where(pred_labels != cls)[0]
-                            pred_scores = pred_scores[index]
-                            pred_boxes = pred_boxes[index]
-                            pred_labels = pred_labels[index]
+                img_labels = np.array([int(ann['image_level_label']) for ann in img_level_anns], dtype=np.int64)
+                # gt classes, their supercategories and image-level labels
+                allowed_classes = np.union1d(self.hierarchy.ancestor_closure(gt_labels), img_labels)
 
+                # add supercategory preds and remove unannotated preds
+                src_idx, pred_labels = self.hierarchy.expand(pred_labels, allowed_classes)
+                pred_scores = pred_scores[src_idx]
+                pred_boxes = pred_boxes[src_idx]
 
+            yield original_id, pred_boxes, pred_scores, pred_labels
 
+    def prepare_coco_pred(self, predictions):
+        coco_results = []
+        for original_id, prediction in predictions.items():
+            if len(prediction) == 0:
+                coco_results.append([])
+
+        for original_id, pred_boxes, pred_scores, pred_labels in self.prepare_box_pred(predictions):
             coco_results.extend(
                 [
                     {
@@ -379,7 +379,9 @@ class SggEvaluator(object):
         self.pending_tasks.clear()
 
         for iou_type in self.iou_types:
-            if 'bbox' == iou_type:
+            if 'bbox' == iou_type and self.box_evaluator is not None:
+                self.box_evaluator.synchronize_between_processes()
+            elif 'bbox' == iou_type:
                 self.eval_imgs[iou_type] = np.concatenate(self.eval_imgs[iou_type], 2)
                 create_common_coco_eval(self.coco_eval[iou_type], 
                                         self.img_ids, self.eval_imgs[iou_type])
@@ -398,11 +400,17 @@ class SggEvaluator(object):
 
                     self.coco_eval['bbox'].gt_dt_valid = tmp
 
+        if self.do_sgg:
+            # all sgg metric sums / counts in one all_reduce
+            synchronize_metric_sums([v for v in self.sgg_result_dict.values() if isinstance(v, MetricSums)])
 
 
     def accumulate(self):
-        for coco_eval in self.coco_eval.values():
-            coco_eval.accumulate()
+        for iou_type, coco_eval in self.coco_eval.items():
+            if iou_type == 'bbox' and self.box_evaluator is not None:
+                self.box_evaluator.accumulate(coco_eval)
+            else:
+                coco_eval.accumulate()
 
         if not self.do_sgg:
             return 0
@@ -440,16 +448,16 @@ class SggEvaluator(object):
                     os.makedirs(self.output_folder)
                 torch.save(result_dict, os.path.join(self.output_folder, 'result_dict.pytorch'))
 
-        rec_50 = float(np.mean(result_dict[self.mode + '_recall'][50]))
+        rec_50 = float(result_dict[self.mode + '_recall'].mean(50))
         zero_50 = 0
-        res = {'R@50': rec_50}
+        res = {'R@50': rec_50, 'mR@50': float(result_dict[self.mode + '_mean_recall'][50])}
 
         if self.ovd_enabled:
-            zero_50 = float(np.mean(result_dict[self.mode + '_ovd_zeroshot_recall'][50]))
+            zero_50 = float(result_dict[self.mode + '_ovd_zeroshot_recall'].mean(50))
             res['zR-OvD@50'] = zero_50
 
         if self.ovr_enabled:
-            zero_50 = float(np.mean(result_dict[self.mode + '_ovr_zeroshot_recall'][50]))
+            zero_50 = float(result_dict[self.mode + '_ovr_zeroshot_recall'].mean(50))
             res['zR-OvR@50'] = zero_50
 
         return res
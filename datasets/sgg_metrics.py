@@ -13,11 +13,66 @@ from util.bounding_box import intersect_2d, argsort_desc, bbox_overlaps
 
 from abc import ABC, abstractmethod
 
-from util.misc import get_rank, get_world_size, all_gather
+from util.misc import get_rank, get_world_size, all_reduce_arrays
 
 
 
 
+class MetricSums(object):
+    """
+    Running sum and count of per-image metric values for every k in ks,
+    optionally per predicate class. The state is a pair of fixed-shape arrays,
+    so merging over processes is a single all_reduce instead of gathering the
+    pickled per-image lists. mean(k) equals np.mean of the values added for k.
+    """
+
+    def __init__(self, ks=(20, 50, 100), num_classes=None):
+        self.ks = tuple(ks)
+        self._rows = {k: i for i, k in enumerate(self.ks)}
+        shape = (len(self.ks), ) if num_classes is None else (len(self.ks), num_classes)
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.synchronized = False
+
+    def __iter__(self):
+        return iter(self.ks)
+
+    def keys(self):
+        return self.ks
+
+    def append(self, k, value, mask=None):
+        """add one value for k, or one value per class where mask is True"""
+        i = self._rows[k]
+        if mask is None:
+            self.sum[i] += value
+            self.count[i] += 1
+        else:
+            self.sum[i][mask] += np.asarray(value, dtype=np.float64)[mask]
+            self.count[i][mask] += 1
+
+    def counts(self, k):
+        return self.count[self._rows[k]]
+
+    def mean(self, k):
+        i = self._rows[k]
+        # nan where nothing was added, as np.mean([])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sum[i] / self.count[i]
+
+
+def synchronize_metric_sums(containers):
+    """Sum the not yet synchronized containers over all processes with one all_reduce.
+    Every process must pass the same containers in the same order."""
+    containers = [c for c in containers if not c.synchronized]
+    arrays = []
+    for c in containers:
+        arrays += [c.sum, c.count]
+    arrays = all_reduce_arrays(arrays)
+    for i, c in enumerate(containers):
+        c.sum, c.count = arrays[2 * i], arrays[2 * i + 1]
+        c.synchronized = True
+
+
 class SceneGraphEvaluation(ABC):
     def __init__(self, result_dict):
         super().__init__()
@@ -35,20 +90,7 @@ class SceneGraphEvaluation(ABC):
 
 
     def synchronize(self, name):
-        world_size = get_world_size()
-        if world_size == 1:
-            return
-
-        # serialize and gather the data
-        data = self.result_dict[name]
-        data_list = all_gather(data)
-
-        # merge the data from all processes
-        for i in range(world_size):
-            if i != get_rank():
-                data = data_list[i]
-                for k, v in data.items():
-                    self.result_dict[name][k] += v
+        synchronize_metric_sums([self.result_dict[name]])
 
 
 """
@@ -61,7 +103,7 @@ class SGRecall(SceneGraphEvaluation):
         
 
     def register_container(self, mode):
-        self.result_dict[mode + '_recall'] = {20: [], 50: [], 100: []}
+        self.result_dict[mode + '_recall'] = MetricSums()
 
 
     def generate_print_string(self, mode):
@@ -70,8 +112,8 @@ class SGRecall(SceneGraphEvaluation):
         self.synchronize(name)
 
         result_str = 'SGG eval : '
-        for k, v in self.result_dict[mode + '_recall'].items():
-            result_str += '    R @ %d: %.4f; ' % (k, np.mean(v))
+        for k in self.result_dict[mode + '_recall']:
+            result_str += '    R @ %d: %.4f; ' % (k, self.result_dict[mode + '_recall'].mean(k))
         result_str += ' for mode=%s, type=Recall(Main).' % mode
         result_str += '\n'
         return result_str
@@ -111,7 +153,7 @@ class SGRecall(SceneGraphEvaluation):
             # the following code are copied from Neural-MOTIFS
             match = reduce(np.union1d, pred_to_gt[:k])
             rec_i = float(len(match)) / float(gt_rels.shape[0])
-            self.result_dict[mode + '_recall'][k].append(rec_i)
+            self.result_dict[mode + '_recall'].append(k, rec_i)
 
         return local_container
 """
@@ -123,7 +165,7 @@ class SGNoGraphConstraintRecall(SceneGraphEvaluation):
         super(SGNoGraphConstraintRecall, self).__init__(result_dict)
 
     def register_container(self, mode):
-        self.result_dict[mode + '_recall_nogc'] = {20: [], 50: [], 100: []}
+        self.result_dict[mode + '_recall_nogc'] = MetricSums()
 
 
     def generate_print_string(self, mode):
@@ -132,8 +174,8 @@ class SGNoGraphConstraintRecall(SceneGraphEvaluation):
         self.synchronize(name)
         # 
         result_str = 'SGG eval : '
-        for k, v in self.result_dict[mode + '_recall_nogc'].items():
-            result_str += ' ng-R @ %d: %.4f; ' % (k, np.mean(v))
+        for k in self.result_dict[mode + '_recall_nogc']:
+            result_str += ' ng-R @ %d: %.4f; ' % (k, self.result_dict[mode + '_recall_nogc'].mean(k))
         result_str += ' for mode=%s, type=No Graph Constraint Recall(Main).' % mode
         result_str += '\n'
         return result_str
@@ -175,7 +217,7 @@ class SGNoGraphConstraintRecall(SceneGraphEvaluation):
         for k in self.result_dict[mode + '_recall_nogc']:
             match = reduce(np.union1d, nogc_pred_to_gt[:k])
             rec_i = float(len(match)) / float(gt_rels.shape[0])
-            self.result_dict[mode + '_recall_nogc'][k].append(rec_i)
+            self.result_dict[mode + '_recall_nogc'].append(k, rec_i)
 
         return local_container
 
@@ -190,7 +232,7 @@ class SGZeroShotRecall(SceneGraphEvaluation):
         super(SGZeroShotRecall, self).__init__(result_dict)
 
     def register_container(self, mode):
-        self.result_dict[mode + '_zeroshot_recall'] = {20: [], 50: [], 100: []} 
+        self.result_dict[mode + '_zeroshot_recall'] = MetricSums()
 
 
     def generate_print_string(self, mode):
@@ -199,8 +241,8 @@ class SGZeroShotRecall(SceneGraphEvaluation):
         self.synchronize(name)
         #
         result_str = 'SGG eval : '
-        for k, v in self.result_dict[mode + '_zeroshot_recall'].items():
-            result_str += '   zR @ %d: %.4f; ' % (k, np.mean(v))
+        for k in self.result_dict[mode + '_zeroshot_recall']:
+            result_str += '   zR @ %d: %.4f; ' % (k, self.result_dict[mode + '_zeroshot_recall'].mean(k))
         result_str += ' for mode=%s, type=Zero Shot Recall.' % mode
         result_str += '\n'
         return result_str
@@ -228,7 +270,7 @@ class SGZeroShotRecall(SceneGraphEvaluation):
                     match_list = match
                 zeroshot_match = len(self.zeroshot_idx) + len(match_list) - len(set(self.zeroshot_idx + match_list))
                 zero_rec_i = float(zeroshot_match) / float(len(self.zeroshot_idx))
-                self.result_dict[mode + '_zeroshot_recall'][k].append(zero_rec_i)
+                self.result_dict[mode + '_zeroshot_recall'].append(k, zero_rec_i)
 
 """
 Modified for:
@@ -242,7 +284,7 @@ class OvdSGZeroShotRecall(SceneGraphEvaluation):
         self.key = '_ovd_zeroshot_recall'
 
     def register_container(self, mode):
-        self.result_dict[mode + self.key] = {20: [], 50: [], 100: []} 
+        self.result_dict[mode + self.key] = MetricSums()
 
     def generate_print_string(self, mode):
         # sync. 
@@ -250,8 +292,8 @@ class OvdSGZeroShotRecall(SceneGraphEvaluation):
         self.synchronize(name)
         #
         result_str = 'SGG eval : '
-        for k, v in self.result_dict[name].items():
-            result_str += '   zR @ %d: %.4f; ' % (k, np.mean(v))
+        for k in self.result_dict[name]:
+            result_str += '   zR @ %d: %.4f; ' % (k, self.result_dict[name].mean(k))
         result_str += ' for mode=%s, type=Ovd Zero Shot Recall.' % mode
         result_str += '\n'
         return result_str
@@ -287,7 +329,7 @@ class OvdSGZeroShotRecall(SceneGraphEvaluation):
                     match_list = match
                 zeroshot_match = len(self.zeroshot_idx) + len(match_list) - len(set(self.zeroshot_idx + match_list))
                 zero_rec_i = float(zeroshot_match) / float(len(self.zeroshot_idx))
-                self.result_dict[mode + self.key][k].append(zero_rec_i)
+                self.result_dict[mode + self.key].append(k, zero_rec_i)
 
 
 class OvrSGZeroShotRecall(OvdSGZeroShotRecall):
@@ -300,7 +342,7 @@ class OvrSGZeroShotRecall(OvdSGZeroShotRecall):
         self.key = '_ovr_zeroshot_recall'
 
     def register_container(self, mode):
-        self.result_dict[mode + self.key] = {20: [], 50: [], 100: []} 
+        self.result_dict[mode + self.key] = MetricSums()
 
     def generate_print_string(self, mode):
         # sync. 
@@ -308,8 +350,8 @@ class OvrSGZeroShotRecall(OvdSGZeroShotRecall):
         self.synchronize(name)
         #
         result_str = 'SGG eval : '
-        for k, v in self.result_dict[name].items():
-            result_str += '   zR @ %d: %.4f; ' % (k, np.mean(v))
+        for k in self.result_dict[name]:
+            result_str += '   zR @ %d: %.4f; ' % (k, self.result_dict[name].mean(k))
         result_str += ' for mode=%s, type=Ovr Zero Shot Recall.' % mode
         result_str += '\n'
         return result_str
@@ -343,7 +385,7 @@ class OvrSGZeroShotRecall(OvdSGZeroShotRecall):
                     match_list = match
                 zeroshot_match = len(self.zeroshot_idx) + len(match_list) - len(set(self.zeroshot_idx + match_list))
                 zero_rec_i = float(zeroshot_match) / float(len(self.zeroshot_idx))
-                self.result_dict[mode + self.key][k].append(zero_rec_i)
+                self.result_dict[mode + self.key].append(k, zero_rec_i)
             
     
 
@@ -362,7 +404,7 @@ class SGNGZeroShotRecall(SceneGraphEvaluation):
         super(SGNGZeroShotRecall, self).__init__(result_dict)
     
     def register_container(self, mode):
-        self.result_dict[mode + '_ng_zeroshot_recall'] = {20: [], 50: [], 100: []} 
+        self.result_dict[mode + '_ng_zeroshot_recall'] = MetricSums()
 
     def generate_print_string(self, mode):
         # sync. 
@@ -370,8 +412,8 @@ class SGNGZeroShotRecall(SceneGraphEvaluation):
         self.synchronize(name)
         #
         result_str = 'SGG eval : '
-        for k, v in self.result_dict[mode + '_ng_zeroshot_recall'].items():
-            result_str += 'ng-zR @ %d: %.4f; ' % (k, np.mean(v))
+        for k in self.result_dict[mode + '_ng_zeroshot_recall']:
+            result_str += 'ng-zR @ %d: %.4f; ' % (k, self.result_dict[mode + '_ng_zeroshot_recall'].mean(k))
         result_str += ' for mode=%s, type=No Graph Constraint Zero Shot Recall.' % mode
         result_str += '\n'
         return result_str
@@ -399,7 +441,7 @@ class SGNGZeroShotRecall(SceneGraphEvaluation):
                     match_list = match
                 zeroshot_match = len(self.zeroshot_idx) + len(match_list) - len(set(self.zeroshot_idx + match_list))
                 zero_rec_i = float(zeroshot_match) / float(len(self.zeroshot_idx))
-                self.result_dict[mode + '_ng_zeroshot_recall'][k].append(zero_rec_i)
+                self.result_dict[mode + '_ng_zeroshot_recall'].append(k, zero_rec_i)
 
 
 """
@@ -412,8 +454,8 @@ class SGPairAccuracy(SceneGraphEvaluation):
         super(SGPairAccuracy, self).__init__(result_dict)
 
     def register_container(self, mode):
-        self.result_dict[mode + '_accuracy_hit'] = {20: [], 50: [], 100: []}
-        self.result_dict[mode + '_accuracy_count'] = {20: [], 50: [], 100: []}
+        self.result_dict[mode + '_accuracy_hit'] = MetricSums()
+        self.result_dict[mode + '_accuracy_count'] = MetricSums()
 
 
     def generate_print_string(self, mode):
@@ -423,9 +465,9 @@ class SGPairAccuracy(SceneGraphEvaluation):
         # 
 
         result_str = 'SGG eval : '
-        for k, v in self.result_dict[mode + '_accuracy_hit'].items():
-            a_hit = np.mean(v)
-            a_count = np.mean(self.result_dict[mode + '_accuracy_count'][k])
+        for k in self.result_dict[mode + '_accuracy_hit']:
+            a_hit = self.result_dict[mode + '_accuracy_hit'].mean(k)
+            a_count = self.result_dict[mode + '_accuracy_count'].mean(k)
             result_str += '    A @ %d: %.4f; ' % (k, a_hit/a_count )
         result_str += ' for mode=%s, type=TopK Accuracy.' % mode
         result_str += '\n'
@@ -453,8 +495,8 @@ class SGPairAccuracy(SceneGraphEvaluation):
                     gt_pair_match = reduce(np.union1d, gt_pair_pred_to_gt[:k])
                 else:
                     gt_pair_match = []
-                self.result_dict[mode + '_accuracy_hit'][k].append(float(len(gt_pair_match)))
-                self.result_dict[mode + '_accuracy_count'][k].append(float(gt_rels.shape[0]))
+                self.result_dict[mode + '_accuracy_hit'].append(k, float(len(gt_pair_match)))
+                self.result_dict[mode + '_accuracy_count'].append(k, float(gt_rels.shape[0]))
 
 
 """
@@ -470,9 +512,7 @@ class SGMeanRecall(SceneGraphEvaluation):
 
     def register_container(self, mode):
         self.result_dict[mode + '_mean_recall'] = {20: 0.0, 50: 0.0, 100: 0.0}
-        self.result_dict[mode + '_mean_recall_collect'] = {20: [[] for i in range(self.num_rel)], 
-                                                           50: [[] for i in range(self.num_rel)], 
-                                                           100: [[] for i in range(self.num_rel)]}
+        self.result_dict[mode + '_mean_recall_collect'] = MetricSums(num_classes=self.num_rel)
         self.result_dict[mode + '_mean_recall_list'] = {20: [], 50: [], 100: []}
 
 
@@ -500,45 +540,30 @@ class SGMeanRecall(SceneGraphEvaluation):
             match = reduce(np.union1d, pred_to_gt[:k])
             # NOTE: by kaihua, calculate Mean Recall for each category independently
             # this metric is proposed by: CVPR 2019 oral paper "Learning to Compose Dynamic Tree Structures for Visual Contexts"
-            recall_hit = [0] * self.num_rel
-            recall_count = [0] * self.num_rel
-            for idx in range(gt_rels.shape[0]):
-                local_label = gt_rels[idx,2]
-                recall_count[int(local_label)] += 1
-                recall_count[0] += 1
-
-            for idx in range(len(match)):
-                local_label = gt_rels[int(match[idx]),2]
-                recall_hit[int(local_label)] += 1
-                recall_hit[0] += 1
-            
-            for n in range(self.num_rel):
-                if recall_count[n] > 0:
-                    self.result_dict[mode + '_mean_recall_collect'][k][n].append(float(recall_hit[n] / recall_count[n]))
+            # index 0 counts all the predicates of the image
+            recall_count = np.bincount(gt_rels[:, 2].astype(np.int64), minlength=self.num_rel)[:self.num_rel]
+            recall_count[0] += gt_rels.shape[0]
+            matched = gt_rels[np.asarray(match, dtype=np.int64), 2].astype(np.int64)
+            recall_hit = np.bincount(matched, minlength=self.num_rel)[:self.num_rel]
+            recall_hit[0] += len(matched)
+
+            self.result_dict[mode + '_mean_recall_collect'].append(
+                k, recall_hit / np.maximum(recall_count, 1), mask=recall_count > 0)
 
 
     def calculate_mean_recall(self, mode):
         # sync. 
         name = mode + '_mean_recall_collect'
-        world_size = get_world_size()
-        data_list = all_gather(self.result_dict[name])
-        for i in range(world_size):
-            if i != get_rank():
-                data = data_list[i]
-                for k, v in data.items():
-                    for j in range(len(v)):
-                        self.result_dict[name][k][j] += v[j]
-
+        self.synchronize(name)
 
-        # 
         for k, v in self.result_dict[mode + '_mean_recall'].items():
             sum_recall = 0
             num_rel_no_bg = self.num_rel - 1
             for idx in range(num_rel_no_bg):
-                if len(self.result_dict[mode + '_mean_recall_collect'][k][idx+1]) == 0:
+                if self.result_dict[name].counts(k)[idx+1] == 0:
                     tmp_recall = 0.0
                 else:
-                    tmp_recall = np.mean(self.result_dict[mode + '_mean_recall_collect'][k][idx+1])
+                    tmp_recall = float(self.result_dict[name].mean(k)[idx+1])
                 self.result_dict[mode + '_mean_recall_list'][k].append(tmp_recall)
                 sum_recall += tmp_recall
 
@@ -558,9 +583,7 @@ class SGNGMeanRecall(SceneGraphEvaluation):
 
     def register_container(self, mode):
         self.result_dict[mode + '_ng_mean_recall'] = {20: 0.0, 50: 0.0, 100: 0.0}
-        self.result_dict[mode + '_ng_mean_recall_collect'] = {20: [[] for i in range(self.num_rel)], 
-                                                              50: [[] for i in range(self.num_rel)], 
-                                                              100: [[] for i in range(self.num_rel)]}
+        self.result_dict[mode + '_ng_mean_recall_collect'] = MetricSums(num_classes=self.num_rel)
         self.result_dict[mode + '_ng_mean_recall_list'] = {20: [], 50: [], 100: []}
 
     def generate_print_string(self, mode):
@@ -588,43 +611,30 @@ class SGNGMeanRecall(SceneGraphEvaluation):
             match = reduce(np.union1d, pred_to_gt[:k])
             # NOTE: by kaihua, calculate Mean Recall for each category independently
             # this metric is proposed by: CVPR 2019 oral paper "Learning to Compose Dynamic Tree Structures for Visual Contexts"
-            recall_hit = [0] * self.num_rel
-            recall_count = [0] * self.num_rel
-            for idx in range(gt_rels.shape[0]):
-                local_label = gt_rels[idx,2]
-                recall_count[int(local_label)] += 1
-                recall_count[0] += 1
-
-            for idx in range(len(match)):
-                local_label = gt_rels[int(match[idx]),2]
-                recall_hit[int(local_label)] += 1
-                recall_hit[0] += 1
-            
-            for n in range(self.num_rel):
-                if recall_count[n] > 0:
-                    self.result_dict[mode + '_ng_mean_recall_collect'][k][n].append(float(recall_hit[n] / recall_count[n]))
+            # index 0 counts all the predicates of the image
+            recall_count = np.bincount(gt_rels[:, 2].astype(np.int64), minlength=self.num_rel)[:self.num_rel]
+            recall_count[0] += gt_rels.shape[0]
+            matched = gt_rels[np.asarray(match, dtype=np.int64), 2].astype(np.int64)
+            recall_hit = np.bincount(matched, minlength=self.num_rel)[:self.num_rel]
+            recall_hit[0] += len(matched)
+
+            self.result_dict[mode + '_ng_mean_recall_collect'].append(
+                k, recall_hit / np.maximum(recall_count, 1), mask=recall_count > 0)
  
 
     def calculate_mean_recall(self, mode):
         # sync. 
         name = mode + '_ng_mean_recall_collect'
-        world_size = get_world_size()
-        data_list = all_gather(self.result_dict[name])
-        for i in range(world_size):
-            if i != get_rank():
-                data = data_list[i]
-                for k, v in data.items():
-                    for j in range(len(v)):
-                        self.result_dict[name][k][j] += v[j]
+        self.synchronize(name)
 
         for k, v in self.result_dict[mode + '_ng_mean_recall'].items():
             sum_recall = 0
             num_rel_no_bg = self.num_rel - 1
             for idx in range(num_rel_no_bg):
-                if len(self.result_dict[mode + '_ng_mean_recall_collect'][k][idx+1]) == 0:
+                if self.result_dict[name].counts(k)[idx+1] == 0:
                     tmp_recall = 0.0
                 else:
-                    tmp_recall = np.mean(self.result_dict[mode + '_ng_mean_recall_collect'][k][idx+1])
+                    tmp_recall = float(self.result_dict[name].mean(k)[idx+1])
                 self.result_dict[mode + '_ng_mean_recall_list'][k].append(tmp_recall)
                 sum_recall += tmp_recall
 
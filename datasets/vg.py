@@ -18,6 +18,9 @@ from util.bounding_box import BoxList, boxlist_iou
 from util.box_ops import box_iou
 
 from datasets.coco import make_coco_transforms
+from datasets.image_io import get_decode_size, load_image, box_scale
+from datasets.image_shards import open_image_shards
+from datasets.image_meta import meta_file, load_meta, verify_images
 from pycocotools.coco import COCO
 
 BOX_SCALE = 1024  # Scale at which we have the boxes
@@ -59,7 +62,10 @@ class VGDataset(torch.utils.data.Dataset):
                 use_distill=False,
                 unsupervised_distill=False,
                 gpt4sgg_file=None,
-		use_gpt4sgg=False
+		use_gpt4sgg=False,
+                draft_decode=False,
+                image_shards=None,
+                use_image_meta=True
                 ):
         """
         Torch dataset (COCO format) for VisualGenome
@@ -75,6 +81,11 @@ class VGDataset(torch.utils.data.Dataset):
             num_im: Number of images in the entire dataset. -1 for all images.
             num_val_im: Number of images in the validation set (must be less than num_im
                unless num_im is -1.)
+            draft_decode: decode large JPEGs at reduced resolution (datasets/image_io.py)
+            image_shards: ImageShards the images are read from instead of img_dir
+                          (datasets/image_shards.py)
+            use_image_meta: trust the verified sizes of <image_file>.meta.json if it exists
+                            (datasets/image_meta.py)
         """
         self.dataset_name = "vg"
         self.box_scale = BOX_SCALE
@@ -91,6 +102,7 @@ class VGDataset(torch.utils.data.Dataset):
         self.filter_non_overlap = filter_non_overlap and self.split == 'train'
         self.filter_duplicate_rels = filter_duplicate_rels and self.split == 'train'
         self.transforms = transforms
+        self.decode_size = get_decode_size(transforms) if (draft_decode and transforms is not None) else None
         self.ovd_mode = ovd_mode 
         self.ovr_mode = ovr_mode
         self.use_distill = use_distill
@@ -139,7 +151,10 @@ class VGDataset(torch.utils.data.Dataset):
         self.gt_classes = gt_classes
         self.relationships = relationships
         self.gt_boxes = gt_boxes
-        filenames, img_info  = load_image_filenames(img_dir, image_file) # length equals to split_mask
+        self.image_meta = load_meta(meta_file(image_file)) if use_image_meta else None
+        if self.image_meta is not None:
+            print("VG dataset uses the verified image sizes of", meta_file(image_file))
+        filenames, img_info  = load_image_filenames(img_dir, image_file, self.image_meta) # length equals to split_mask
 
         filenames = [filenames[i] for i in np.where(split_mask)[0]]
         img_info = [img_info[i] for i in np.where(split_mask)[0]]
@@ -198,11 +213,12 @@ class VGDataset(torch.utils.data.Dataset):
         self._coco = None
 
         # WARNING: original image_file.json has several pictures with false image size
-        # use correct function to check the validity before training
-        # it will take a while, you only need to do it once
+        # verify the image headers once before training (python -m datasets.image_meta),
+        # the sizes of the sidecar are used then, or fix the file with correct_img_info
         ##correct_img_info(self.img_dir, self.image_file)
 
         self.use_text_labels = use_text_labels
+        self.image_shards = image_shards
 
         
 
@@ -245,15 +261,44 @@ class VGDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.images)
 
+    def get_img_info(self, index):
+        return {'height': self.images[index]['height'], 'width': self.images[index]['width']}
+
+    def image_key(self, index):
+        return os.path.relpath(self.images[index]['file_name'], self.img_dir)
+
+    def get_shard_position(self, index):
+        if self.image_shards is None:
+            return None
+        return self.image_shards.position(self.image_key(index))
+
+    def pack_record(self, index):
+        """(key, image path, annotation) of an image for datasets/image_shards.py"""
+        item = self.images[index]
+        ann = self.annotations[index]
+        boxes = np.asarray(ann['boxes'], dtype=np.float32).reshape(-1, 4) / BOX_SCALE * max(item['width'], item['height'])
+        annotation = {'image_id': item['image_id'],
+                      'width': item['width'],
+                      'height': item['height'],
+                      'boxes': boxes.tolist(), # xyxy in pixels
+                      'labels': [self.ind_to_classes[int(c)] for c in ann['labels']],
+                      'edges': [[int(r[0]), int(r[1]), self.ind_to_predicates[int(r[2])]] for r in ann['edges']],
+                      }
+        return self.image_key(index), item['file_name'], annotation
+
     def __getitem__(self, index):
         item = self.images[index]
         image_id = item["image_id"]
         w, h = item['width'], item['height']
         
         # load image
-        img = Image.open(item['file_name']).convert("RGB")
-        if img.size[0] != item['width'] or img.size[1] != item['height']:
-            print('='*20, ' ERROR index ', str(index), ' ', str(img.size), ' ', 
+        if self.image_shards is not None:
+            img, file_size = self.image_shards.load_image(self.image_key(index), self.decode_size)
+        else:
+            img, file_size = load_image(item['file_name'], self.decode_size)
+        # sizes of the verified sidecar are correct
+        if self.image_meta is None and (file_size[0] != item['width'] or file_size[1] != item['height']):
+            print('='*20, ' ERROR index ', str(index), ' ', str(file_size), ' ', 
                   str(item['width']), ' ', str(item['height']), ' ', '='*20)
 
         flip_img = (random.random() > 0.5) and self.flip_aug and (self.split == 'train')
@@ -285,6 +330,9 @@ class VGDataset(torch.utils.data.Dataset):
         target = dict()
         target["iscrowd"] = torch.zeros(gt_boxes.shape[0], dtype=torch.float32)
         target["boxes"] = torch.as_tensor(gt_boxes, dtype=torch.float32)
+        if img.size != (w, h):
+            # decoded in draft mode, orig_size stays the annotated size
+            target["boxes"] = target["boxes"] * box_scale(img, (w, h))
         target["labels"] = torch.as_tensor(gt_classes, dtype=torch.int64)
         target["edges"] = torch.as_tensor(gt_edges, dtype=torch.int64)
         target["image_id"] = image_id
@@ -456,25 +504,29 @@ def bbox_overlaps(boxes1, boxes2, to_move=1):
 
     return inter
 
-def correct_img_info(img_dir, image_file):
+def correct_img_info(img_dir, image_file, num_workers=16):
     with open(image_file, 'r') as f:
         data = json.load(f)
     # make a copy
     with open(image_file.replace(".json", "_bak.json"), "w") as fout:
         json.dump(data, fout)
 
+    # sizes from the image headers, read in parallel
+    paths = [os.path.join(img_dir, '{}.jpg'.format(img['image_id'])) for img in data]
+    sizes, _ = verify_images(paths, num_workers, checksum=False)
+
     tmp = []
     for i in range(len(data)):
         img = data[i]
-        basename = '{}.jpg'.format(img['image_id'])
-        filename = os.path.join(img_dir, basename)
-        img_data = Image.open(filename).convert("RGB")
-        if img['width'] != img_data.size[0] or img['height'] != img_data.size[1]:
+        meta = sizes.get('{}.jpg'.format(img['image_id']))
+        if meta is None:
+            continue
+        if img['width'] != meta['width'] or img['height'] != meta['height']:
             print('--------- False id: ', i, '---------')
-            print(img_data.size)
+            print((meta['width'], meta['height']))
             print(img)
-            data[i]['width'] = img_data.size[0]
-            data[i]['height'] = img_data.size[1]
+            data[i]['width'] = meta['width']
+            data[i]['height'] = meta['height']
             tmp.append(img)
 
     print("replace:", len(tmp))
@@ -502,13 +554,15 @@ def load_info(dict_file, add_bg=True):
     return ind_to_classes, ind_to_predicates, ind_to_attributes
 
 
-def load_image_filenames(img_dir, image_file):
+def load_image_filenames(img_dir, image_file, image_meta=None):
     """
     Loads the image filenames from visual genome from the JSON file that contains them.
     This matches the preprocessing in scene-graph-TF-release/data_tools/vg_to_imdb.py.
     Parameters:
         image_file: JSON file. Elements contain the param "image_id".
         img_dir: directory where the VisualGenome images are located
+        image_meta: verified sidecar (datasets/image_meta.py), its files exist and
+                    its sizes replace the ones of image_file
     Return: 
         List of filenames corresponding to the good images
     """
@@ -524,7 +578,15 @@ def load_image_filenames(img_dir, image_file):
             continue
 
         filename = os.path.join(img_dir, basename)
-        if os.path.exists(filename):
+        if image_meta is not None:
+            meta = image_meta['images'].get(basename)
+            if meta is not None:
+                img = dict(img, width=meta['width'], height=meta['height'])
+            elif basename not in image_meta['errors']:
+                continue
+            fns.append(filename)
+            img_info.append(img)
+        elif os.path.exists(filename):
             fns.append(filename)
             img_info.append(img)
 
@@ -756,7 +818,9 @@ def build_vg(image_set, args, disable_transforms=False):
                      use_distill=getattr(args, "use_distill", False),
                      unsupervised_distill=getattr(args, "unsupervised_distill", False),
                      gpt4sgg_file=getattr(args, "gpt4sgg_file", None),
-                     use_gpt4sgg=getattr(args, "use_gpt4sgg", False)
+                     use_gpt4sgg=getattr(args, "use_gpt4sgg", False),
+                     draft_decode=getattr(args, "draft_decode", True),
+                     image_shards=open_image_shards(data_path, image_set, args)
                      )
 
 def get_VG_statistics(img_dir, roidb_file, dict_file, image_file, must_overlap=True):
@@ -0,0 +1,128 @@
+"""
+Negative vocabulary sampling for the caption supervised datasets (COCO captions /
+GPT4SGG, Flickr30k, SBU captions, OpenImages).
+
+Every sample draws up to 80 negative nouns / predicates from the parsed vocabulary
+(tens of thousands of names) excluding its positives. VocabSampler keeps the
+vocabulary as integer ids and draws k ids in O(k) instead of building
+set(vocabulary) - set(positives) and permuting it with np.random.choice:
+
+    uniform:  Floyd's algorithm over the ranks of the non-excluded ids
+    weighted: draws from the cumulative weights (count ** power), rejecting
+              excluded / repeated ids, i.e. the distribution of
+              np.random.choice(p=weights, replace=False)
+
+The builders of these datasets draw uniformly by default and by the parsed
+frequencies (count ** power) with --options neg_sampling_power=<power>.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+def read_vocab_file(path):
+    """names and counts of a "name,count" per line vocabulary file (count defaults to 1)"""
+    names, counts = [], []
+    with open(path, 'r') as fin:
+        for line in fin:
+            fields = line.rstrip().split(',')
+            names.append(fields[0])
+            try:
+                counts.append(float(fields[1]))
+            except (IndexError, ValueError):
+                counts.append(1.0)
+    return names, counts
+
+
+class VocabSampler(object):
+    """
+    Args:
+        names: vocabulary, duplicates are removed (first occurrence kept)
+        counts: optional frequency of every name, negatives are drawn with
+                probability proportional to count ** power, uniformly if None
+        power: exponent of the counts, e.g. 0.75 to flatten the distribution
+    """
+
+    # rejection rounds of the weighted sampler before the exact O(n) fallback
+    max_rounds = 8
+
+    def __init__(self, names, counts=None, power=1.0):
+        name2count = OrderedDict()
+        for idx, name in enumerate(names):
+            if name not in name2count:
+                name2count[name] = counts[idx] if counts is not None else 1.0
+        self.names = list(name2count.keys())
+        self.name2id = {name: idx for idx, name in enumerate(self.names)}
+
+        self.cum_weights = None
+        if counts is not None and power != 0:
+            weights = np.power(np.maximum(np.asarray(list(name2count.values()), dtype=np.float64), 0), power)
+            if weights.sum() > 0:
+                self.weights = weights / weights.sum()
+                self.cum_weights = np.cumsum(self.weights)
+
+    @classmethod
+    def from_file(cls, path, power=0.0):
+        """Sampler over a vocabulary file, weighted by the parsed counts if power != 0."""
+        names, counts = read_vocab_file(path)
+        return cls(names, counts if power != 0 else None, power)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _excluded_ids(self, exclude):
+        return sorted(set(self.name2id[name] for name in exclude if name in self.name2id))
+
+    def sample(self, k, exclude=()):
+        """k names (at most the number of non-excluded names) in random order,
+        without replacement and without the names in exclude"""
+        excluded = self._excluded_ids(exclude)
+        available = len(self.names) - len(excluded)
+        k = min(k, available)
+        if k <= 0:
+            return []
+        if self.cum_weights is not None:
+            ids = self._sample_weighted(k, excluded)
+        else:
+            ids = self._sample_uniform(k, available, excluded)
+        return [self.names[i] for i in ids]
+
+    def _sample_uniform(self, k, available, excluded):
+        # Floyd's algorithm: k distinct ranks in [0, available)
+        chosen = set()
+        for j in range(available - k, available):
+            t = np.random.randint(0, j + 1)
+            chosen.add(j if t in chosen else t)
+        ids = np.fromiter(chosen, dtype=np.int64, count=k)
+        np.random.shuffle(ids)
+
+        # rank among the non-excluded ids -> id
+        for e in excluded:
+            ids += ids >= e
+        return ids.tolist()
+
+    def _sample_weighted(self, k, excluded):
+        chosen = []
+        seen = set(excluded)
+        for _ in range(self.max_rounds):
+            u = np.random.random_sample(2 * (k - len(chosen))) * self.cum_weights[-1]
+            draws = np.searchsorted(self.cum_weights, u, side='right')
+            for i in np.minimum(draws, len(self.names) - 1).tolist():
+                if i not in seen:
+                    seen.add(i)
+                    chosen.append(i)
+                    if len(chosen) == k:
+                        return chosen
+
+        # heavy vocabulary head: draw the rest exactly from the remaining ids
+        remaining = np.ones(len(self.names), dtype=bool)
+        remaining[list(seen)] = False
+        candidates = np.nonzero(remaining)[0]
+        num = min(k - len(chosen), len(candidates))
+        p = self.weights[candidates]
+        if np.count_nonzero(p) < num:
+            p = None
+        else:
+            p = p / p.sum()
+        chosen.extend(np.random.choice(candidates, size=num, replace=False, p=p).tolist())
+        return chosen
@@ -8,19 +8,42 @@ import os
 import sys
 from typing import Iterable
 import json
-import matplotlib.pyplot as plt
-import cv2
 
 from util.utils import slprint, to_device, convert_boxes_to_normalized
 
 import torch
 
 import util.misc as utils
-from datasets.coco_eval import CocoEvaluator
+from util.startup import startup_profile
+from groundingdino.util.geometry_cache import geometry_cache
+from groundingdino.util.stage_timer import stage_timer
 from datasets.sgg_eval import SggEvaluator 
-from datasets.panoptic_eval import PanopticEvaluator
 
-from util.vis_utils import plot_raw_img2, add_box_to_img
+# cv2 / matplotlib (util.vis_utils) and the panoptic evaluator are imported where
+# they are used: they are only needed with --save_results or the panoptic dataset
+
+
+def hook_stages(model, criterion=None, postprocessors=None):
+    """Times the module stages of a step with stage_timer, returns the hook handles."""
+    model_without_ddp = getattr(model, 'module', model)
+    modules = [(model_without_ddp.backbone, 'backbone'),
+               (model_without_ddp.transformer.encoder, 'encoder'),
+               (model_without_ddp.transformer.decoder, 'decoder')]
+    if criterion is not None:
+        modules.append((criterion.matcher, 'matcher'))
+    if postprocessors is not None:
+        modules.append((postprocessors['bbox'], 'postprocess'))
+    handles = []
+    for module, name in modules:
+        handles.extend(stage_timer.hook(module, name))
+    return handles
+
+
+def unhook_stages(handles):
+    for handle in handles:
+        handle.remove()
+    stage_timer.configure(enabled=False)
+
 
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
@@ -61,9 +84,17 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
 
+    # per stage time (time_*, ms) and cuda peak memory (mem_*, MB) of every step,
+    # averaged by the metric logger
+    profile_stages = getattr(args, "profile_stages", False)
+    if profile_stages:
+        stage_timer.configure(enabled=True, device=device)
+        stage_handles = hook_stages(model, criterion)
+
     _cnt = 0
 
     for samples, targets in metric_logger.log_every(data_loader, print_freq, header, logger=logger):
+        startup_profile.mark('first train batch')
         args.global_iter += 1
 
         samples = samples.to(device)
@@ -108,22 +139,23 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             sys.exit(1)
 
 
-        # amp backward function
-        if args.amp:
-            optimizer.zero_grad()
-            scaler.scale(losses).backward()
-            if max_norm > 0:
-                scaler.unscale_(optimizer)
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-            scaler.step(optimizer)
-            scaler.update()
-        else:
-            # original backward function
-            optimizer.zero_grad()
-            losses.backward()
-            if max_norm > 0:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
-            optimizer.step()
+        with stage_timer("backward"):
+            # amp backward function
+            if args.amp:
+                optimizer.zero_grad()
+                scaler.scale(losses).backward()
+                if max_norm > 0:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                # original backward function
+                optimizer.zero_grad()
+                losses.backward()
+                if max_norm > 0:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
+                optimizer.step()
 
         if model_t is not None and teacher_update and args.global_iter % teacher_update_interval == 0:
             if utils.get_rank() == 0:
@@ -149,6 +181,8 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         if 'class_error' in loss_dict_reduced:
             metric_logger.update(class_error=loss_dict_reduced['class_error'])
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+        if profile_stages:
+            metric_logger.update(**stage_timer.flush())
 
 
         if wandb_logger is not None:
@@ -166,6 +200,9 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                 break
 
 
+    if profile_stages:
+        unhook_stages(stage_handles)
+
     if getattr(criterion, 'loss_weight_decay', False):
         criterion.loss_weight_decay(epoch=epoch)
     if getattr(criterion, 'tuning_matching', False):
@@ -237,7 +274,8 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
                                      multiple_preds=False, iou_thres=0.5,
                                      output_folder=os.path.join(output_dir, "sgg_eval"),
                                      ovd_enabled=getattr(args, "sg_ovd_mode", False),
-                                     ovr_enabled=getattr(args, "sg_ovr_mode", False)
+                                     ovr_enabled=getattr(args, "sg_ovr_mode", False),
+                                     incremental_bbox_eval=getattr(args, "incremental_bbox_eval", True)
                                      )
         postprocessors['bbox'].eval()
 
@@ -255,6 +293,7 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
 
     panoptic_evaluator = None
     if 'panoptic' in postprocessors.keys():
+        from datasets.panoptic_eval import PanopticEvaluator
         panoptic_evaluator = PanopticEvaluator(
             data_loader.dataset.ann_file,
             data_loader.dataset.ann_folder,
@@ -275,32 +314,50 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
     vis_dir = os.path.join(args.output_dir, "visualization")
     os.makedirs(vis_dir, exist_ok=True)
 
+    # metrics only: skip the criterion and let the model compute the last layer heads only,
+    # eval losses are still computed on every eval_loss_interval-th batch (0: never).
+    # The batch index is the same on all ranks, so reduce_dict stays in sync.
+    eval_metrics_only = getattr(args, "eval_metrics_only", False)
+    eval_loss_interval = getattr(args, "eval_loss_interval", 0)
+
+    profile_stages = getattr(args, "profile_stages", False)
+    if profile_stages:
+        stage_timer.configure(enabled=True, device=device)
+        stage_handles = hook_stages(model, criterion, postprocessors)
+
     for samples, targets in metric_logger.log_every(data_loader, 10, header, logger=logger):
+        startup_profile.mark('first eval batch')
         samples = samples.to(device)
         targets = [{k: to_device(v, device) for k, v in t.items()} for t in targets]
 
+        compute_loss = (not eval_metrics_only) or \
+                        (eval_loss_interval > 0 and _cnt % eval_loss_interval == 0)
+
         with torch.cuda.amp.autocast(enabled=args.amp):
             if need_tgt_for_training:
-                outputs = model(samples, targets)
+                outputs = model(samples, targets, inference_only=not compute_loss)
             else:
-                outputs = model(samples)
+                outputs = model(samples, inference_only=not compute_loss)
 
-            loss_dict = criterion(outputs, targets)
-        weight_dict = criterion.weight_dict
+            if compute_loss:
+                loss_dict = criterion(outputs, targets)
 
-        # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = utils.reduce_dict(loss_dict)
-        loss_dict_reduced_scaled = {k: v * weight_dict[k]
-                                    for k, v in loss_dict_reduced.items() if k in weight_dict}
-        loss_dict_reduced_unscaled = {f'{k}_unscaled': v
-                                      for k, v in loss_dict_reduced.items()}
+        if compute_loss:
+            weight_dict = criterion.weight_dict
 
+            # reduce losses over all GPUs for logging purposes
+            loss_dict_reduced = utils.reduce_dict(loss_dict)
+            loss_dict_reduced_scaled = {k: v * weight_dict[k]
+                                        for k, v in loss_dict_reduced.items() if k in weight_dict}
+            loss_dict_reduced_unscaled = {f'{k}_unscaled': v
+                                          for k, v in loss_dict_reduced.items()}
 
-        metric_logger.update(loss=sum(loss_dict_reduced_scaled.values()),
-                             **loss_dict_reduced_scaled,
-                             **loss_dict_reduced_unscaled)
-        if 'class_error' in loss_dict_reduced:
-            metric_logger.update(class_error=loss_dict_reduced['class_error'])
+
+            metric_logger.update(loss=sum(loss_dict_reduced_scaled.values()),
+                                 **loss_dict_reduced_scaled,
+                                 **loss_dict_reduced_unscaled)
+            if 'class_error' in loss_dict_reduced:
+                metric_logger.update(class_error=loss_dict_reduced['class_error'])
 
         orig_target_sizes = torch.stack([t["orig_size"] for t in targets], dim=0)
         
@@ -329,7 +386,11 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
             coco_evaluator.update(res)
 
         if sgg_evaluator is not None:
-            sgg_evaluator.update(res)
+            with stage_timer("evaluator_update"):
+                sgg_evaluator.update(res)
+
+        if profile_stages:
+            metric_logger.update(**stage_timer.flush())
 
         _cnt += 1
         if panoptic_evaluator is not None:
@@ -349,6 +410,9 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
         save_graphs = True
 
         if args.save_results:
+            import cv2
+            from util.vis_utils import plot_raw_img2
+
             # res_score = outputs['res_score']
             # res_label = outputs['res_label']
             # res_bbox = outputs['res_bbox']
@@ -488,13 +552,15 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
                 print("BREAK!"*5)
                 break
 
-    relations_info['mean_rel'] = sum(relations_info['all_rel']) / len(relations_info['all_rel'])
-    print("The mean number of relations is ", relations_info['mean_rel'])
+    # the relations are only counted with --save_results
+    if relations_info['all_rel']:
+        relations_info['mean_rel'] = sum(relations_info['all_rel']) / len(relations_info['all_rel'])
+        print("The mean number of relations is ", relations_info['mean_rel'])
 
-    infos_path = os.path.join(args.output_dir, "1-info_about_relations.txt")
+        infos_path = os.path.join(args.output_dir, "1-info_about_relations.txt")
 
-    with open(infos_path, "w") as f:
-        json.dump(relations_info, f, indent=2) 
+        with open(infos_path, "w") as f:
+            json.dump(relations_info, f, indent=2) 
 
     if args.save_results:
         import os.path as osp
@@ -508,13 +574,17 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
+    if utils.is_main_process() and geometry_cache.enabled:
+        print("Geometry cache:", geometry_cache.stats())
     if coco_evaluator is not None:
         coco_evaluator.synchronize_between_processes()
     if panoptic_evaluator is not None:
         panoptic_evaluator.synchronize_between_processes()
 
     if sgg_evaluator is not None:
-        sgg_evaluator.synchronize_between_processes()
+        # the evaluator updates run in its executor, wait for them
+        with stage_timer("evaluator_wait"):
+            sgg_evaluator.synchronize_between_processes()
 
     # accumulate predictions from all images
     if coco_evaluator is not None:
@@ -523,7 +593,8 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
 
     sgg_res = None
     if sgg_evaluator is not None:
-        sgg_res = sgg_evaluator.accumulate()
+        with stage_timer("evaluator_accumulate"):
+            sgg_res = sgg_evaluator.accumulate()
         sgg_evaluator.summarize()
         sgg_evaluator.reset()
 
@@ -532,6 +603,10 @@ def evaluate(model, criterion, postprocessors, data_loader, base_ds, device, out
     if panoptic_evaluator is not None:
         panoptic_res = panoptic_evaluator.summarize()
     stats = {k: meter.global_avg for k, meter in metric_logger.meters.items() if meter.count > 0}
+    if profile_stages:
+        # once per evaluation, not averaged over the steps
+        stats.update(stage_timer.flush())
+        unhook_stages(stage_handles)
     if coco_evaluator is not None:
         if 'bbox' in postprocessors.keys():
             stats['coco_eval_bbox'] = coco_evaluator.coco_eval['bbox'].stats.tolist()
@@ -573,6 +648,7 @@ def test(model, criterion, postprocessors, data_loader, base_ds, device, output_
 
     panoptic_evaluator = None
     if 'panoptic' in postprocessors.keys():
+        from datasets.panoptic_eval import PanopticEvaluator
         panoptic_evaluator = PanopticEvaluator(
             data_loader.dataset.ann_file,
             data_loader.dataset.ann_folder,
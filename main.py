@@ -17,20 +17,24 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.multiprocessing as mp
 import torch.distributed as dist 
 
+from util.startup import startup_profile
 from util.get_param_dicts import get_param_dict
 from util.logger import setup_logger
 from util.slconfig import DictAction, SLConfig
 from util.utils import ModelEma, BestMetricHolder
+from util.checkpointer import AsyncCheckpointer
 import util.misc as utils
 
-import datasets
 from datasets import build_dataset, get_coco_api_from_dataset
 from engine import evaluate, train_one_epoch, test
 
-import wandb
 from collections import OrderedDict
 
 from groundingdino.models.GroundingDINO import build_groundingdino
+from groundingdino.util.mmap_checkpoint import load_checkpoint
+
+# wandb, cv2 and the dataset modules are imported on use, see util/startup.py
+startup_profile.mark('imports')
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
@@ -175,6 +179,7 @@ def main(gpu, ngpus_per_node, args):
     wandb_logger = None
     if utils.get_rank() == 0 and not args.eval:
         if os.environ.get("DEBUG") not in ['1', '2']:
+            import wandb
             wandb_logger = wandb.init(config=args, project='dino-'+args.dataset_file)
 
     if not hasattr(args, "frozen_weights"):
@@ -192,6 +197,7 @@ def main(gpu, ngpus_per_node, args):
     # build model
     model, criterion, postprocessors = build_model_main(args)
     model_without_ddp = model
+    startup_profile.mark('model built')
     if utils.get_rank() == 0:
         print("PostProcessors:", postprocessors)
 
@@ -199,7 +205,7 @@ def main(gpu, ngpus_per_node, args):
     if args.frozen_weights is not None:
         assert args.masks, "Frozen training is meant for segmentation only"
 
-        checkpoint = torch.load(args.frozen_weights, map_location='cpu')
+        checkpoint = load_checkpoint(args.frozen_weights, map_location='cpu', sections=('model', ))
         model_without_ddp.detr.load_state_dict(checkpoint['model'])
 
     rln_proj = getattr(model, "rln_proj", None)
@@ -232,7 +238,7 @@ def main(gpu, ngpus_per_node, args):
     # load pre-trained weights
     if (not args.resume) and args.pretrain_model_path:
         logger.info("*"*10 + "Loading weights from pretrained model:%s ..." % args.pretrain_model_path)
-        checkpoint = torch.load(args.pretrain_model_path, map_location='cpu')['model']
+        checkpoint = load_checkpoint(args.pretrain_model_path, map_location='cpu', sections=('model', ))['model']
         _ignorekeywordlist = args.finetune_ignore if args.finetune_ignore else []
         ignorelist = []
 
@@ -284,7 +290,7 @@ def main(gpu, ngpus_per_node, args):
         teacher_weight = getattr(args, "teacher_weight", None)
         if teacher_weight is not None:
             logger.info("Loading Teacher weight:{}".format(teacher_weight))
-            checkpoint = torch.load(teacher_weight, map_location='cpu')['model']
+            checkpoint = load_checkpoint(teacher_weight, map_location='cpu', sections=('model', ))['model']
             missing, unexpected = model_t.load_state_dict(utils.clean_state_dict(checkpoint))
             logger.info("Teacher Missing keys:{}".format(missing))
             logger.info("Teacher unexpected keys:{}".format(unexpected))
@@ -345,35 +351,76 @@ def main(gpu, ngpus_per_node, args):
                                   weight_decay=args.weight_decay)
     
 
-    dataset_train = build_dataset(image_set='train', args=args)
-    
+    # evaluation only jobs do not build (index, decode annotations of) the train set
+    dataset_train = data_loader_train = batch_sampler_train = multi_source_train = None
+    if not args.eval:
+        dataset_train = build_dataset(image_set='train', args=args)
+        sampler_train = DistributedSampler(dataset_train, drop_last=True) if args.distributed else None
+
+        # read packed images (datasets/image_shards.py) shard by shard instead of by random access
+        if getattr(args, "shard_sequential", False):
+            from datasets.samplers import build_shard_sequential_sampler
+            shard_sampler = build_shard_sequential_sampler(dataset_train, args, seed=args.seed)
+            if shard_sampler is not None:
+                sampler_train = shard_sampler
+                logger.info("Shard sequential sampling: {} shards".format(len(shard_sampler.shards)))
+
+        try:
+            is_oiv6 = args.dataset_file == 'oicap'
+        except:
+            is_oiv6 = False
+
+        # annotations fully loaded in every worker may OOM on OpenImages,
+        # the indexed store (datasets/ann_store.py) shares them between workers
+        num_workers_train = args.num_workers
+        if is_oiv6 and not getattr(dataset_train, "uses_ann_store", False):
+            num_workers_train = min(args.num_workers, 2)
+
+        # pack batches under a padded-pixel budget instead of a fixed batch_size
+        batch_sampler_train = None
+        if getattr(args, "batch_max_pixels", None):
+            from datasets.samplers import build_token_budget_batch_sampler
+            batch_sampler_train = build_token_budget_batch_sampler(dataset_train, args, seed=args.seed)
+            logger.info("Token budget batching: max_pixels={}, {}".format(
+                            args.batch_max_pixels, batch_sampler_train.stats()))
+
+        # weighted, interleaved streams of the sources of a mixed training set
+        multi_source_train = None
+        if getattr(args, "multi_source", False):
+            from datasets.multi_source import build_multi_source_loader
+            multi_source_train = build_multi_source_loader(dataset_train, args, collate_fn=utils.collate_fn,
+                                                           seed=args.seed)
+            if multi_source_train is not None:
+                sampler_train = batch_sampler_train = None
+                logger.info("Multi source loading: {}".format(multi_source_train.stats()))
+
+        if multi_source_train is not None:
+            data_loader_train = multi_source_train
+        elif batch_sampler_train is not None:
+            data_loader_train = DataLoader(dataset_train,
+                                           batch_sampler=batch_sampler_train,
+                                           collate_fn=utils.collate_fn,
+                                           num_workers=num_workers_train,
+                                           pin_memory=True)
+        else:
+            data_loader_train = DataLoader(dataset_train, 
+                                           batch_size=args.batch_size, 
+                                           sampler=sampler_train,
+                                           shuffle=(sampler_train is None), 
+                                           collate_fn=utils.collate_fn, 
+                                           num_workers=num_workers_train,
+                                           pin_memory=True)
+
     use_test_set = getattr(args, "use_test_set", False)
     if use_test_set:
         print("*"*10, " Use test set !", "*"*10)
 
     dataset_val = build_dataset(image_set='val' if not use_test_set else 'test', args=args)
-    if utils.get_rank() == 0:
-        logger.info("len(dataset_train)=%s, len(dataset_val)=%s" %(len(dataset_train), len(dataset_val)) )
+    sampler_val = DistributedSampler(dataset_val, shuffle=False) if args.distributed else None
 
-    if args.distributed:
-        sampler_train = DistributedSampler(dataset_train, drop_last=True)
-        sampler_val = DistributedSampler(dataset_val, shuffle=False)
-    else:
-        sampler_train, sampler_val = None, None
-
-
-    try:
-        is_oiv6 = args.dataset_file == 'oicap'
-    except:
-        is_oiv6 = False
-
-    data_loader_train = DataLoader(dataset_train, 
-                                   batch_size=args.batch_size, 
-                                   sampler=sampler_train,
-                                   shuffle=(sampler_train is None), 
-                                   collate_fn=utils.collate_fn, 
-                                   num_workers=args.num_workers if not is_oiv6 else 2, # > 0 may OOM
-                                   pin_memory=True)
+    if utils.get_rank() == 0:
+        logger.info("len(dataset_train)=%s, len(dataset_val)=%s" % (
+                    len(dataset_train) if dataset_train is not None else 0, len(dataset_val)))
 
     data_loader_val = DataLoader(dataset_val, batch_size=1, 
                                  sampler=sampler_val,
@@ -382,9 +429,11 @@ def main(gpu, ngpus_per_node, args):
                                  num_workers=args.num_workers,
                                  pin_memory=True
                                  )
+    startup_profile.mark('datasets built')
 
     if args.onecyclelr:
-        lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=args.lr, steps_per_epoch=len(data_loader_train), epochs=args.epochs, pct_start=0.2)
+        steps_per_epoch = len(data_loader_train) if data_loader_train is not None else 1
+        lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=args.lr, steps_per_epoch=steps_per_epoch, epochs=args.epochs, pct_start=0.2)
     elif args.multi_step_lr:
         lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_drop_list)
     else:
@@ -393,7 +442,8 @@ def main(gpu, ngpus_per_node, args):
 
     if args.dataset_file == "coco_panoptic":
         # We also evaluate AP during panoptic training, on original coco DS
-        coco_val = datasets.coco.build("val", args)
+        from datasets.coco import build as build_coco
+        coco_val = build_coco("val", args)
         base_ds = get_coco_api_from_dataset(coco_val)
     else:
         base_ds = get_coco_api_from_dataset(dataset_val)
@@ -407,7 +457,9 @@ def main(gpu, ngpus_per_node, args):
             checkpoint = torch.hub.load_state_dict_from_url(
                 args.resume, map_location='cpu', check_hash=True)
         else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
+            # evaluation does not need the optimizer state
+            sections = ('model', 'ema_model') if args.eval else None
+            checkpoint = load_checkpoint(args.resume, map_location='cpu', sections=sections)
 
         missing, unexpected = model_without_ddp.load_state_dict(
                                         utils.clean_state_dict(checkpoint['model']), strict=False)
@@ -428,6 +480,8 @@ def main(gpu, ngpus_per_node, args):
             optimizer.load_state_dict(checkpoint['optimizer'])
             lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
             args.start_epoch = checkpoint['epoch'] + 1
+            if 'train_loader' in checkpoint and hasattr(data_loader_train, 'load_state_dict'):
+                data_loader_train.load_state_dict(checkpoint['train_loader'])
 
 
     if args.eval:
@@ -436,6 +490,8 @@ def main(gpu, ngpus_per_node, args):
 
         test_stats, coco_evaluator = evaluate(model, criterion, postprocessors,
                                               data_loader_val, base_ds, device, args.output_dir, wo_class_error=wo_class_error, args=args)
+        if utils.is_main_process():
+            startup_profile.report(logger)
         if args.output_dir and coco_evaluator is not None:
             utils.save_on_master(coco_evaluator.coco_eval["bbox"].eval, output_dir / "eval.pth")
 
@@ -508,16 +564,28 @@ def main(gpu, ngpus_per_node, args):
     print("*"*10, " start training ...")
     args.global_iter = -1
 
+    # checkpoints are snapshot once per name group and written in the background
+    checkpointer = AsyncCheckpointer(checkpoint_format=getattr(args, 'checkpoint_format', 'pth'),
+                                     async_save=getattr(args, 'async_checkpoint', True),
+                                     pin_memory=getattr(args, 'checkpoint_pin_memory', True),
+                                     logger=logger)
+
     # train
     for epoch in range(args.start_epoch, args.epochs):
         epoch_start_time = time.time()
-        if args.distributed:
+        if multi_source_train is not None:
+            multi_source_train.set_epoch(epoch)
+        elif batch_sampler_train is not None:
+            batch_sampler_train.set_epoch(epoch)
+        elif sampler_train is not None:
             sampler_train.set_epoch(epoch)
         train_stats = train_one_epoch(
             model, criterion, data_loader_train, optimizer, device, epoch,
             args.clip_max_norm, wo_class_error=wo_class_error, lr_scheduler=lr_scheduler, 
             args=args, logger=(logger if args.save_log else None), ema_m=ema_m, wandb_logger=wandb_logger, 
             model_t=model_t)
+        if epoch == args.start_epoch and utils.is_main_process():
+            startup_profile.report(logger)
 
         if args.output_dir:
             checkpoint_paths = [output_dir / 'checkpoint.pth']
@@ -529,19 +597,20 @@ def main(gpu, ngpus_per_node, args):
             # extra checkpoint before LR drop and every 100 epochs
             if (epoch + 1) % args.lr_drop == 0 or (epoch + 1) % args.save_checkpoint_interval == 0:
                 checkpoint_paths.append(output_dir / f'checkpoint{epoch:04}.pth')
-            for checkpoint_path in checkpoint_paths:
-                weights = {
-                    'model': model_without_ddp.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'lr_scheduler': lr_scheduler.state_dict(),
-                    'epoch': epoch,
-                    'args': args,
-                }
-                if args.use_ema:
-                    weights.update({
-                        'ema_model': ema_m.module.state_dict(),
-                    })
-                utils.save_on_master(weights, checkpoint_path)
+            weights = {
+                'model': model_without_ddp.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'epoch': epoch,
+                'args': args,
+            }
+            if args.use_ema:
+                weights.update({
+                    'ema_model': ema_m.module.state_dict(),
+                })
+            if multi_source_train is not None:
+                weights['train_loader'] = multi_source_train.state_dict()
+            checkpointer.save(weights, checkpoint_paths)
                 
         # eval
         test_stats, coco_evaluator = evaluate(
@@ -566,17 +635,25 @@ def main(gpu, ngpus_per_node, args):
 
         if _isbest:
             checkpoint_path = output_dir / 'checkpoint_best_regular.pth'
-            utils.save_on_master({
-                'model': model_without_ddp.state_dict(),
-                'optimizer': optimizer.state_dict(),
-                'lr_scheduler': lr_scheduler.state_dict(),
-                'epoch': epoch,
-                'args': args,
-            }, checkpoint_path)
+            if args.output_dir:
+                # same state as checkpoint.pth of this epoch
+                checkpointer.link(output_dir / 'checkpoint.pth', checkpoint_path)
+            else:
+                checkpointer.save({
+                    'model': model_without_ddp.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'lr_scheduler': lr_scheduler.state_dict(),
+                    'epoch': epoch,
+                    'args': args,
+                }, checkpoint_path)
         log_stats = {
             **{f'train_{k}': v for k, v in train_stats.items()},
             **{f'test_{k}': v for k, v in test_stats.items()},
         }
+        if batch_sampler_train is not None:
+            log_stats['train_padding_efficiency'] = batch_sampler_train.padding_efficiency
+        if 'snapshot_time' in checkpointer.stats:
+            log_stats['checkpoint_snapshot_time'] = checkpointer.stats['snapshot_time']
 
         # eval ema
         if args.use_ema:
@@ -589,7 +666,7 @@ def main(gpu, ngpus_per_node, args):
             _isbest = best_map_holder.update(map_ema, epoch, is_ema=True)
             if _isbest:
                 checkpoint_path = output_dir / 'checkpoint_best_ema.pth'
-                utils.save_on_master({
+                checkpointer.save({
                     'model': ema_m.module.state_dict(),
                     'optimizer': optimizer.state_dict(),
                     'lr_scheduler': lr_scheduler.state_dict(),
@@ -626,6 +703,7 @@ def main(gpu, ngpus_per_node, args):
                     for name in filenames:
                         torch.save(coco_evaluator.coco_eval["bbox"].eval,
                                    output_dir / "eval" / name)
+    checkpointer.close()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
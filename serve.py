@@ -0,0 +1,97 @@
+"""
+Local scene graph inference server with dynamic request batching.
+
+    python serve.py -c config/GroundingDINO_SwinB_ovr.py --resume vg-ovr-swinb.pth \
+        --port 8000 --max_batch_size 8 --max_wait_ms 10 --warmup 3
+
+    POST /predict   {"image": <base64 encoded image>} or {"image_path": <path in --image_root>},
+                    optional "classes" / "predicates" lists (index 0: __background__, default VG150)
+    GET  /metrics   per-stage latency (preprocess, queue, text, forward, postprocess, total), batch sizes
+    GET  /health
+
+Malformed requests get http 400, server failures http 500. "image_path" requests
+are rejected unless --image_root is given.
+"""
+import argparse
+import json
+
+import torch
+
+import util.misc as utils
+from util.slconfig import SLConfig
+from util.serving import SceneGraphService, make_http_server
+from main import get_args_parser, build_model_main
+
+from groundingdino.util.mmap_checkpoint import load_checkpoint
+
+
+def build_service(args):
+    cfg = SLConfig.fromfile(args.config_file)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    for k, v in cfg._cfg_dict.to_dict().items():
+        if k not in vars(args):
+            setattr(args, k, v)
+    args.distributed = False
+    args.eval = True
+    args.debug = getattr(args, 'debug', False) or False
+
+    model, _, postprocessors = build_model_main(args)
+    if args.resume:
+        checkpoint = load_checkpoint(args.resume, map_location='cpu', sections=('model', ))
+        missing, unexpected = model.load_state_dict(utils.clean_state_dict(checkpoint['model']), strict=False)
+        print("Missing keys: {}\nUnexpected keys: {}".format(missing, unexpected))
+    model.to(args.device).eval()
+
+    postprocessor = postprocessors['bbox']
+    postprocessor.rln_proj = getattr(model, 'rln_proj', None)
+    postprocessor.rln_classifier = getattr(model, 'rln_classifier', None)
+    postprocessor.rln_freq_bias = getattr(model, 'rln_freq_bias', None)
+
+    if args.vocab is not None:
+        with open(args.vocab, 'r') as f:
+            vocab = json.load(f)
+        class_names, predicate_names = vocab['classes'], vocab['predicates']
+    else:
+        from datasets.vg import VG150_OBJ_CATEGORIES, VG150_PREDICATES
+        class_names, predicate_names = VG150_OBJ_CATEGORIES, VG150_PREDICATES
+
+    return SceneGraphService(model, postprocessor, args.device, class_names, predicate_names,
+                             max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                             text_cache_size=args.text_cache_size, max_relations=args.max_relations)
+
+
+def main(args):
+    if args.device.startswith('cuda'):
+        torch.backends.cudnn.benchmark = True
+    service = build_service(args)
+    if args.warmup > 0:
+        print("Warming up ({} batches of {})".format(args.warmup, args.max_batch_size))
+        service.warmup(args.warmup)
+
+    server = make_http_server(service, args.host, args.port, image_root=args.image_root)
+    print("Serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('scene graph inference server', parents=[get_args_parser()])
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='max time a batch waits for more requests')
+    parser.add_argument('--text_cache_size', type=int, default=16, help='number of cached vocabularies')
+    parser.add_argument('--max_relations', type=int, default=50, help='top relations returned per image')
+    parser.add_argument('--warmup', type=int, default=3, help='warm-up batches before serving, 0: no warm-up')
+    parser.add_argument('--image_root', type=str, default=None,
+                        help='directory "image_path" requests are read from, default: "image_path" is disabled')
+    parser.add_argument('--vocab', type=str, default=None,
+                        help="json with 'classes' and 'predicates' lists (index 0: __background__), "
+                             "defaults to VG150")
+    main(parser.parse_args())
@@ -0,0 +1,360 @@
+"""
+Synthetic benchmarks of the data, model and evaluation hot paths, on cpu and
+without the real datasets or pretrained weights:
+
+    python tools/benchmark.py -c config/GroundingDINO_bench_tiny.py --output bench.json
+    python tools/benchmark.py -c config/GroundingDINO_bench_tiny.py --baseline bench.json
+    python tools/benchmark.py -c config/GroundingDINO_bench_tiny.py --cases model_forward,matcher
+
+A synthetic VG150 split (roidb h5, image_data.json, dicts, random jpegs) and a small
+random bert are generated once under --work_dir. The cases are
+
+    load_graphs       datasets.vg.load_graphs on the roidb
+    vg_getitem        VGDataset.__getitem__ (decode, transforms, captions)
+    collate_fn        util.misc.collate_fn
+    model_forward     GroundingDINO.forward (inference_only)
+    postprocess       PostProcess + graph_infer
+    matcher           HungarianMatcher
+    sgg_update        SggEvaluator.update (until its tasks are done)
+    sgg_accumulate    SggEvaluator.accumulate
+
+and the report (json) has the latency, throughput and peak memory of every case
+(util/benchmark.py). With --baseline the cases slower / larger than the baseline by
+more than --tolerance are listed and the exit code is 1.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+
+import util.misc as utils
+from util.utils import to_device
+from util.slconfig import SLConfig
+from util.benchmark import measure, compare, format_results, save_report, load_report
+from main import get_args_parser, build_model_main
+
+
+ALL_CASES = ('load_graphs', 'vg_getitem', 'collate_fn', 'model_forward', 'postprocess',
+             'matcher', 'sgg_update', 'sgg_accumulate')
+
+SYNTHETIC_VERSION = 1
+
+
+@contextlib.contextmanager
+def _cwd(path):
+    prev = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(prev)
+
+
+def make_synthetic_vg(data_path, num_images=32, min_size=200, max_size=480, max_objects=12, seed=0):
+    """
+    VG150 style split under <data_path>/visual_genome: VG_100K/<image_id>.jpg with random
+    pixels, stanford_filtered/{VG-SGG.h5, custom_annotations.h5} (all images in the
+    train / val split, key "split"), {image_data, custom_image_data}.json, VG-SGG-dicts.json
+    and zeroshot_triplet.pytorch. Skipped if the same split was generated before.
+    """
+    import h5py
+    from PIL import Image
+    from datasets.vg import BOX_SCALE, VG150_OBJ_CATEGORIES, VG150_PREDICATES
+
+    vg_dir = os.path.join(data_path, 'visual_genome')
+    img_dir = os.path.join(vg_dir, 'VG_100K')
+    sf_dir = os.path.join(vg_dir, 'stanford_filtered')
+    stamp_file = os.path.join(vg_dir, 'synthetic.json')
+    stamp = dict(version=SYNTHETIC_VERSION, num_images=num_images, min_size=min_size,
+                 max_size=max_size, max_objects=max_objects, seed=seed)
+    if os.path.exists(stamp_file):
+        with open(stamp_file, 'r') as f:
+            if json.load(f) == stamp:
+                return vg_dir
+    os.makedirs(img_dir, exist_ok=True)
+    os.makedirs(sf_dir, exist_ok=True)
+
+    rng = np.random.RandomState(seed)
+    images, boxes, labels, rels, predicates = [], [], [], [], []
+    first_box, last_box, first_rel, last_rel = [], [], [], []
+    num_boxes = num_rels = 0
+    for i in range(num_images):
+        image_id = i + 1
+        w, h = (int(e) for e in rng.randint(min_size, max_size + 1, 2))
+        Image.fromarray(rng.randint(0, 256, (h, w, 3), dtype=np.uint8)).save(
+            os.path.join(img_dir, '%d.jpg' % image_id), quality=90)
+        images.append({'image_id': image_id, 'width': w, 'height': h})
+
+        # boxes as cx, cy, w, h at BOX_SCALE of the longer side
+        n = rng.randint(2, max_objects + 1)
+        x1, y1 = rng.uniform(0, 0.7 * w, n), rng.uniform(0, 0.7 * h, n)
+        bw, bh = rng.uniform(8, w - x1), rng.uniform(8, h - y1)
+        scale = BOX_SCALE / max(w, h)
+        boxes.append(np.stack([x1 + bw / 2, y1 + bh / 2, bw, bh], 1) * scale)
+        labels.append(rng.randint(1, len(VG150_OBJ_CATEGORIES), n))
+        first_box.append(num_boxes)
+        last_box.append(num_boxes + n - 1)
+
+        r = rng.randint(1, 2 * n + 1)
+        sub = rng.randint(0, n, r)
+        obj = (sub + rng.randint(1, n, r)) % n
+        rels.append(np.stack([sub, obj], 1) + num_boxes)
+        predicates.append(rng.randint(1, len(VG150_PREDICATES), r))
+        first_rel.append(num_rels)
+        last_rel.append(num_rels + r - 1)
+        num_boxes += n
+        num_rels += r
+
+    for name in ('VG-SGG.h5', 'custom_annotations.h5'):
+        with h5py.File(os.path.join(sf_dir, name), 'w') as f:
+            f['split'] = np.zeros(num_images, dtype=np.int64)
+            f['img_to_first_box'] = np.asarray(first_box, dtype=np.int64)
+            f['img_to_last_box'] = np.asarray(last_box, dtype=np.int64)
+            f['img_to_first_rel'] = np.asarray(first_rel, dtype=np.int64)
+            f['img_to_last_rel'] = np.asarray(last_rel, dtype=np.int64)
+            f['labels'] = np.concatenate(labels).astype(np.int64)[:, None]
+            f['boxes_%d' % BOX_SCALE] = np.concatenate(boxes).astype(np.float32)
+            f['relationships'] = np.concatenate(rels).astype(np.int64)
+            f['predicates'] = np.concatenate(predicates).astype(np.int64)[:, None]
+
+    for name in ('image_data.json', 'custom_image_data.json'):
+        with open(os.path.join(sf_dir, name), 'w') as f:
+            json.dump(images, f)
+    with open(os.path.join(sf_dir, 'VG-SGG-dicts.json'), 'w') as f:
+        json.dump({'label_to_idx': {name: idx for idx, name in enumerate(VG150_OBJ_CATEGORIES) if idx > 0},
+                   'predicate_to_idx': {name: idx for idx, name in enumerate(VG150_PREDICATES) if idx > 0}}, f)
+
+    triplets = np.stack([rng.randint(1, len(VG150_OBJ_CATEGORIES), 100),
+                         rng.randint(1, len(VG150_OBJ_CATEGORIES), 100),
+                         rng.randint(1, len(VG150_PREDICATES), 100)], 1)
+    torch.save(torch.as_tensor(triplets), os.path.join(vg_dir, 'zeroshot_triplet.pytorch'))
+
+    with open(stamp_file, 'w') as f:
+        json.dump(stamp, f)
+    return vg_dir
+
+
+def make_tiny_bert(path, hidden_size=64, num_layers=2, seed=0):
+    """
+    Random bert with a word level vocabulary of the VG150 names, saved with its tokenizer.
+    [CLS], [SEP] and "." keep the ids of bert-base-uncased (101, 102, 1012), which the
+    model and graph_infer rely on.
+    """
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    from datasets.vg import VG150_OBJ_CATEGORIES, VG150_PREDICATES
+
+    if os.path.exists(os.path.join(path, 'config.json')):
+        return path
+    os.makedirs(path, exist_ok=True)
+
+    vocab = ['[PAD]'] + ['[unused%d]' % i for i in range(99)] + ['[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    vocab += ['[unused%d]' % i for i in range(99, 99 + 1012 - len(vocab))]
+    vocab += ['.', ',', '?']
+    words = set()
+    for name in VG150_OBJ_CATEGORIES[1:] + VG150_PREDICATES[1:]:
+        words.update(name.lower().split())
+    letters = [chr(c) for c in range(ord('a'), ord('z') + 1)]
+    vocab += sorted(words - set(letters)) + letters + ['##' + c for c in letters]
+    assert vocab.index('[CLS]') == 101 and vocab.index('.') == 1012
+
+    with open(os.path.join(path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(vocab) + '\n')
+    BertTokenizerFast(vocab_file=os.path.join(path, 'vocab.txt'), do_lower_case=True).save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=2, intermediate_size=2 * hidden_size, max_position_embeddings=512)
+    BertModel(config).save_pretrained(path)
+    return path
+
+
+def build_context(args):
+    from datasets.vg import build_vg
+
+    work_dir = os.path.abspath(args.work_dir)
+    args.data_path = os.path.join(work_dir, 'data')
+    make_synthetic_vg(args.data_path, num_images=args.num_images, seed=args.seed)
+    args.text_encoder_type = make_tiny_bert(os.path.join(work_dir, 'tiny_bert'), seed=args.seed)
+
+    torch.manual_seed(args.seed)
+    dataset = build_vg('val', args)
+    model, criterion, postprocessors = build_model_main(args)
+    model.to(args.device).eval()
+
+    postprocessor = postprocessors['bbox']
+    postprocessor.rln_proj = getattr(model, 'rln_proj', None)
+    postprocessor.rln_classifier = getattr(model, 'rln_classifier', None)
+    postprocessor.rln_freq_bias = getattr(model, 'rln_freq_bias', None)
+    postprocessor.name2classes = dataset.name2classes
+    postprocessor.name2predicates = dataset.name2predicates
+
+    samples = [dataset[i] for i in range(len(dataset))]
+    bs = args.batch_size
+    batches = [utils.collate_fn(samples[i:i + bs]) for i in range(0, len(samples), bs)]
+    batches = [(images.to(args.device), [{k: to_device(v, args.device) for k, v in t.items()} for t in targets])
+               for images, targets in batches]
+    return dict(work_dir=work_dir, dataset=dataset, model=model, criterion=criterion,
+                postprocessor=postprocessor, samples=samples, batches=batches)
+
+
+def forward(ctx):
+    with torch.no_grad():
+        return [ctx['model'](images, targets, inference_only=True) for images, targets in ctx['batches']]
+
+
+def postprocess(ctx, outputs):
+    results = []
+    for out, (_, targets) in zip(outputs, ctx['batches']):
+        orig_target_sizes = torch.stack([t['orig_size'] for t in targets], dim=0)
+        res = ctx['postprocessor'](out, orig_target_sizes)
+        results.append({t['image_id']: r for t, r in zip(targets, res)})
+    return results
+
+
+def match(ctx, outputs):
+    matcher = ctx['criterion'].matcher
+    for out, (_, targets) in zip(outputs, ctx['batches']):
+        # as SetCriterion.forward
+        for bid, t in enumerate(targets):
+            t['input_ids'] = out['input_ids'][bid]
+        matcher(out, targets)
+
+
+def run_cases(ctx, args, cases):
+    from datasets.vg import load_graphs
+    from datasets.sgg_eval import SggEvaluator
+
+    num_images = len(ctx['samples'])
+    num_batches = len(ctx['batches'])
+    kw = dict(warmup=args.warmup, iters=args.iters, device=args.device)
+    results = {}
+
+    if 'load_graphs' in cases:
+        roidb_file = os.path.join(args.data_path, 'visual_genome', 'stanford_filtered', 'custom_annotations.h5')
+        results['load_graphs'] = measure(
+            lambda: load_graphs(roidb_file, 'val', -1, 0, filter_empty_rels=True, filter_non_overlap=False),
+            items=num_images, **kw)
+
+    if 'vg_getitem' in cases:
+        dataset = ctx['dataset']
+        results['vg_getitem'] = measure(lambda: [dataset[i] for i in range(len(dataset))], items=num_images, **kw)
+
+    if 'collate_fn' in cases:
+        samples, bs = ctx['samples'], args.batch_size
+        results['collate_fn'] = measure(
+            lambda: [utils.collate_fn(samples[i:i + bs]) for i in range(0, len(samples), bs)],
+            items=num_batches, **kw)
+
+    if 'model_forward' in cases:
+        results['model_forward'] = measure(lambda: forward(ctx), items=num_images, **kw)
+
+    if not set(cases) & {'postprocess', 'matcher', 'sgg_update', 'sgg_accumulate'}:
+        return results
+    outputs = forward(ctx)
+
+    if 'postprocess' in cases:
+        results['postprocess'] = measure(lambda: postprocess(ctx, outputs), items=num_images, **kw)
+
+    if 'matcher' in cases:
+        results['matcher'] = measure(lambda: match(ctx, outputs), items=num_batches, **kw)
+
+    if not set(cases) & {'sgg_update', 'sgg_accumulate'}:
+        return results
+    predictions = postprocess(ctx, outputs)
+    # the evaluator reads ./data/visual_genome/zeroshot_triplet.pytorch
+    with _cwd(ctx['work_dir']):
+        evaluator = SggEvaluator(ctx['dataset'], ('bbox', 'relation'), mode='sgdet',
+                                 num_rel_category=51, iou_thres=0.5,
+                                 output_folder=os.path.join(ctx['work_dir'], 'sgg_eval'))
+
+    def update():
+        for res in predictions:
+            evaluator.update(res)
+        for task in evaluator.pending_tasks:
+            task.result()
+
+    def updated():
+        evaluator.reset()
+        update()
+        evaluator.synchronize_between_processes()
+
+    if 'sgg_update' in cases:
+        results['sgg_update'] = measure(update, items=num_images, setup=evaluator.reset, **kw)
+
+    if 'sgg_accumulate' in cases:
+        results['sgg_accumulate'] = measure(evaluator.accumulate, items=num_images, setup=updated, **kw)
+
+    return results
+
+
+def main(args):
+    cfg = SLConfig.fromfile(args.config_file)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    for k, v in cfg._cfg_dict.to_dict().items():
+        if k not in vars(args):
+            setattr(args, k, v)
+    args.device = args.bench_device
+    args.dataset_file = 'vg'
+    args.distributed = False
+    args.eval = True
+    args.debug = getattr(args, 'debug', False) or False
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    cases = ALL_CASES if args.cases == 'all' else tuple(args.cases.split(','))
+    unknown = set(cases) - set(ALL_CASES)
+    assert not unknown, "unknown cases {}, available: {}".format(sorted(unknown), ALL_CASES)
+
+    ctx = build_context(args)
+    results = run_cases(ctx, args, cases)
+
+    report = {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'device': args.device,
+            'num_threads': torch.get_num_threads(),
+            'num_images': len(ctx['samples']),
+            'batch_size': args.batch_size,
+            'config': os.path.basename(args.config_file),
+        },
+        'results': results,
+    }
+
+    baseline = load_report(args.baseline)['results'] if args.baseline else None
+    print(format_results(results, baseline))
+    if args.output:
+        save_report(args.output, report)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, tolerance=args.tolerance, memory_tolerance=args.memory_tolerance)
+        for r in regressions:
+            print("REGRESSION {case}: {metric} {value:.2f} vs baseline {baseline:.2f} ({ratio:.2f}x)".format(**r))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('synthetic benchmarks', parents=[get_args_parser()])
+    parser.add_argument('--work_dir', type=str, default='logs/benchmark',
+                        help='synthetic data and the random text encoder are generated here')
+    parser.add_argument('--num_images', type=int, default=32, help='images of the synthetic split')
+    parser.add_argument('--cases', type=str, default='all', help='comma separated cases or "all"')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--bench_device', type=str, default='cpu')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch cpu threads, 0: torch default')
+    parser.add_argument('--output', type=str, default=None, help='json report')
+    parser.add_argument('--baseline', type=str, default=None, help='json report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--memory_tolerance', type=float, default=0.25,
+                        help='allowed relative growth of the python heap peak')
+    main(parser.parse_args())
@@ -0,0 +1,221 @@
+"""
+Speed / accuracy trade-off of the inference options of the transformer, on the first
+--num_images images of the val split:
+
+    python tools/benchmark_tradeoff.py -c config/GroundingDINO_SwinB_ovr.py \
+        --resume vg-ovr-swinb.pth --output_dir logs/tradeoff --sweep early_exit
+
+    # without data / weights, on the synthetic split of tools/benchmark.py
+    python tools/benchmark_tradeoff.py -c config/GroundingDINO_bench_tiny.py \
+        --output_dir logs/tradeoff --synthetic --num_images 32 --sweep early_exit
+
+Every setting of the sweep is evaluated with engine.evaluate (R@50, mR@50, seconds
+per image including data loading and the evaluator), the model forward alone is
+timed on the first --latency_images images (util/benchmark.py), and the numbers of
+decoder queries and layers run per batch are averaged. The curve is written to
+<output_dir>/tradeoff_<sweep>.json.
+
+Sweeps:
+    early_exit  all layers, exit after 1 .. dec_layers - 1 layers (--exit_layers),
+                adaptive exit at every --exit_thresholds
+    queries     num_queries, fewer queries (--query_counts), adaptive selection by the
+                encoder scores at every --query_thresholds
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from util.slconfig import SLConfig
+from util.utils import to_device
+from util.benchmark import measure
+from datasets import build_dataset, get_coco_api_from_dataset
+from engine import evaluate
+from main import get_args_parser, build_model_main
+
+from groundingdino.util.mmap_checkpoint import load_checkpoint
+
+
+def early_exit_settings(args, model, postprocessors):
+    decoder = model.transformer.decoder
+
+    def apply(**kw):
+        return lambda: decoder.set_early_exit(**kw)
+
+    settings = [('all_layers', apply())]
+    for layer in args.exit_layers or range(1, decoder.num_layers):
+        settings.append(('exit_layer=%d' % layer, apply(exit_layer=layer)))
+    for threshold in args.exit_thresholds:
+        settings.append(('exit_threshold=%g' % threshold,
+                         apply(threshold=threshold, topk=args.exit_topk, min_layers=args.exit_min_layers)))
+    return settings
+
+
+def query_settings(args, model, postprocessors):
+    transformer = model.transformer
+
+    def apply(**kw):
+        def fn():
+            transformer.set_query_selection(**kw)
+            # as many detections as queries at most, so the pair stage shrinks with the queries
+            postprocessors['bbox'].cap_detections_to_queries = bool(kw)
+        return fn
+
+    settings = [('all_queries=%d' % transformer.num_queries, apply())]
+    for count in args.query_counts:
+        settings.append(('queries=%d' % count, apply(num_queries=count)))
+    for threshold in args.query_thresholds:
+        settings.append(('query_threshold=%g' % threshold,
+                         apply(threshold=threshold, min_queries=args.min_queries)))
+    return settings
+
+
+SWEEPS = {
+    'early_exit': early_exit_settings,
+    'queries': query_settings,
+}
+
+
+def run_setting(model, criterion, postprocessors, data_loader, base_ds, batches, args):
+    sizes = []
+    handle = model.transformer.register_forward_hook(
+        lambda m, inputs, outputs: sizes.append((m.last_num_queries, m.decoder.last_num_layers)))
+
+    start = time.time()
+    with torch.no_grad():
+        stats, _ = evaluate(model, criterion, postprocessors, data_loader, base_ds,
+                            torch.device(args.device), args.output_dir, wo_class_error=True, args=args)
+    elapsed = time.time() - start
+    handle.remove()
+
+    def forward():
+        with torch.no_grad():
+            for samples, targets in batches:
+                model(samples, targets, inference_only=True)
+
+    latency = measure(forward, items=sum(len(t) for _, t in batches), warmup=args.warmup,
+                      iters=args.iters, device=args.device, trace_memory=False)
+
+    return {
+        'R@50': stats.get('R@50'),
+        'mR@50': stats.get('mR@50'),
+        'sec_per_image': elapsed / max(len(data_loader.sampler), 1),
+        'forward_ms_per_image': latency['median_ms'] / latency['items'],
+        'decoder_queries': sum(q for q, _ in sizes) / max(len(sizes), 1),
+        'decoder_layers': sum(n for _, n in sizes) / max(len(sizes), 1),
+    }
+
+
+def main(args):
+    cfg = SLConfig.fromfile(args.config_file)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    for k, v in cfg._cfg_dict.to_dict().items():
+        if k not in vars(args):
+            setattr(args, k, v)
+    args.device = args.bench_device
+    args.distributed = False
+    args.eval = True
+    args.debug = getattr(args, 'debug', False) or False
+    args.use_ema = False
+    # the settings are compared on the metrics, the eval losses are not needed
+    args.eval_metrics_only = True
+    args.output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    # the evaluator reads ./data/visual_genome/zeroshot_triplet.pytorch
+    cwd = contextlib.nullcontext()
+    if args.synthetic:
+        from tools.benchmark import make_synthetic_vg, make_tiny_bert, _cwd
+        work_dir = os.path.abspath(args.work_dir)
+        args.dataset_file = 'vg'
+        args.data_path = os.path.join(work_dir, 'data')
+        make_synthetic_vg(args.data_path, num_images=args.num_images, seed=args.seed)
+        args.text_encoder_type = make_tiny_bert(os.path.join(work_dir, 'tiny_bert'), seed=args.seed)
+        cwd = _cwd(work_dir)
+
+    torch.manual_seed(args.seed)
+    model, criterion, postprocessors = build_model_main(args)
+    if args.resume:
+        checkpoint = load_checkpoint(args.resume, map_location='cpu', sections=('model', ))
+        missing, unexpected = model.load_state_dict(utils.clean_state_dict(checkpoint['model']), strict=False)
+        print("Missing keys: {}\nUnexpected keys: {}".format(missing, unexpected))
+    model.to(args.device).eval()
+    criterion.to(args.device)
+    # the relation heads are attached to the criterion / postprocessor as in main.py
+    for m in (criterion, postprocessors['bbox']):
+        m.rln_proj = getattr(model, 'rln_proj', None)
+        m.rln_classifier = getattr(model, 'rln_classifier', None)
+        m.rln_freq_bias = getattr(model, 'rln_freq_bias', None)
+
+    dataset_val = build_dataset(image_set='val', args=args)
+    indices = list(range(min(args.num_images, len(dataset_val))))
+    data_loader = DataLoader(dataset_val, batch_size=1, sampler=indices, drop_last=False,
+                             collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    base_ds = get_coco_api_from_dataset(dataset_val)
+
+    batches = []
+    for samples, targets in DataLoader(dataset_val, batch_size=1, sampler=indices[:args.latency_images],
+                                       collate_fn=utils.collate_fn):
+        batches.append((samples.to(args.device), [{k: to_device(v, args.device) for k, v in t.items()}
+                                                  for t in targets]))
+
+    results = {}
+    with cwd:
+        for name, apply in SWEEPS[args.sweep](args, model, postprocessors):
+            apply()
+            results[name] = run_setting(model, criterion, postprocessors, data_loader, base_ds, batches, args)
+            print(name, json.dumps(results[name]))
+
+    reference = next(iter(results.values()))
+    for r in results.values():
+        r['speedup'] = reference['forward_ms_per_image'] / r['forward_ms_per_image']
+        if r['R@50'] is not None and reference['R@50'] is not None:
+            r['drift_R@50'] = r['R@50'] - reference['R@50']
+
+    print("{:<28s} {:>8s} {:>8s} {:>12s} {:>8s} {:>8s} {:>8s}".format(
+        'setting', 'R@50', 'mR@50', 'fwd ms/img', 'speedup', 'queries', 'layers'))
+    for name, r in results.items():
+        print("{:<28s} {:>8.4f} {:>8.4f} {:>12.2f} {:>8.2f} {:>8.1f} {:>8.2f}".format(
+            name, r['R@50'] or 0, r['mR@50'] or 0, r['forward_ms_per_image'], r['speedup'],
+            r['decoder_queries'], r['decoder_layers']))
+
+    report = {'sweep': args.sweep, 'num_images': len(indices), 'device': args.device,
+              'num_threads': torch.get_num_threads(), 'results': results}
+    with open(os.path.join(args.output_dir, 'tradeoff_%s.json' % args.sweep), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('inference speed / accuracy trade-off', parents=[get_args_parser()])
+    parser.add_argument('--sweep', type=str, default='early_exit', choices=sorted(SWEEPS.keys()))
+    parser.add_argument('--num_images', type=int, default=500, help='number of val images to evaluate')
+    parser.add_argument('--latency_images', type=int, default=16, help='images the forward is timed on')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--bench_device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch cpu threads, 0: torch default')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='synthetic split and random text encoder of tools/benchmark.py')
+    parser.add_argument('--work_dir', type=str, default='logs/benchmark', help='synthetic data directory')
+    # early_exit
+    parser.add_argument('--exit_layers', type=int, nargs='*', default=None,
+                        help='fixed exit layers, default: 1 .. dec_layers - 1')
+    parser.add_argument('--exit_thresholds', type=float, nargs='*', default=[0.05, 0.02, 0.01])
+    parser.add_argument('--exit_topk', type=int, default=100)
+    parser.add_argument('--exit_min_layers', type=int, default=2)
+    # queries
+    parser.add_argument('--query_counts', type=int, nargs='*', default=[300, 100, 50])
+    parser.add_argument('--query_thresholds', type=float, nargs='*', default=[0.3, 0.2])
+    parser.add_argument('--min_queries', type=int, default=10)
+    main(parser.parse_args())
@@ -0,0 +1,71 @@
+"""
+Pack the images and annotations of a dataset split into large shard files
+(datasets/image_shards.py), which the dataset builders then read instead of
+the single image files:
+
+    python tools/pack_shards.py -c config/GroundingDINO_SwinT_OGC_full.py \
+        --pack_dataset vg --image_set train --shard_mb 1024
+
+The shards are written to <data_path>/<dataset>/shards/<image_set>; train with
+--options shard_sequential=True to read them shard by shard.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util.slconfig import SLConfig
+from main import get_args_parser
+from datasets.image_shards import pack_dataset, shard_prefix
+
+
+DATA_DIRS = {
+    'vg': 'visual_genome',
+    'coco': 'coco',
+    'oicap': 'open-imagev6',
+}
+
+
+def build_unpacked(name, image_set, args):
+    # the annotations are packed as stored, without transforms
+    if name == 'vg':
+        from datasets.vg import build_vg
+        return build_vg(image_set, args, disable_transforms=True)
+    if name == 'coco':
+        from datasets.coco import build
+        return build(image_set, args)
+    if name == 'oicap':
+        from datasets.oiv6 import build_oicap
+        return build_oicap(image_set, args, disable_transforms=True)
+    raise ValueError("dataset %s cannot be packed" % name)
+
+
+def main(args):
+    cfg = SLConfig.fromfile(args.config_file)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    for k, v in cfg._cfg_dict.to_dict().items():
+        if k not in vars(args):
+            setattr(args, k, v)
+    # read the single image files, not existing shards
+    args.use_image_shards = False
+
+    dataset = build_unpacked(args.pack_dataset, args.image_set, args)
+    prefix = args.prefix or shard_prefix(os.path.join(args.data_path, DATA_DIRS[args.pack_dataset]), args.image_set)
+
+    start = time.time()
+    num = pack_dataset(dataset, prefix, shard_bytes=args.shard_mb * 2 ** 20, num_threads=args.num_threads)
+    print("packed %d images to %s-*.bin in %.1fs" % (num, prefix, time.time() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('pack images into shards', parents=[get_args_parser()])
+    parser.add_argument('--pack_dataset', type=str, default='vg', choices=sorted(DATA_DIRS.keys()))
+    parser.add_argument('--image_set', type=str, default='train')
+    parser.add_argument('--prefix', type=str, default=None,
+                        help='output prefix, defaults to <data_path>/<dataset>/shards/<image_set>')
+    parser.add_argument('--shard_mb', type=int, default=1024, help='size of a shard file')
+    parser.add_argument('--num_threads', type=int, default=16, help='threads reading the image files')
+    main(parser.parse_args())
@@ -0,0 +1,110 @@
+"""
+Check the int8 dynamic quantized model against the fp32 model on cpu.
+
+Both models are evaluated on the first --num_images images of the val split and
+R@50 / mR@50, the latency per image and the state dict size are reported:
+
+    python tools/quantize_eval.py -c config/GroundingDINO_SwinB_ovr.py \
+        --resume vg-ovr-swinb.pth --output_dir logs/quant --num_images 500
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.data import DataLoader
+
+import util.misc as utils
+from util.slconfig import SLConfig
+from datasets import build_dataset, get_coco_api_from_dataset
+from engine import evaluate
+from main import get_args_parser, build_model_main
+
+from groundingdino.util.mmap_checkpoint import load_checkpoint
+from groundingdino.util.quantization import quantize_dynamic_model, state_dict_nbytes
+
+
+def run_eval(model, criterion, postprocessors, data_loader, base_ds, args):
+    # the relation heads are attached to the criterion / postprocessor as in main.py,
+    # again after quantization since quantize_dynamic replaces the linear layers
+    for m in (criterion, postprocessors['bbox']):
+        m.rln_proj = getattr(model, 'rln_proj', None)
+        m.rln_classifier = getattr(model, 'rln_classifier', None)
+        m.rln_freq_bias = getattr(model, 'rln_freq_bias', None)
+    start = time.time()
+    with torch.no_grad():
+        stats, _ = evaluate(model, criterion, postprocessors, data_loader, base_ds,
+                            torch.device('cpu'), args.output_dir, wo_class_error=True, args=args)
+    elapsed = time.time() - start
+    return {
+        'R@50': stats.get('R@50'),
+        'mR@50': stats.get('mR@50'),
+        'sec_per_image': elapsed / max(len(data_loader.sampler), 1),
+        'state_dict_mb': state_dict_nbytes(model) / 2 ** 20,
+    }
+
+
+def main(args):
+    cfg = SLConfig.fromfile(args.config_file)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    for k, v in cfg._cfg_dict.to_dict().items():
+        if k not in vars(args):
+            setattr(args, k, v)
+    args.device = 'cpu'
+    args.distributed = False
+    args.amp = False
+    args.eval = True
+    args.debug = getattr(args, 'debug', False) or False
+    args.use_ema = False
+    # the quantized model is checked on the metrics, the eval losses are not needed
+    args.eval_metrics_only = True
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    model, criterion, postprocessors = build_model_main(args)
+    checkpoint = load_checkpoint(args.resume, map_location='cpu', sections=('model', ))
+    missing, unexpected = model.load_state_dict(utils.clean_state_dict(checkpoint['model']), strict=False)
+    print("Missing keys: {}\nUnexpected keys: {}".format(missing, unexpected))
+    model.eval()
+
+    dataset_val = build_dataset(image_set='val', args=args)
+    indices = list(range(min(args.num_images, len(dataset_val))))
+    data_loader = DataLoader(dataset_val, batch_size=1, sampler=indices, drop_last=False,
+                             collate_fn=utils.collate_fn, num_workers=args.num_workers)
+    base_ds = get_coco_api_from_dataset(dataset_val)
+
+    results = {'num_images': len(indices), 'num_threads': torch.get_num_threads()}
+    results['fp32'] = run_eval(model, criterion, postprocessors, data_loader, base_ds, args)
+
+    model = quantize_dynamic_model(model)
+    results['int8'] = run_eval(model, criterion, postprocessors, data_loader, base_ds, args)
+
+    for k in ('R@50', 'mR@50'):
+        if results['fp32'][k] is not None and results['int8'][k] is not None:
+            results['drift_' + k] = results['int8'][k] - results['fp32'][k]
+    results['speedup'] = results['fp32']['sec_per_image'] / results['int8']['sec_per_image']
+    results['size_ratio'] = results['int8']['state_dict_mb'] / results['fp32']['state_dict_mb']
+
+    print(json.dumps(results, indent=2))
+    with open(os.path.join(args.output_dir, 'quantize_eval.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.max_drift is not None:
+        drift = max(abs(results.get('drift_R@50', 0.0)), abs(results.get('drift_mR@50', 0.0)))
+        assert drift <= args.max_drift, "R@50 / mR@50 drift {:.4f} > {}".format(drift, args.max_drift)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('int8 dynamic quantization check', parents=[get_args_parser()])
+    parser.add_argument('--num_images', type=int, default=500, help='number of val images to evaluate')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch cpu threads, 0: torch default')
+    parser.add_argument('--max_drift', type=float, default=None,
+                        help='fail if |R@50| or |mR@50| drift is larger than this')
+    main(parser.parse_args())
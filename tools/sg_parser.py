@@ -1,18 +1,25 @@
 import os
 import sys
 import json
-import sng_parser
-import spacy
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 import re
 
-try:
-    parser = sng_parser.Parser('spacy', model='en')
-    print("use spacy parser")
-except:
-    import sng_parser as parser
-    print("import sng_parser as parser !")
+_parser = None
+
+
+def get_parser():
+    """spaCy scene graph parser, built on first use (once per worker process)"""
+    global _parser
+    if _parser is None:
+        import sng_parser
+        try:
+            _parser = sng_parser.Parser('spacy', model='en')
+            print("use spacy parser")
+        except:
+            _parser = sng_parser
+            print("import sng_parser as parser !")
+    return _parser
 
 black_lists = set(['we', 'me',  'i', 'you', 'u', 'he', 'she', 'them', 'her', 'his',
                     'they', 'this', 'that', 'it', 'image', 'group',
@@ -54,7 +61,7 @@ def get_triple(data):
 
     all_rels = []
     for caption in captions:
-        graph = parser.parse(caption)
+        graph = get_parser().parse(caption)
 
         entities_1 = [item['lemma_head'] for item in graph['entities']]
         #entities = [item['span'] for item in graph['entities']]
@@ -0,0 +1,130 @@
+"""
+Benchmark helpers: latency, throughput and peak memory of a callable, and the
+comparison of a report against a stored baseline (see tools/benchmark.py).
+
+    result = measure(lambda: dataset[0], items=1, warmup=2, iters=20)
+    # {'mean_ms', 'median_ms', 'min_ms', 'items_per_s', 'py_peak_mb', 'rss_peak_mb', ...}
+
+Timing runs without tracing; the python heap peak (numpy included) is taken by one
+more call under tracemalloc, the process peak RSS (torch cpu tensors included) is
+read from getrusage, and the cuda peak from torch when a cuda device is used.
+"""
+import json
+import statistics
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+import torch
+
+
+def _rss_peak_mb():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _sync(device):
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, items=1, warmup=1, iters=5, device=None, trace_memory=True, setup=None):
+    """
+    Times iters calls of fn() after warmup calls.
+    items: number of items (images, batches, ...) processed by one call, for items_per_s
+    setup: called before every call of fn, not timed (e.g. to reset state fn consumes)
+    """
+    setup = setup or (lambda: None)
+    for _ in range(warmup):
+        setup()
+        fn()
+    _sync(device)
+
+    rss_before = _rss_peak_mb()
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    times = []
+    for _ in range(iters):
+        setup()
+        _sync(device)
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append(time.perf_counter() - start)
+
+    result = {
+        'iters': iters,
+        'items': items,
+        'mean_ms': 1000 * statistics.mean(times),
+        'median_ms': 1000 * statistics.median(times),
+        'min_ms': 1000 * min(times),
+        'items_per_s': items / statistics.median(times) if statistics.median(times) > 0 else None,
+    }
+
+    rss_after = _rss_peak_mb()
+    if rss_after is not None:
+        result['rss_peak_mb'] = rss_after
+        result['rss_growth_mb'] = rss_after - rss_before
+    if device is not None and torch.device(device).type == 'cuda':
+        result['cuda_peak_mb'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+    if trace_memory:
+        setup()
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['py_peak_mb'] = peak / 2 ** 20
+
+    return result
+
+
+def compare(results, baseline, tolerance=0.25, key='median_ms', memory_key='py_peak_mb', memory_tolerance=0.25):
+    """
+    Cases of results slower (key) or larger (memory_key) than the baseline by more
+    than the relative tolerance. Cases missing from either report are skipped.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for k, tol in ((key, tolerance), (memory_key, memory_tolerance)):
+            if result.get(k) is None or not base.get(k):
+                continue
+            ratio = result[k] / base[k]
+            if ratio > 1 + tol:
+                regressions.append({'case': name, 'metric': k, 'baseline': base[k],
+                                    'value': result[k], 'ratio': ratio})
+    return regressions
+
+
+def format_results(results, baseline=None, key='median_ms'):
+    lines = ["{:<22s} {:>10s} {:>12s} {:>10s} {:>10s}".format(
+        'case', key, 'items/s', 'py MB', 'vs base')]
+    for name, r in results.items():
+        ratio = ''
+        if baseline is not None and baseline.get(name, {}).get(key):
+            ratio = '{:.2f}x'.format(r[key] / baseline[name][key])
+        lines.append("{:<22s} {:>10.2f} {:>12.2f} {:>10.1f} {:>10s}".format(
+            name, r[key], r.get('items_per_s') or 0, r.get('py_peak_mb') or 0, ratio))
+    return "\n".join(lines)
+
+
+def save_report(path, report):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(path):
+    with open(path, 'r') as f:
+        return json.load(f)
@@ -0,0 +1,163 @@
+"""
+Asynchronous, atomic checkpoint saving.
+
+AsyncCheckpointer.save() copies the state to (pinned) cpu memory once and returns;
+a background thread writes it to a temporary file that is renamed to the target,
+so a crash never leaves a truncated checkpoint. Additional names for the same
+state (e.g. checkpoint0009.pth next to checkpoint.pth) are hard links of the
+written file instead of another serialization. Only the main process writes.
+"""
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from groundingdino.util.mmap_checkpoint import save_mmap_checkpoint
+from util.misc import is_main_process
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. file systems without hard links
+        shutil.copyfile(src, dst)
+
+
+def _replace(tmp_path, path):
+    if os.path.isdir(tmp_path):
+        # directories (mmap checkpoints) can not be renamed over an existing one
+        old_path = path + '.old'
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class AsyncCheckpointer(object):
+    """
+    Args:
+        checkpoint_format: 'pth' (torch.save) or 'mmap' (groundingdino.util.mmap_checkpoint)
+        async_save: write in a background thread, otherwise save() blocks until written
+        pin_memory: snapshot cuda tensors into reused pinned buffers
+        logger: optional logger for the save latency
+    """
+
+    def __init__(self, checkpoint_format='pth', async_save=True, pin_memory=True, logger=None):
+        assert checkpoint_format in ('pth', 'mmap'), checkpoint_format
+        self.checkpoint_format = checkpoint_format
+        self.async_save = async_save
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.logger = logger
+        self.enabled = is_main_process()
+
+        self._executor = ThreadPoolExecutor(max_workers=1) if (self.enabled and async_save) else None
+        self._pending = []
+        self._buffers = {}
+        self.stats = {}
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    def _snapshot(self, obj, prefix=''):
+        if torch.is_tensor(obj):
+            tensor = obj.detach()
+            if tensor.device.type == 'cpu' and not self.pin_memory:
+                return tensor.clone()
+            buf = self._buffers.get(prefix)
+            if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+                buf = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=self.pin_memory)
+                self._buffers[prefix] = buf
+            buf.copy_(tensor, non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            new_obj = type(obj)((k, self._snapshot(v, '%s/%s' % (prefix, k))) for k, v in obj.items())
+            if hasattr(obj, '_metadata'):
+                # module versions of a state_dict
+                new_obj._metadata = obj._metadata
+            return new_obj
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, '%s/%d' % (prefix, i)) for i, v in enumerate(obj))
+        return obj
+
+    def _write(self, state, paths):
+        start = time.time()
+        path = str(paths[0])
+        tmp_path = path + '.tmp'
+        _remove(tmp_path)
+        if self.checkpoint_format == 'mmap':
+            save_mmap_checkpoint(state, tmp_path)
+        else:
+            torch.save(state, tmp_path)
+        _replace(tmp_path, path)
+        for other in paths[1:]:
+            self._link(path, str(other))
+        self.stats['write_time'] = time.time() - start
+        self._log("Saved checkpoint {} in {:.2f}s".format(
+            ', '.join(os.path.basename(str(p)) for p in paths), self.stats['write_time']))
+
+    def _link(self, src, dst):
+        tmp_path = dst + '.tmp'
+        _remove(tmp_path)
+        if os.path.isdir(src):
+            shutil.copytree(src, tmp_path, copy_function=_link_or_copy)
+        else:
+            _link_or_copy(src, tmp_path)
+        _replace(tmp_path, dst)
+
+    def wait(self):
+        """Block until the pending writes are finished, re-raising their errors."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def save(self, state, paths):
+        """Save state to every path in paths, written once and hard-linked to the other paths."""
+        if not self.enabled:
+            return
+        if not isinstance(paths, (list, tuple)):
+            paths = [paths]
+
+        # the pinned buffers are reused, the previous write has to finish first
+        self.wait()
+        start = time.time()
+        state = self._snapshot(state)
+        if self.pin_memory:
+            torch.cuda.synchronize()
+        self.stats['snapshot_time'] = time.time() - start
+
+        if self._executor is None:
+            self._write(state, paths)
+        else:
+            self._pending.append(self._executor.submit(self._write, state, paths))
+
+    def link(self, src, dst):
+        """Make dst another name of the checkpoint saved (or being saved) to src."""
+        if not self.enabled:
+            return
+        if self._executor is None:
+            self._link(str(src), str(dst))
+        else:
+            self._pending.append(self._executor.submit(self._link, str(src), str(dst)))
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -163,6 +163,32 @@ def reduce_dict(input_dict, average=True):
     return reduced_dict
 
 
+def all_reduce_arrays(arrays):
+    """
+    Sum a list of numpy arrays over all processes with a single all_reduce,
+    without pickling. The arrays are packed into one float64 tensor, placed on
+    the current cuda device for nccl and on the cpu for other backends (gloo).
+    Returns a list of arrays with the same shapes and dtypes.
+    """
+    world_size = get_world_size()
+    if world_size < 2 or len(arrays) == 0:
+        return arrays
+    flat = np.concatenate([np.asarray(a, dtype=np.float64).reshape(-1) for a in arrays])
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    with torch.no_grad():
+        tensor = torch.from_numpy(flat).to(device)
+        dist.all_reduce(tensor)
+        flat = tensor.cpu().numpy()
+
+    reduced = []
+    offset = 0
+    for a in arrays:
+        a = np.asarray(a)
+        reduced.append(flat[offset: offset + a.size].reshape(a.shape).astype(a.dtype))
+        offset += a.size
+    return reduced
+
+
 class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
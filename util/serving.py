@@ -0,0 +1,402 @@
+"""
+Scene graph inference service with dynamic request batching.
+
+    SceneGraphService   model + PostProcess, text features cached per vocabulary
+    DynamicBatcher      groups queued requests into batches (max batch size / max wait)
+    LatencyStats        per-stage latency (preprocess, queue, text, forward, postprocess, total)
+    InProcessClient     same interface as the http client, without the http layer
+    make_http_server    stdlib http server: POST /predict, GET /metrics, GET /health
+
+Malformed requests raise RequestError (http 400), every other failure is a server
+error (http 500). "image_path" requests are only served with an image_root, the
+path is resolved inside it.
+
+See serve.py for the entry point.
+"""
+import base64
+import io
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import torch
+from PIL import Image
+
+import datasets.transforms as T
+from util.misc import nested_tensor_from_tensor_list
+
+
+class LatencyStats(object):
+    """Latencies of the last `window` calls of every stage in ms, and a histogram of the batch sizes."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._values = {}
+        self._batch_sizes = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            if stage not in self._values:
+                self._values[stage] = deque(maxlen=self.window)
+            self._values[stage].append(seconds * 1000.0)
+
+    def record_batch(self, size):
+        with self._lock:
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            values = {k: np.asarray(v) for k, v in self._values.items()}
+            batch_sizes = dict(self._batch_sizes)
+        summary = {
+            k: {
+                'count': len(v),
+                'mean_ms': float(v.mean()),
+                'p50_ms': float(np.percentile(v, 50)),
+                'p95_ms': float(np.percentile(v, 95)),
+                'max_ms': float(v.max()),
+            } for k, v in values.items() if len(v) > 0
+        }
+        summary['batch_sizes'] = {str(k): batch_sizes[k] for k in sorted(batch_sizes)}
+        return summary
+
+
+class DynamicBatcher(object):
+    """
+    Calls process_fn(items) -> results on batches of the submitted items from a
+    worker thread. A batch is started by the first queued item and closed when it
+    has max_batch_size items or max_wait_ms passed.
+    """
+
+    def __init__(self, process_fn, max_batch_size=8, max_wait_ms=10, stats=None):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = stats
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future, time.time()))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is None:
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while not self._stopped:
+            batch = self._collect()
+            if batch is None:
+                break
+            start = time.time()
+            if self.stats is not None:
+                self.stats.record_batch(len(batch))
+                for _, _, submit_time in batch:
+                    self.stats.record('queue', start - submit_time)
+            try:
+                results = self.process_fn([item for item, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            if self.stats is not None:
+                end = time.time()
+                for _, _, submit_time in batch:
+                    self.stats.record('total', end - submit_time)
+
+    def close(self):
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join()
+
+
+class SceneGraphService(object):
+    """
+    Args:
+        model: GroundingDINO with do_sgg=True, in eval mode on device
+        postprocessor: PostProcess built with use_text_labels=True (postprocessors['bbox'])
+        class_names / predicate_names: default vocabulary, index 0 is __background__
+        max_relations: number of top triplets returned per image
+    """
+
+    def __init__(self, model, postprocessor, device, class_names, predicate_names,
+                 max_batch_size=8, max_wait_ms=10, text_cache_size=16, max_relations=50):
+        assert postprocessor.use_text_labels, "the service needs a PostProcess with use_text_labels=True"
+        self.model = model.eval()
+        self.postprocessor = postprocessor
+        self.device = torch.device(device)
+        self.default_vocab = (tuple(class_names), tuple(predicate_names))
+        self.text_cache_size = text_cache_size
+        self.max_relations = max_relations
+        self.stats = LatencyStats()
+        self._text_cache = OrderedDict()
+        self.transform = T.Compose([
+            T.RandomResize([800], max_size=1333),
+            T.ToTensor(),
+            T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        ])
+        self.batcher = DynamicBatcher(self._process, max_batch_size, max_wait_ms, stats=self.stats)
+
+    def _text_features(self, vocab):
+        """text features, name maps and label positive map of a vocabulary, LRU cached"""
+        if vocab in self._text_cache:
+            self._text_cache.move_to_end(vocab)
+            return self._text_cache[vocab]
+
+        class_names, predicate_names = vocab
+        with torch.no_grad():
+            text_dict = self.model.encode_captions(['. '.join(class_names[1:]) + '.'], self.device)
+            rel_text_dict = None
+            if self.model.sgg_mode != 'full':
+                rel_text_dict = self.model.encode_captions(['. '.join(predicate_names[1:]) + '.'],
+                                                           self.device, encode_relation=True)
+        name2classes = OrderedDict((name, idx) for idx, name in enumerate(class_names) if name != '__background__')
+        name2predicates = {name: idx for idx, name in enumerate(predicate_names)}
+
+        self.postprocessor.name2classes = name2classes
+        self.postprocessor._positive_map = None
+        positive_map = self.postprocessor.get_positive_map(self.postprocessor.max_text_len)
+
+        entry = (text_dict, rel_text_dict, name2classes, name2predicates, positive_map)
+        self._text_cache[vocab] = entry
+        if len(self._text_cache) > self.text_cache_size:
+            self._text_cache.popitem(last=False)
+        return entry
+
+    def _load_image(self, image):
+        if isinstance(image, str):
+            image = Image.open(image)
+        elif isinstance(image, (bytes, bytearray)):
+            image = Image.open(io.BytesIO(image))
+        elif isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        return image.convert('RGB')
+
+    def submit(self, image, classes=None, predicates=None):
+        """
+        Queue one image (path, encoded bytes, RGB array or PIL image), returns a Future
+        of the scene graph. Decoding and resizing run in the calling thread.
+        """
+        start = time.time()
+        image = self._load_image(image)
+        w, h = image.size
+        tensor, _ = self.transform(image, None)
+        self.stats.record('preprocess', time.time() - start)
+
+        vocab = self.default_vocab
+        if classes is not None or predicates is not None:
+            vocab = (tuple(classes) if classes is not None else vocab[0],
+                     tuple(predicates) if predicates is not None else vocab[1])
+        return self.batcher.submit({'image': tensor, 'orig_size': (h, w), 'vocab': vocab})
+
+    def predict(self, image, classes=None, predicates=None):
+        return self.submit(image, classes, predicates).result()
+
+    def _process(self, requests):
+        # one forward pass per vocabulary in the batch
+        groups = OrderedDict()
+        for idx, request in enumerate(requests):
+            groups.setdefault(request['vocab'], []).append(idx)
+
+        results = [None] * len(requests)
+        for vocab, indices in groups.items():
+            for idx, result in zip(indices, self._process_group(vocab, [requests[i] for i in indices])):
+                results[idx] = result
+        return results
+
+    @staticmethod
+    def _repeat(text_dict, bs):
+        if text_dict is None:
+            return None
+        return {k: v.repeat(bs, *([1] * (v.dim() - 1))) for k, v in text_dict.items()}
+
+    def _process_group(self, vocab, requests):
+        bs = len(requests)
+        start = time.time()
+        text_dict, rel_text_dict, name2classes, name2predicates, positive_map = self._text_features(vocab)
+        self.stats.record('text', time.time() - start)
+
+        start = time.time()
+        samples = nested_tensor_from_tensor_list([r['image'] for r in requests]).to(self.device)
+        target_sizes = torch.as_tensor([r['orig_size'] for r in requests], device=self.device)
+        with torch.no_grad():
+            outputs = self.model(samples, text_dict=self._repeat(text_dict, bs),
+                                 rel_text_dict=self._repeat(rel_text_dict, bs), inference_only=True)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.stats.record('forward', time.time() - start)
+
+        start = time.time()
+        self.postprocessor.name2classes = name2classes
+        self.postprocessor.name2predicates = name2predicates
+        self.postprocessor._positive_map = positive_map
+        with torch.no_grad():
+            results = self.postprocessor(outputs, target_sizes)
+        graphs = [self._format(res['graph'], vocab) for res in results]
+        self.stats.record('postprocess', time.time() - start)
+        return graphs
+
+    def _format(self, graph, vocab):
+        class_names, predicate_names = vocab
+        # graph_infer repeats a single object twice and adds an empty relation
+        num_objects = graph['node_id'].nelement()
+        objects = [{'box': box, 'label': class_names[label], 'score': score}
+                   for box, label, score in zip(graph['pred_boxes'].view(-1, 4)[:num_objects].tolist(),
+                                                graph['pred_boxes_class'].view(-1)[:num_objects].tolist(),
+                                                graph['pred_boxes_score'].view(-1)[:num_objects].tolist())]
+        relations = []
+        if num_objects > 1:
+            all_relation = graph['all_relation'][:self.max_relations]
+            rel_scores, rel_labels = all_relation[:, 1:].max(1)
+            for (sub, obj), label, score in zip(graph['all_node_pairs'][:self.max_relations].tolist(),
+                                                (rel_labels + 1).tolist(), rel_scores.tolist()):
+                relations.append({'subject': sub, 'object': obj,
+                                  'predicate': predicate_names[label], 'score': score})
+        return {'objects': objects, 'relations': relations}
+
+    def warmup(self, num_iters=3, image_size=(800, 1333)):
+        """Run full batches of blank images so that the first requests do not pay for
+        cudnn autotuning / lazy allocations, the warm-up latencies are not recorded."""
+        image = np.zeros((image_size[0], image_size[1], 3), dtype=np.uint8)
+        for _ in range(num_iters):
+            futures = [self.submit(image) for _ in range(self.batcher.max_batch_size)]
+            for future in futures:
+                future.result()
+        self.stats = LatencyStats()
+        self.batcher.stats = self.stats
+
+    def close(self):
+        self.batcher.close()
+
+
+class RequestError(ValueError):
+    """A malformed predict request, answered with http 400."""
+
+
+class InProcessClient(object):
+    """Client with the request / response format of the http server, calling the service directly."""
+
+    def __init__(self, service, image_root=None):
+        self.service = service
+        self.image_root = image_root
+
+    def predict(self, request):
+        return json.loads(json.dumps(_handle_predict(self.service, request, self.image_root)))
+
+    def metrics(self):
+        return self.service.stats.summary()
+
+
+def _resolve_image_path(path, image_root):
+    if image_root is None:
+        raise RequestError('"image_path" is disabled, the server has no image root')
+    if not isinstance(path, str):
+        raise RequestError('"image_path" must be a string')
+    root = os.path.realpath(image_root)
+    path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, path]) != root:
+        raise RequestError('"image_path" must be inside the image root')
+    return path
+
+
+def _handle_predict(service, request, image_root=None):
+    """request: {"image": base64 encoded image} or {"image_path": path relative to image_root},
+    optional "classes" / "predicates" lists with __background__ first"""
+    if not isinstance(request, dict):
+        raise RequestError('the request must be a json object')
+    if 'image' in request:
+        try:
+            image = base64.b64decode(request['image'], validate=True)
+        except (TypeError, ValueError):
+            raise RequestError('"image" is not base64 encoded')
+    elif 'image_path' in request:
+        image = _resolve_image_path(request['image_path'], image_root)
+    else:
+        raise RequestError('the request needs "image" or "image_path"')
+    for key in ('classes', 'predicates'):
+        names = request.get(key)
+        if names is not None and not (isinstance(names, list) and all(isinstance(n, str) for n in names)):
+            raise RequestError('"%s" must be a list of names' % key)
+    try:
+        # decoded here so that a bad image is told apart from a failure of the model;
+        # the message does not tell a missing file from an unreadable one
+        image = service._load_image(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise RequestError('cannot read the image')
+    return service.predict(image, request.get('classes'), request.get('predicates'))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_http_server(service, host='127.0.0.1', port=8000, image_root=None):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok'})
+            elif self.path == '/metrics':
+                self._send(200, service.stats.summary())
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length))
+            except ValueError:
+                self._send(400, {'error': 'the request is not valid json'})
+                return
+            try:
+                self._send(200, _handle_predict(service, request, image_root))
+            except RequestError as e:
+                self._send(400, {'error': str(e)})
+            except Exception as e:
+                # model / batching failures (e.g. cuda oom) are server errors, clients may retry
+                traceback.print_exc()
+                self._send(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return _ThreadingHTTPServer((host, port), Handler)
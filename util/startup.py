@@ -0,0 +1,61 @@
+"""
+Startup time profile: seconds since the process started at named points of main.py
+(imports done, model built, datasets built, first batch, ...).
+
+    from util.startup import startup_profile
+    startup_profile.mark('model built')
+    startup_profile.report(logger)
+
+Only the first mark of a name is kept, so marks inside loops (e.g. 'first train batch')
+cost a dict lookup afterwards. For a per-module import breakdown use
+`python -X importtime main.py ...`.
+"""
+import os
+import time
+from collections import OrderedDict
+
+
+def _process_start_time():
+    # /proc/self/stat field 22: start time in clock ticks after boot
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        start_after_boot = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.time() - (uptime - start_after_boot)
+    except (OSError, IndexError, ValueError, AttributeError):
+        return None
+
+
+class StartupProfile(object):
+    def __init__(self):
+        self.start_time = _process_start_time()
+        if self.start_time is None:
+            # no procfs: the first import of this module is the reference
+            self.start_time = time.time()
+        self.marks = OrderedDict()
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = time.time() - self.start_time
+
+    def summary(self):
+        return dict(self.marks)
+
+    def report(self, logger=None):
+        if not self.marks:
+            return
+        prev = 0.0
+        lines = ["Startup profile (s since process start / since previous mark):"]
+        for name, t in self.marks.items():
+            lines.append("  {:<24s} {:8.2f} {:8.2f}".format(name, t, t - prev))
+            prev = t
+        msg = "\n".join(lines)
+        if logger is not None:
+            logger.info(msg)
+        else:
+            print(msg)
+
+
+startup_profile = StartupProfile()